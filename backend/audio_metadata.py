@@ -0,0 +1,149 @@
+"""
+Voice note metadata: duration and a small waveform
+WAV is read with the standard library; other formats are decoded by ffmpeg when it is installed
+"""
+import base64
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import wave
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from file_crypto import FileCipher, is_encrypted_name
+
+logger = logging.getLogger(__name__)
+
+WAVEFORM_BARS = 64
+# ffmpeg decodes to mono 16-bit at this rate; plenty for peaks, cheap to scan
+DECODE_RATE = 8000
+FFMPEG_TIMEOUT = 30
+
+
+class UnsupportedAudio(Exception):
+    pass
+
+
+def _pcm16(frames: bytes, sample_width: int) -> array:
+    """Little-endian PCM of any common width as signed 16-bit samples"""
+    if sample_width == 1:
+        # 8-bit WAV is unsigned
+        return array("h", ((byte - 128) << 8 for byte in frames))
+    if sample_width == 2:
+        samples = array("h", frames)
+    elif sample_width in (3, 4):
+        # Keep the two most significant bytes of each sample
+        high = bytearray(len(frames) // sample_width * 2)
+        high[0::2] = frames[sample_width - 2::sample_width]
+        high[1::2] = frames[sample_width - 1::sample_width]
+        samples = array("h", bytes(high))
+    else:
+        raise UnsupportedAudio(f"{sample_width * 8}-bit samples")
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples
+
+
+def _peak(samples: array) -> int:
+    """Peak amplitude scaled to 0-255 (channels interleaved: the loudest one wins)"""
+    if not samples:
+        return 0
+    return min(max(max(samples), -min(samples)) * 255 // 32767, 255)
+
+
+def waveform_peaks(samples: array, bars: int = WAVEFORM_BARS) -> bytes:
+    step = max(-(-len(samples) // bars), 1)
+    peaks = bytes(_peak(samples[start:start + step]) for start in range(0, len(samples), step))
+    return peaks.ljust(bars, b"\0")
+
+
+def _from_wav(source) -> Tuple[int, bytes]:
+    """Reads one bar's worth of frames at a time, so long recordings stay cheap on memory"""
+    with wave.open(source, "rb") as reader:
+        rate = reader.getframerate()
+        frame_count = reader.getnframes()
+        sample_width = reader.getsampwidth()
+        frames_per_bar = max(-(-frame_count // WAVEFORM_BARS), 1)
+        peaks = bytearray()
+        while len(peaks) < WAVEFORM_BARS:
+            frames = reader.readframes(frames_per_bar)
+            if not frames:
+                break
+            peaks.append(_peak(_pcm16(frames, sample_width)))
+    if not rate:
+        raise UnsupportedAudio("WAV header has no sample rate")
+    return frame_count * 1000 // rate, bytes(peaks).ljust(WAVEFORM_BARS, b"\0")
+
+
+def _feed(source: BinaryIO, pipe: int):
+    try:
+        with open(pipe, "wb") as stdin:
+            shutil.copyfileobj(source, stdin)
+    except BrokenPipeError:
+        pass  # ffmpeg stopped reading; its exit status says why
+
+
+def _run_piped(command, source: BinaryIO) -> subprocess.CompletedProcess:
+    """Run ffmpeg with `source` streamed into its stdin from a thread, a chunk at a time"""
+    read_end, write_end = os.pipe()
+    try:
+        process = subprocess.Popen(command, stdin=read_end, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except BaseException:
+        os.close(write_end)
+        raise
+    finally:
+        os.close(read_end)
+    feeder = threading.Thread(target=_feed, args=(source, write_end), daemon=True)
+    feeder.start()
+    try:
+        stdout, stderr = process.communicate(timeout=FFMPEG_TIMEOUT)
+    except BaseException:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        feeder.join()
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+
+def _from_ffmpeg(path: Path, source: Optional[BinaryIO]) -> Tuple[int, bytes]:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise UnsupportedAudio("ffmpeg is not installed")
+    command = [ffmpeg, "-hide_banner", "-v", "error"]
+    # Encrypted files are decrypted as they are piped in; plain ones are read by path
+    command += ["-i", "pipe:0"] if source is not None else ["-nostdin", "-i", str(path)]
+    command += ["-f", "s16le", "-ac", "1", "-ar", str(DECODE_RATE), "pipe:1"]
+    if source is not None:
+        source.seek(0)
+        result = _run_piped(command, source)
+    else:
+        result = subprocess.run(command, capture_output=True, timeout=FFMPEG_TIMEOUT)
+    if result.returncode != 0:
+        raise UnsupportedAudio(result.stderr.decode(errors="replace").strip()[:200])
+    samples = _pcm16(result.stdout, 2)
+    return len(samples) * 1000 // DECODE_RATE, waveform_peaks(samples)
+
+
+def extract_audio_metadata(root: str, filename: str, cipher: Optional[FileCipher] = None) -> Dict:
+    """
+    Process pool entry point: {"duration_ms", "waveform"} for a stored audio file
+
+    The waveform is WAVEFORM_BARS peak bytes, base64 encoded (88 characters),
+    small enough to travel with every message.
+    """
+    path = Path(root) / filename
+    source = cipher.plaintext(path) if is_encrypted_name(filename) else None
+    try:
+        try:
+            duration_ms, peaks = _from_wav(source if source is not None else str(path))
+        except (wave.Error, EOFError, UnsupportedAudio):
+            duration_ms, peaks = _from_ffmpeg(path, source)
+    finally:
+        if source is not None:
+            source.close()
+    return {"duration_ms": duration_ms, "waveform": base64.b64encode(peaks).decode()}
@@ -0,0 +1,98 @@
+"""
+Benchmark for decrypting a page of message history
+Compares the inline per-message loop with PageDecryptor (cold and warm cache), and how long each stalls the event loop
+
+Run from backend/: python benchmarks/message_decrypt_bench.py [rounds] [page sizes...]
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from key_ring import KeyRing  # noqa: E402
+from message_crypto import MessageCipher, PageDecryptor  # noqa: E402
+
+PAGE_SIZES = [50, 500, 1000]
+
+
+def make_page(cipher, size):
+    content = "Merhaba, yarın toplantı saat kaçta? " * 4
+    translations = {"en": "Hello, what time is the meeting tomorrow? " * 4}
+    return [
+        cipher.seal({"id": str(uuid.uuid4()), "platform": "whatgram", "content": content,
+                     "translations": translations})
+        for _ in range(size)
+    ]
+
+
+async def inline_path(cipher, page):
+    """Decrypting each message on the event loop, as the history endpoints used to"""
+    for message in page:
+        try:
+            message.update(cipher.unseal(message))
+        except Exception:
+            pass
+
+
+async def measure(render, rounds):
+    """Average page latency and the longest the event loop went without running a 1 ms ticker"""
+    longest_stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal longest_stall
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            longest_stall = max(longest_stall, now - last - 0.001)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.005)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await render()
+        # Let the ticker run between pages so a stall covers one page, not the whole loop
+        await asyncio.sleep(0.002)
+    elapsed = time.perf_counter() - started - rounds * 0.002
+    running = False
+    await task
+    return elapsed / rounds * 1000, longest_stall * 1000
+
+
+async def run(rounds, page_sizes):
+    cipher = MessageCipher(KeyRing({"k1": os.urandom(32)}, "k1"))
+    print(f"{rounds} rounds per page size")
+    for size in page_sizes:
+        pages = [make_page(cipher, size) for _ in range(rounds)]
+        results = [("inline loop", await measure(lambda: inline_path(cipher, pages.pop()), rounds))]
+
+        # Cold: every page is new, so every message goes to the worker thread
+        cold = PageDecryptor(cipher.unseal, max_entries=size)
+        pages = [make_page(cipher, size) for _ in range(rounds)]
+        results.append(("PageDecryptor cold", await measure(lambda: cold.decrypt_page(pages.pop()), rounds)))
+
+        # Warm: the same page reloaded, as when a user reopens a conversation
+        warm = PageDecryptor(cipher.unseal, max_entries=size)
+        page = make_page(cipher, size)
+        await warm.decrypt_page(page)
+        results.append(("PageDecryptor warm", await measure(lambda: warm.decrypt_page(page), rounds)))
+
+        print(f"  {size} messages")
+        baseline = results[0][1][0]
+        for name, (ms, stall) in results:
+            print(f"    {name:<20} {ms:8.3f} ms/page  {baseline / ms:6.1f}x  loop stalled up to {stall:7.3f} ms")
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    page_sizes = [int(value) for value in sys.argv[2:]] or PAGE_SIZES
+    asyncio.run(run(rounds, page_sizes))
+
+
+if __name__ == "__main__":
+    main()
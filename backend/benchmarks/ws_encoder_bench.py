@@ -0,0 +1,95 @@
+"""
+Microbenchmark for WebSocket notification encoding
+Compares per-participant json.dumps of the full message with the serialize-once EventTemplate
+
+Run from backend/: python benchmarks/ws_encoder_bench.py [participants] [languages] [rounds]
+"""
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_protocol import JSON_CODEC, MSGPACK_CODEC, EventTemplate, orjson  # noqa: E402
+
+LANGUAGES = ["tr", "en", "de", "fr", "es", "ar", "ru", "ja"]
+
+
+def make_message(languages):
+    content = "Merhaba, yarın toplantı saat kaçta? " * 4
+    return SimpleNamespace(
+        id=str(uuid.uuid4()),
+        conversation_id=str(uuid.uuid4()),
+        sender_id=str(uuid.uuid4()),
+        receiver_id=str(uuid.uuid4()),
+        content=content,
+        platform="whatgram",
+        timestamp=datetime.utcnow(),
+        message_type="text",
+        original_language="tr",
+        file_message=None,
+        encrypted_content="gAAAAAB" + "x" * 240,
+        translations={lang: f"[{lang}] {content}" for lang in languages},
+        is_read=False,
+        is_delivered=False,
+        is_encrypted=True,
+    )
+
+
+def legacy_path(message, recipients):
+    """What send_message used to do: dump the whole message for every participant"""
+    frames = []
+    for language in recipients:
+        payload = dict(vars(message))
+        payload["content"] = message.translations.get(language, message.content)
+        frames.append(json.dumps({"type": "new_message", "message": payload,
+                                  "translated_for": language}, default=str))
+    return frames
+
+
+def template_path(message, recipients, codec):
+    template = EventTemplate("new_message", message)
+    return [
+        template.for_recipient(message.translations.get(language, message.content), language).render(codec)
+        for language in recipients
+    ]
+
+
+def timeit(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    participants = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    language_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    languages = LANGUAGES[:language_count]
+    message = make_message(languages)
+    recipients = [languages[i % len(languages)] for i in range(participants)]
+
+    print(f"{participants} participants, {len(languages)} languages, {rounds} rounds "
+          f"(orjson {'on' if orjson is not None else 'off'})")
+    results = [("json.dumps per participant", timeit(lambda: legacy_path(message, recipients), rounds),
+                len(legacy_path(message, recipients)[0]))]
+    results.append(("EventTemplate json", timeit(lambda: template_path(message, recipients, JSON_CODEC), rounds),
+                    len(template_path(message, recipients, JSON_CODEC)[0])))
+    if MSGPACK_CODEC is not None:
+        results.append(("EventTemplate msgpack",
+                        timeit(lambda: template_path(message, recipients, MSGPACK_CODEC), rounds),
+                        len(template_path(message, recipients, MSGPACK_CODEC)[0])))
+
+    baseline = results[0][1]
+    for name, ms, size in results:
+        print(f"  {name:<28} {ms:8.3f} ms/fan-out  {baseline / ms:6.1f}x  {size:5d} bytes/frame")
+
+
+if __name__ == "__main__":
+    main()
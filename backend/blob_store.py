@@ -0,0 +1,244 @@
+"""
+Content-addressed upload storage
+Identical files share one blob on disk, named by SHA-256 and reference counted in MongoDB
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from file_crypto import ENCRYPTED_MARKER, FileCipher, file_id_for
+from media_variants import VARIANT_SIZES, variant_filename
+from upload_writer import UploadWriter
+
+logger = logging.getLogger(__name__)
+
+
+class Blob(NamedTuple):
+    content_hash: str
+    filename: str
+    size: int
+    deduplicated: bool
+    encrypted: bool = False
+
+
+class BlobStore:
+    """
+    blobs documents: {hash, encrypted, filename, size, ref_count, created_at, last_referenced_at}
+
+    Every FileMessage pointing at a blob holds one reference. Blobs whose count
+    dropped to zero are removed by the collector after a grace period, once no
+    message is found referencing their file.
+
+    The same bytes stored encrypted and in the clear are two blobs; encrypted
+    ones are named <id>.wge<ext> and written through the FileCipher. Stored
+    names are random ids recorded on the blob document: the content hash stays
+    in the collection, so a link neither reveals nor lets anyone probe for
+    known content. Blobs stored before that keep their <hash> names.
+    """
+
+    def __init__(self, db, root: Path, writer: UploadWriter, cipher: Optional[FileCipher] = None,
+                 gc_interval: float = 3600.0, gc_grace_seconds: float = 86400.0,
+                 variant_sizes: Iterable[str] = tuple(VARIANT_SIZES)):
+        self.db = db
+        self.collection = db.blobs
+        self.root = root
+        self.writer = writer
+        self.cipher = cipher
+        self.gc_interval = gc_interval
+        self.gc_grace_seconds = gc_grace_seconds
+        self.variant_sizes = tuple(variant_sizes)
+        self._task: Optional[asyncio.Task] = None
+
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+        self.collected = 0
+
+    def path_for(self, filename: str) -> Path:
+        return self.root / filename
+
+    @staticmethod
+    def _filename(extension: str, encrypted: bool) -> str:
+        """A fresh opaque name for a new blob"""
+        blob_id = uuid.uuid4().hex
+        extension = extension.lower()
+        if encrypted:
+            return f"{blob_id}.{ENCRYPTED_MARKER}{extension}"
+        # An upload literally named *.wge must not look like an encrypted blob
+        return f"{blob_id}{'' if extension == '.' + ENCRYPTED_MARKER else extension}"
+
+    async def _reference(self, content_hash: str, size: int, filename: str, encrypted: bool) -> Optional[Dict]:
+        """
+        Add a reference, creating the blob document if needed; returns the document as it was
+
+        `filename` is only used when the document is created.
+        """
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            # Blobs stored before encryption existed have no flag and are plaintext
+            {"hash": content_hash, "encrypted": True if encrypted else {"$ne": True}},
+            {
+                "$inc": {"ref_count": 1},
+                "$set": {"last_referenced_at": now},
+                "$setOnInsert": {
+                    "encrypted": encrypted,
+                    "filename": filename,
+                    "size": size,
+                    "created_at": now
+                }
+            },
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+    async def _existing(self, previous: Optional[Dict], new_filename: str) -> Tuple[str, bool]:
+        """Filename for the blob and whether its bytes are already on disk"""
+        filename = previous["filename"] if previous else new_filename
+        # A racing first upload may still be writing; identical bytes make a second write harmless
+        exists = previous is not None and await self.writer.run_in_pool(self.path_for(filename).exists)
+        return filename, exists
+
+    def _check_cipher(self, encrypt: bool):
+        if encrypt and self.cipher is None:
+            raise RuntimeError("Encrypted storage requested but no FileCipher is configured")
+
+    async def store(self, upload, extension: str = "", encrypt: bool = False) -> Blob:
+        """Store an UploadFile, or just add a reference when the same bytes are already stored"""
+        self._check_cipher(encrypt)
+        digest = await self.writer.digest_upload(upload)
+        content_hash = digest.sha256
+        new_filename = self._filename(extension, encrypt)
+        previous = await self._reference(content_hash, digest.size, new_filename, encrypt)
+        filename, exists = await self._existing(previous, new_filename)
+        path = self.path_for(filename)
+        if exists:
+            self.deduplicated += 1
+            self.bytes_saved += digest.size
+            return Blob(content_hash, filename, digest.size, True, encrypt)
+
+        transform = self.cipher.encryptor(file_id_for(content_hash)) if encrypt else None
+        try:
+            await self.writer.write_upload(upload, path, transform)
+        except BaseException:
+            await self.release(filename)
+            raise
+        self.stored += 1
+        return Blob(content_hash, filename, digest.size, False, encrypt)
+
+    async def store_file(self, source: Path, extension: str = "", encrypt: bool = False, opener=None) -> Blob:
+        """
+        Adopt a finished file (e.g. an assembled resumable upload); the source is moved or removed
+
+        `opener` reads an encrypted source's plaintext (FileCipher.part_opener);
+        such a source can only be stored encrypted.
+        """
+        self._check_cipher(encrypt)
+        if opener is not None and not encrypt:
+            raise ValueError("An encrypted source must be stored encrypted")
+        digest = await self.writer.digest_file(source, opener)
+        content_hash = digest.sha256
+        new_filename = self._filename(extension, encrypt)
+        previous = await self._reference(content_hash, digest.size, new_filename, encrypt)
+        filename, exists = await self._existing(previous, new_filename)
+        if exists:
+            await self.writer.run_in_pool(self._unlink, source)
+            self.deduplicated += 1
+            self.bytes_saved += digest.size
+            return Blob(content_hash, filename, digest.size, True, encrypt)
+
+        destination = self.path_for(filename)
+        try:
+            if encrypt:
+                await self.writer.run_in_pool(
+                    self.cipher.encrypt_file, source, destination, file_id_for(content_hash), opener
+                )
+                await self.writer.run_in_pool(self._unlink, source)
+            else:
+                await self.writer.run_in_pool(os.replace, source, destination)
+        except BaseException:
+            await self.release(filename)
+            raise
+        self.stored += 1
+        return Blob(content_hash, filename, digest.size, False, encrypt)
+
+    async def release(self, filename: str):
+        """Drop one reference, e.g. when a message pointing at the blob is deleted"""
+        await self.collection.update_one({"filename": filename}, {"$inc": {"ref_count": -1}})
+
+    async def collect(self) -> int:
+        """Delete unreferenced blobs past the grace period"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.gc_grace_seconds)
+        candidates = await self.collection.find(
+            {"ref_count": {"$lte": 0}, "last_referenced_at": {"$lt": cutoff}},
+            {"_id": 0, "filename": 1, "last_referenced_at": 1}
+        ).to_list(1000)
+
+        collected = 0
+        for blob in candidates:
+            if await self.db.messages.count_documents({"file_message.filename": blob["filename"]}, limit=1):
+                # Still referenced (a count went wrong somewhere); keep it and repair the count
+                await self.collection.update_one({"filename": blob["filename"]}, {"$set": {"ref_count": 1}})
+                continue
+            # Only delete if nothing referenced it since it was selected
+            result = await self.collection.delete_one({
+                "filename": blob["filename"],
+                "ref_count": {"$lte": 0},
+                "last_referenced_at": blob["last_referenced_at"]
+            })
+            if result.deleted_count:
+                await self.writer.run_in_pool(self._remove, blob["filename"])
+                collected += 1
+        self.collected += collected
+        return collected
+
+    def _remove(self, filename: str):
+        """
+        Delete a blob and its image variants
+
+        Only exact names are removed: a wildcard on the stem would also match
+        the other copy of the same bytes (<hash>.jpg vs <hash>.wge.jpg).
+        """
+        self._unlink(self.path_for(filename))
+        for size in self.variant_sizes:
+            self._unlink(self.path_for(variant_filename(filename, size)))
+
+    @staticmethod
+    def _unlink(path: Path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                collected = await self.collect()
+                if collected:
+                    logger.info(f"Blob collector reclaimed {collected} unreferenced blobs")
+            except Exception as e:
+                logger.error(f"Blob collection failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "bytes_saved": self.bytes_saved,
+            "collected": self.collected,
+        }
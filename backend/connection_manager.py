@@ -0,0 +1,362 @@
+"""
+WebSocket connection registry
+Supports several sockets per user, each drained by its own writer task through a bounded queue
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, List, Optional, Set, Union
+
+from fastapi import WebSocket
+
+from ws_protocol import JSON_CODEC, SplicedFrame
+
+logger = logging.getLogger(__name__)
+
+# Pre-encoded text/binary frames, or events encoded with the socket's negotiated codec
+Frame = Union[str, bytes, dict, SplicedFrame]
+
+
+class BackpressurePolicy(str, Enum):
+    DROP = "drop"              # Discard the new frame when the queue is full
+    COALESCE = "coalesce"      # Replace a queued frame with the same key, else drop the oldest frame
+    DISCONNECT = "disconnect"  # Close the socket of a consumer that cannot keep up
+
+
+class ConnectionMetrics:
+    """Worker-wide counters shared by every connection"""
+
+    def __init__(self):
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.send_errors = 0
+        self.send_latency_total = 0.0
+        self.send_latency_max = 0.0
+        self.evicted_idle = 0
+        self.evicted_slow = 0
+        self.pings_sent = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def record_send(self, seconds: float, size: int):
+        self.frames_sent += 1
+        self.bytes_out += size
+        self.send_latency_total += seconds
+        if seconds > self.send_latency_max:
+            self.send_latency_max = seconds
+
+    def snapshot(self) -> Dict:
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "send_errors": self.send_errors,
+            "send_latency_avg_ms": round(self.send_latency_total / self.frames_sent * 1000, 3) if self.frames_sent else 0.0,
+            "send_latency_max_ms": round(self.send_latency_max * 1000, 3),
+            "evicted_idle": self.evicted_idle,
+            "evicted_slow": self.evicted_slow,
+            "pings_sent": self.pings_sent,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+        }
+
+
+class ClientConnection:
+    """One socket plus its outbound queue and writer task"""
+
+    def __init__(self, websocket: WebSocket, user_id: str, max_queue: int,
+                 policy: BackpressurePolicy, on_close=None,
+                 metrics: Optional[ConnectionMetrics] = None, codec=JSON_CODEC):
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max_queue
+        self.policy = policy
+        self.metrics = metrics or ConnectionMetrics()
+        self.codec = codec
+        self.closed = False
+        self.registered = False
+        self._closing = False
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.received_frames = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.connected_at = time.monotonic()
+        self.last_activity = self.connected_at
+
+        self._queue: Deque[list] = deque()
+        self._coalesced: Dict[str, list] = {}
+        self._wakeup = asyncio.Event()
+        self._on_close = on_close
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def touch(self, size: int = 0):
+        """Record inbound traffic (any frame, including pong) from the client"""
+        self.last_activity = time.monotonic()
+        self.received_frames += 1
+        self.bytes_in += size
+        self.metrics.bytes_in += size
+
+    def stats(self) -> Dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "codec": self.codec.name,
+            "connected_seconds": round(time.monotonic() - self.connected_at, 1),
+            "queue_depth": self.queue_depth,
+            "frames_out": self.sent_frames,
+            "frames_in": self.received_frames,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "dropped_frames": self.dropped_frames,
+        }
+
+    def _drop(self):
+        self.dropped_frames += 1
+        self.metrics.frames_dropped += 1
+
+    def enqueue(self, frame: Frame, coalesce_key: Optional[str] = None) -> bool:
+        """Queue a frame without blocking; returns False if it was not accepted"""
+        if self.closed:
+            return False
+
+        if coalesce_key is not None and self.policy == BackpressurePolicy.COALESCE:
+            queued = self._coalesced.get(coalesce_key)
+            if queued is not None:
+                # Newer state supersedes the frame still waiting in the queue
+                queued[1] = frame
+                return True
+
+        if len(self._queue) >= self.max_queue:
+            if self.policy == BackpressurePolicy.DISCONNECT:
+                logger.warning(f"Disconnecting slow consumer {self.user_id}/{self.id}")
+                self._drop()
+                self.metrics.evicted_slow += 1
+                asyncio.create_task(self.close(code=1013))
+                self.closed = True
+                return False
+            if self.policy == BackpressurePolicy.COALESCE:
+                oldest = self._queue.popleft()
+                self._forget(oldest)
+                self._drop()
+            else:
+                self._drop()
+                return False
+
+        item = [coalesce_key, frame]
+        self._queue.append(item)
+        if coalesce_key is not None:
+            self._coalesced[coalesce_key] = item
+        self._wakeup.set()
+        return True
+
+    def _forget(self, item: list):
+        key = item[0]
+        if key is not None and self._coalesced.get(key) is item:
+            del self._coalesced[key]
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                item = self._queue.popleft()
+                self._forget(item)
+                frame = item[1]
+                if isinstance(frame, SplicedFrame):
+                    frame = frame.render(self.codec)
+                elif isinstance(frame, dict):
+                    frame = self.codec.encode(frame)
+                started = time.perf_counter()
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                    size = len(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                    size = len(frame.encode())
+                self.metrics.record_send(time.perf_counter() - started, size)
+                self.sent_frames += 1
+                self.bytes_out += size
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A failed send means the socket is dead; evict it instead of retrying
+            self.metrics.send_errors += 1
+            logger.info(f"WebSocket send to {self.user_id}/{self.id} failed: {e}")
+            await self.close(code=1011)
+
+    async def close(self, code: int = 1000):
+        if self._closing:
+            return
+        self._closing = True
+        self.closed = True
+        self._wakeup.set()
+        if self._writer and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass  # Socket is already gone
+        if self._on_close:
+            self._on_close(self)
+
+
+class ConnectionManager:
+    """Registry of live sockets keyed by user, many sockets per user"""
+
+    def __init__(self, max_queue: int = 256, policy: BackpressurePolicy = BackpressurePolicy.DROP,
+                 heartbeat_interval: float = 25.0, idle_timeout: float = 75.0):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.active_connections: Set[ClientConnection] = set()
+        self.user_connections: Dict[str, Set[ClientConnection]] = {}
+        self.metrics = ConnectionMetrics()
+        self.bus = None
+        self.presence = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def attach_bus(self, bus):
+        """Route personal messages through a delivery bus so other workers see them too"""
+        self.bus = bus
+        bus.set_handler(self.deliver_local)
+        for user_id in self.user_connections:
+            bus.subscribe(user_id)
+
+    def attach_presence(self, presence):
+        """Report users' first connect and last disconnect, here and on other workers"""
+        self.presence = presence
+        if self.bus is not None:
+            self.bus.set_presence_handler(presence.users_changed)
+
+    async def connect(self, websocket: WebSocket, user_id: str, codec=JSON_CODEC,
+                      subprotocol: Optional[str] = None) -> ClientConnection:
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(
+            websocket, user_id, self.max_queue, self.policy,
+            on_close=self._unregister, metrics=self.metrics, codec=codec
+        )
+        self.active_connections.add(connection)
+        connection.start()
+        return connection
+
+    def register(self, connection: ClientConnection):
+        """
+        Route the user's frames to an authenticated socket and count it for presence
+
+        Until then a socket only gets heartbeats and replies to its own frames,
+        so opening /ws/<user_id> without a token neither receives that user's
+        messages nor makes them appear online.
+        """
+        if connection.registered or connection.closed:
+            return
+        connection.registered = True
+        user_id = connection.user_id
+        first = user_id not in self.user_connections
+        self.user_connections.setdefault(user_id, set()).add(connection)
+        if self.bus is not None:
+            self.bus.subscribe(user_id)
+        if first and self.presence is not None:
+            self.presence.user_online(user_id)
+
+    def _unregister(self, connection: ClientConnection):
+        self.active_connections.discard(connection)
+        sockets = self.user_connections.get(connection.user_id)
+        if sockets is not None:
+            sockets.discard(connection)
+            if not sockets:
+                del self.user_connections[connection.user_id]
+                if self.bus is not None:
+                    self.bus.unsubscribe(connection.user_id)
+                if self.presence is not None:
+                    self.presence.user_offline(connection.user_id)
+        if self.presence is not None:
+            self.presence.connection_closed(connection)
+
+    async def disconnect(self, connection: ClientConnection):
+        await connection.close()
+
+    def is_connected(self, user_id: str) -> bool:
+        return user_id in self.user_connections
+
+    def is_online(self, user_id: str) -> bool:
+        """Connected to this worker or, through the bus, to any other"""
+        if self.bus is not None:
+            return self.bus.is_online(user_id)
+        return self.is_connected(user_id)
+
+    def connections_for(self, user_id: str) -> List[ClientConnection]:
+        return list(self.user_connections.get(user_id, ()))
+
+    async def send_personal_message(self, message: Frame, user_id: str,
+                                    coalesce_key: Optional[str] = None) -> int:
+        """Send to every socket of a user, on this worker or (through the bus) on another"""
+        if self.bus is not None:
+            return await self.bus.publish(user_id, message, coalesce_key)
+        return await self.deliver_local(user_id, message, coalesce_key)
+
+    async def deliver_local(self, user_id: str, message: Frame,
+                            coalesce_key: Optional[str] = None) -> int:
+        """Queue a frame on this worker's sockets for a user; returns how many accepted it"""
+        return sum(
+            connection.enqueue(message, coalesce_key)
+            for connection in self.connections_for(user_id)
+        )
+
+    async def broadcast(self, message: Frame):
+        # Enqueueing never blocks; each socket's writer task sends concurrently
+        for connection in list(self.active_connections):
+            connection.enqueue(message)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            ping = {"type": "ping", "ts": time.time()}
+            for connection in list(self.active_connections):
+                if now - connection.last_activity > self.idle_timeout:
+                    # No pong or other traffic for several intervals: treat as half-open
+                    logger.info(f"Evicting idle WebSocket {connection.user_id}/{connection.id}")
+                    self.metrics.evicted_idle += 1
+                    asyncio.create_task(connection.close(code=1001))
+                elif connection.enqueue(ping, coalesce_key="ping"):
+                    self.metrics.pings_sent += 1
+
+    def start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        for connection in list(self.active_connections):
+            await connection.close(code=1001)
+
+    def stats(self) -> Dict:
+        depths = [c.queue_depth for c in self.active_connections]
+        return {
+            "connections": len(self.active_connections),
+            "users": len(self.user_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "policy": self.policy.value,
+            **self.metrics.snapshot(),
+        }
+
+    def connection_stats(self) -> List[Dict]:
+        """Per-socket bandwidth counters for this worker"""
+        return [connection.stats() for connection in self.active_connections]
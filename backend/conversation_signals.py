@@ -0,0 +1,158 @@
+"""
+Typing indicators and read receipts
+Both are coalesced server-side so chatty clients and busy groups stay cheap
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ReceiptHandler = Callable[[List[Dict]], Awaitable[None]]
+
+
+class TypingThrottle:
+    """Forward a user's typing start at most once per interval per conversation"""
+
+    def __init__(self, interval: float = 3.0, max_entries: int = 50000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._last: Dict[Tuple[str, str], float] = {}
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def allow(self, user_id: str, conversation_id: str, is_typing: bool) -> bool:
+        key = (user_id, conversation_id)
+        now = time.monotonic()
+        if is_typing:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                self.suppressed += 1
+                return False
+            if len(self._last) >= self.max_entries:
+                self._prune(now)
+            self._last[key] = now
+        elif self._last.pop(key, None) is None:
+            # A stop without a forwarded start has nothing to cancel
+            self.suppressed += 1
+            return False
+        self.forwarded += 1
+        return True
+
+    def _prune(self, now: float):
+        # Clients that never sent a stop; their indicator has long expired
+        expired = [key for key, last in self._last.items() if now - last >= self.interval]
+        for key in expired:
+            del self._last[key]
+
+    def stats(self) -> Dict:
+        return {"forwarded": self.forwarded, "suppressed": self.suppressed, "tracked": len(self._last)}
+
+
+class ReadReceiptBuffer:
+    """
+    Collapse read receipts to the newest message per (user, conversation)
+
+    Every flush interval the newest message seen in each pair marks everything
+    up to it as read with a single update_many, then the handler is told which
+    receipts were applied (to move read cursors and notify senders).
+    """
+
+    MAX_IDS_PER_KEY = 32
+
+    def __init__(self, db, flush_interval: float = 2.0, on_flush: Optional[ReceiptHandler] = None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self._pending: Dict[Tuple[str, str], Dict[str, None]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.received = 0
+        self.applied = 0
+        self.flushes = 0
+        self.messages_marked = 0
+
+    def add(self, user_id: str, conversation_id: str, message_id: str):
+        self.received += 1
+        ids = self._pending.setdefault((user_id, conversation_id), {})
+        ids[message_id] = None
+        if len(ids) > self.MAX_IDS_PER_KEY:
+            del ids[next(iter(ids))]
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        message_ids = list({message_id for ids in pending.values() for message_id in ids})
+        cursor = self.db.messages.find(
+            {"id": {"$in": message_ids}},
+            {"_id": 0, "id": 1, "conversation_id": 1, "timestamp": 1}
+        )
+        messages = {message["id"]: message async for message in cursor}
+
+        receipts = []
+        for (user_id, conversation_id), ids in pending.items():
+            seen = [
+                messages[message_id] for message_id in ids
+                if message_id in messages and messages[message_id]["conversation_id"] == conversation_id
+            ]
+            if not seen:
+                continue
+            newest = max(seen, key=lambda message: message["timestamp"])
+            receipts.append({
+                "user_id": user_id,
+                "conversation_id": conversation_id,
+                "message_id": newest["id"],
+                "timestamp": newest["timestamp"],
+            })
+        self.flushes += 1
+        await self.apply(receipts)
+
+    async def apply(self, receipts: List[Dict]):
+        """Mark everything up to each receipt's message read, in one update_many"""
+        if not receipts:
+            return
+        result = await self.db.messages.update_many(
+            {"is_read": False, "$or": [
+                {
+                    "conversation_id": receipt["conversation_id"],
+                    "sender_id": {"$ne": receipt["user_id"]},
+                    "timestamp": {"$lte": receipt["timestamp"]}
+                }
+                for receipt in receipts
+            ]},
+            {"$set": {"is_read": True}}
+        )
+        self.messages_marked += result.modified_count
+        self.applied += len(receipts)
+        if self.on_flush is not None:
+            await self.on_flush(receipts)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Read receipt flush failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict:
+        return {
+            "received": self.received,
+            "applied": self.applied,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "messages_marked": self.messages_marked,
+        }
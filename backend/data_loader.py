@@ -0,0 +1,93 @@
+"""
+Request-scoped data loader for MongoDB lookups
+Collapses duplicate and concurrent reads keyed by (collection, id) into batched `$in` queries
+"""
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DataLoader:
+    """Batching loader that lives for a single request"""
+
+    def __init__(self, db, key_field: str = "id"):
+        self.db = db
+        self.key_field = key_field
+        self._futures: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._pending: Dict[str, Dict[str, asyncio.Future]] = {}
+        self._dispatch_scheduled = False
+
+        # Per-request counters
+        self.query_count = 0
+        self.lookup_count = 0
+        self.collection_queries: Dict[str, int] = {}
+
+    def _future_for(self, collection: str, doc_id: str) -> asyncio.Future:
+        key = (collection, doc_id)
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[key] = future
+            self._pending.setdefault(collection, {})[doc_id] = future
+            self._schedule_dispatch()
+        return future
+
+    def _schedule_dispatch(self):
+        if self._dispatch_scheduled:
+            return
+        self._dispatch_scheduled = True
+        # Defer to the next loop iteration so sibling coroutines can queue their keys first
+        loop = asyncio.get_running_loop()
+        loop.call_soon(lambda: loop.create_task(self._dispatch()))
+
+    async def _dispatch(self):
+        self._dispatch_scheduled = False
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(*(
+            self._fetch(collection, futures) for collection, futures in pending.items()
+        ))
+
+    async def _fetch(self, collection: str, futures: Dict[str, asyncio.Future]):
+        ids = list(futures.keys())
+        self.query_count += 1
+        self.collection_queries[collection] = self.collection_queries.get(collection, 0) + 1
+        try:
+            docs = await self.db[collection].find(
+                {self.key_field: {"$in": ids}}, {"_id": 0}
+            ).to_list(len(ids))
+        except Exception as e:
+            logger.error(f"DataLoader query on {collection} failed: {e}")
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        found = {doc[self.key_field]: doc for doc in docs}
+        for doc_id, future in futures.items():
+            if not future.done():
+                future.set_result(found.get(doc_id))
+
+    async def load(self, collection: str, doc_id: Optional[str]) -> Optional[dict]:
+        """Load one document by id, sharing the query with other lookups in this request"""
+        if doc_id is None:
+            return None
+        self.lookup_count += 1
+        return await asyncio.shield(self._future_for(collection, doc_id))
+
+    async def load_many(self, collection: str, doc_ids: Iterable[str]) -> List[Optional[dict]]:
+        """Load several documents with at most one query for the ids not seen yet"""
+        doc_ids = list(doc_ids)
+        self.lookup_count += len(doc_ids)
+        futures = [self._future_for(collection, doc_id) for doc_id in doc_ids]
+        if not futures:
+            return []
+        return list(await asyncio.shield(asyncio.gather(*futures)))
+
+    def stats(self) -> Dict:
+        return {
+            "queries": self.query_count,
+            "lookups": self.lookup_count,
+            "collections": dict(self.collection_queries),
+        }
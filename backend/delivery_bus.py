@@ -0,0 +1,387 @@
+"""
+Delivery bus for WebSocket fan-out across workers
+A frame published for a user reaches whichever worker process holds that user's sockets
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Union
+
+import bson
+from bson import Binary
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+from message_crypto import MessageCipher
+from ws_protocol import SplicedFrame
+
+logger = logging.getLogger(__name__)
+
+Frame = Union[str, bytes, dict, SplicedFrame]
+DeliveryHandler = Callable[[str, Frame, Optional[str]], Awaitable[int]]
+PresenceHandler = Callable[[List[str]], None]
+InvalidationHandler = Callable[[str, str], None]
+
+
+class DeliveryBus:
+    """Base bus: tracks which users this worker serves and hands frames to the local handler"""
+
+    def __init__(self):
+        self.handler: Optional[DeliveryHandler] = None
+        self.presence_handler: Optional[PresenceHandler] = None
+        self.invalidation_handler: Optional[InvalidationHandler] = None
+        self.local_users: Set[str] = set()
+        self.published = 0
+        self.delivered = 0
+
+    def set_handler(self, handler: DeliveryHandler):
+        self.handler = handler
+
+    def set_presence_handler(self, handler: PresenceHandler):
+        """Called with the users whose sockets on other workers came or went"""
+        self.presence_handler = handler
+
+    def set_invalidation_handler(self, handler: InvalidationHandler):
+        """Called with (scope, key) when another worker invalidates a cached entry"""
+        self.invalidation_handler = handler
+
+    def invalidate(self, scope: str, key: str):
+        """Tell the other workers to drop a cached entry; nothing to do with a single worker"""
+
+    def subscribe(self, user_id: str):
+        self.local_users.add(user_id)
+
+    def unsubscribe(self, user_id: str):
+        self.local_users.discard(user_id)
+
+    def is_online(self, user_id: str) -> bool:
+        """Whether any worker known to this bus holds a socket for the user"""
+        return user_id in self.local_users
+
+    async def _deliver_local(self, user_id: str, frame: Frame, coalesce_key: Optional[str]) -> int:
+        if user_id not in self.local_users or self.handler is None:
+            return 0
+        self.delivered += 1
+        return await self.handler(user_id, frame, coalesce_key)
+
+    async def publish(self, user_id: str, frame: Frame, coalesce_key: Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {
+            "backend": type(self).__name__,
+            "local_users": len(self.local_users),
+            "published": self.published,
+            "delivered": self.delivered,
+        }
+
+
+class InProcessBus(DeliveryBus):
+    """Single-worker bus: publishing is a direct local delivery"""
+
+    async def publish(self, user_id: str, frame: Frame, coalesce_key: Optional[str] = None) -> int:
+        self.published += 1
+        return await self._deliver_local(user_id, frame, coalesce_key)
+
+
+class LocalBroker:
+    """In-memory broker stand-in; every listener sees every event, like a shared broker would"""
+
+    def __init__(self, max_backlog: int = 10000):
+        self.max_backlog = max_backlog
+        self._listeners: List[asyncio.Queue] = []
+
+    async def publish(self, event: Dict):
+        for queue in list(self._listeners):
+            if queue.qsize() < self.max_backlog:
+                queue.put_nowait(event)
+
+    async def listen(self) -> AsyncIterator[Dict]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._listeners.remove(queue)
+
+
+class MongoBroker:
+    """
+    Broker on a capped MongoDB collection read through a tailable cursor
+
+    Frames carry message bodies and the collection keeps them until it wraps,
+    so with a cipher each event is stored sealed: {id, sealed} where sealed
+    is the BSON-encoded event, authenticated against its random id.
+    """
+
+    def __init__(self, db, collection: str = "ws_events", size_bytes: int = 64 * 1024 * 1024,
+                 cipher: Optional[MessageCipher] = None):
+        self.db = db
+        self.collection_name = collection
+        self.size_bytes = size_bytes
+        self.cipher = cipher
+        self.unreadable = 0
+
+    async def _ensure_collection(self):
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass  # Already created by another worker
+
+    def _seal(self, event: Dict) -> Dict:
+        if self.cipher is None:
+            return dict(event)
+        event_id = uuid.uuid4().hex
+        return {"id": event_id, "sealed": Binary(self.cipher.encrypt_bytes(event_id, bson.encode(event)))}
+
+    def _open(self, document: Dict) -> Optional[Dict]:
+        if "sealed" not in document:
+            return document
+        try:
+            return bson.decode(self.cipher.decrypt_bytes(document["id"], document["sealed"]))
+        except Exception as e:
+            self.unreadable += 1
+            logger.warning(f"Skipping unreadable delivery bus event {document.get('id')}: {e!r}")
+            return None
+
+    async def publish(self, event: Dict):
+        await self.db[self.collection_name].insert_one(self._seal(event))
+
+    @staticmethod
+    async def _position(collection, document_id) -> Optional[int]:
+        """Index of a document in insertion order, or None once the collection has wrapped past it"""
+        position = 0
+        async for document in collection.find({}, {"_id": 1}, sort=[("$natural", 1)]):
+            if document["_id"] == document_id:
+                return position
+            position += 1
+        return None
+
+    async def listen(self) -> AsyncIterator[Dict]:
+        await self._ensure_collection()
+        collection = self.db[self.collection_name]
+
+        # Only events published after this worker started are of interest
+        newest = await collection.find_one({}, sort=[("$natural", -1)])
+        last_id = newest["_id"] if newest else None
+
+        while True:
+            # ObjectIds from different workers aren't ordered, so resume by position: the
+            # cursor starts on the last event seen, which must come back first to prove the
+            # position still held. If it was overwritten, everything left is newer.
+            resume_on = None
+            skip = 0
+            if last_id is not None:
+                position = await self._position(collection, last_id)
+                if position is not None:
+                    resume_on, skip = last_id, position
+            cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT, skip=skip)
+            relocate = False
+            while cursor.alive and not relocate:
+                async for document in cursor:
+                    if resume_on is not None:
+                        # Anything else means the collection wrapped between the scan and the cursor
+                        relocate = document["_id"] != resume_on
+                        resume_on = None
+                        if relocate:
+                            break
+                        continue
+                    last_id = document["_id"]
+                    event = self._open(document)
+                    if event is not None:
+                        yield event
+            if relocate:
+                await cursor.close()
+                continue
+            # Tailable cursors die on an empty collection; back off and reopen
+            await asyncio.sleep(0.5)
+
+
+class BrokerBus(DeliveryBus):
+    """
+    Multi-worker bus: frames go through a shared broker and each worker keeps its own users' frames
+
+    Workers also publish control events when users come and go, plus a periodic
+    announcement of their full user set, so is_online() covers every worker.
+    A worker that stops announcing is forgotten after three intervals.
+
+    Frames only go through the broker for users some other worker holds. Until
+    this worker has heard a full round of announcements its view of the others
+    is incomplete, so for that first interval every frame is published.
+    """
+
+    def __init__(self, broker, announce_interval: float = 30.0):
+        super().__init__()
+        self.broker = broker
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.announce_interval = announce_interval
+        self.received = 0
+        self.remote_users: Dict[str, Set[str]] = {}
+        self.worker_seen: Dict[str, float] = {}
+        self.skipped = 0
+        self._warm_after = float("inf")
+        self._listener: Optional[asyncio.Task] = None
+        self._announcer: Optional[asyncio.Task] = None
+        self._publishing: Set[asyncio.Task] = set()
+
+    def subscribe(self, user_id: str):
+        if user_id not in self.local_users:
+            super().subscribe(user_id)
+            self._control("online", [user_id])
+
+    def unsubscribe(self, user_id: str):
+        if user_id in self.local_users:
+            super().unsubscribe(user_id)
+            self._control("offline", [user_id])
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.local_users or self._held_remotely(user_id)
+
+    def _held_remotely(self, user_id: str) -> bool:
+        cutoff = time.monotonic() - 3 * self.announce_interval
+        return any(
+            user_id in users and self.worker_seen.get(worker_id, 0) > cutoff
+            for worker_id, users in self.remote_users.items()
+        )
+
+    def invalidate(self, scope: str, key: str):
+        if self._listener is not None:
+            self._spawn(self._publish_event(
+                {"origin": self.worker_id, "control": "invalidate", "scope": scope, "key": key}
+            ))
+
+    def _control(self, kind: str, user_ids: List[str]):
+        if self._listener is not None:
+            self._spawn(self._publish_control(kind, user_ids))
+
+    def _spawn(self, coroutine: Awaitable):
+        # The loop only keeps weak references to tasks; hold these until they finish
+        task = asyncio.create_task(coroutine)
+        self._publishing.add(task)
+        task.add_done_callback(self._published)
+
+    def _published(self, task: asyncio.Task):
+        self._publishing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Delivery bus control event failed: {task.exception()}")
+
+    async def _publish_control(self, kind: str, user_ids: List[str]):
+        await self._publish_event({"origin": self.worker_id, "control": kind, "user_ids": user_ids})
+
+    async def _publish_event(self, event: Dict):
+        try:
+            await self.broker.publish(event)
+        except Exception as e:
+            logger.error(f"Delivery bus control event failed: {e}")
+
+    def _apply_control(self, event: Dict):
+        worker_id = event["origin"]
+        self.worker_seen[worker_id] = time.monotonic()
+        kind = event["control"]
+        if kind == "invalidate":
+            if self.invalidation_handler is not None:
+                self.invalidation_handler(event["scope"], event["key"])
+            return
+        before = self.remote_users.get(worker_id, set())
+        if kind == "announce":
+            after = set(event["user_ids"])
+        elif kind == "online":
+            after = before | set(event["user_ids"])
+        elif kind == "offline":
+            after = before - set(event["user_ids"])
+        else:
+            return
+        self.remote_users[worker_id] = after
+        self._presence_changed(before ^ after)
+
+    def _presence_changed(self, user_ids: Set[str]):
+        if user_ids and self.presence_handler is not None:
+            self.presence_handler(list(user_ids))
+
+    async def _announce_loop(self):
+        while True:
+            await self._publish_control("announce", list(self.local_users))
+            cutoff = time.monotonic() - 3 * self.announce_interval
+            for worker_id, seen in list(self.worker_seen.items()):
+                if seen < cutoff:
+                    del self.worker_seen[worker_id]
+                    self._presence_changed(self.remote_users.pop(worker_id, set()))
+            await asyncio.sleep(self.announce_interval)
+
+    async def publish(self, user_id: str, frame: Frame, coalesce_key: Optional[str] = None) -> int:
+        self.published += 1
+        # Sockets on this worker are served right away; the broker carries the frame to the others
+        delivered = await self._deliver_local(user_id, frame, coalesce_key)
+        if time.monotonic() >= self._warm_after and not self._held_remotely(user_id):
+            self.skipped += 1
+            return delivered
+        if isinstance(frame, SplicedFrame):
+            frame = frame.to_event()
+        await self.broker.publish({
+            "origin": self.worker_id,
+            "user_id": user_id,
+            "frame": frame,
+            "coalesce_key": coalesce_key,
+        })
+        return delivered
+
+    async def _listen(self):
+        while True:
+            try:
+                async for event in self.broker.listen():
+                    self.received += 1
+                    if event.get("origin") == self.worker_id:
+                        continue
+                    if "control" in event:
+                        self._apply_control(event)
+                        continue
+                    await self._deliver_local(event["user_id"], event["frame"], event.get("coalesce_key"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Delivery bus listener failed, restarting: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        if self._listener is None:
+            self._warm_after = time.monotonic() + self.announce_interval
+            self._listener = asyncio.create_task(self._listen())
+            self._announcer = asyncio.create_task(self._announce_loop())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._announcer.cancel()
+            self._listener.cancel()
+            self._listener = self._announcer = None
+            if self._publishing:
+                await asyncio.gather(*self._publishing, return_exceptions=True)
+            # Let the other workers drop this worker's users right away
+            await self._publish_control("announce", [])
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats["worker_id"] = self.worker_id
+        stats["received"] = self.received
+        stats["skipped"] = self.skipped
+        stats["remote_workers"] = len(self.remote_users)
+        stats["remote_users"] = sum(len(users) for users in self.remote_users.values())
+        stats["unreadable"] = getattr(self.broker, "unreadable", 0)
+        return stats
+
+
+def create_delivery_bus(backend: str, db=None, cipher: Optional[MessageCipher] = None) -> DeliveryBus:
+    """Build the bus selected by DELIVERY_BUS: inprocess (default), mongo or local"""
+    if backend == "mongo":
+        return BrokerBus(MongoBroker(db, cipher=cipher))
+    if backend == "local":
+        return BrokerBus(LocalBroker())
+    return InProcessBus()
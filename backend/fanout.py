@@ -0,0 +1,151 @@
+"""
+Fan-out engine for new messages
+Recipients are bucketed by preferred language so each translation and encoding happens once per language
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANGUAGE = "tr"
+
+TranslateFn = Callable[[str, str, Optional[str]], Awaitable[Dict]]
+
+
+class FanoutPlan:
+    """Recipients of one message grouped by preferred language"""
+
+    def __init__(self):
+        self.buckets: Dict[str, List[str]] = {}
+        # Languages at least one auto-translating recipient wants
+        self.translate_to: Set[str] = set()
+
+    def add(self, user_id: str, language: str, auto_translate: bool):
+        self.buckets.setdefault(language, []).append(user_id)
+        if auto_translate:
+            self.translate_to.add(language)
+
+    @property
+    def recipients(self) -> int:
+        return sum(len(user_ids) for user_ids in self.buckets.values())
+
+
+class FanoutMetrics:
+    """Worker-wide fan-out counters"""
+
+    def __init__(self):
+        self.fanouts = 0
+        self.recipients = 0
+        self.delivered = 0
+        self.send_errors = 0
+        self.queued_offline = 0
+        self.translations = 0
+        self.largest_fanout = 0
+        self.translate_total = 0.0
+        self.deliver_total = 0.0
+        self.deliver_max = 0.0
+
+    def snapshot(self) -> Dict:
+        return {
+            "fanouts": self.fanouts,
+            "recipients": self.recipients,
+            "delivered": self.delivered,
+            "send_errors": self.send_errors,
+            "queued_offline": self.queued_offline,
+            "translations": self.translations,
+            "largest_fanout": self.largest_fanout,
+            "translate_avg_ms": round(self.translate_total / self.fanouts * 1000, 3) if self.fanouts else 0.0,
+            "deliver_avg_ms": round(self.deliver_total / self.fanouts * 1000, 3) if self.fanouts else 0.0,
+            "deliver_max_ms": round(self.deliver_max * 1000, 3),
+        }
+
+
+class FanoutEngine:
+    """Plans, translates and delivers one message to every other participant of its conversation"""
+
+    def __init__(self, db, manager, translate: TranslateFn, chunk_size: int = 500,
+                 lookup_batch: int = 5000, default_language: str = DEFAULT_LANGUAGE,
+                 offline_queue=None):
+        self.db = db
+        self.manager = manager
+        self.offline_queue = offline_queue
+        self.translate_fn = translate
+        self.chunk_size = chunk_size
+        self.lookup_batch = lookup_batch
+        self.default_language = default_language
+        self.metrics = FanoutMetrics()
+
+    async def plan(self, participant_ids: Iterable[str], sender_id: str) -> FanoutPlan:
+        """Bulk-load language preferences with a projection, in $in batches"""
+        recipient_ids = [pid for pid in participant_ids if pid != sender_id]
+        plan = FanoutPlan()
+        for start in range(0, len(recipient_ids), self.lookup_batch):
+            cursor = self.db.users.find(
+                {"id": {"$in": recipient_ids[start:start + self.lookup_batch]}},
+                {"_id": 0, "id": 1, "preferred_language": 1, "auto_translate": 1}
+            )
+            async for user in cursor:
+                plan.add(
+                    user["id"],
+                    user.get("preferred_language") or self.default_language,
+                    user.get("auto_translate", True)
+                )
+        return plan
+
+    async def translate(self, content: str, source_language: str, plan: FanoutPlan) -> Dict[str, str]:
+        """One translation per target language, requested concurrently"""
+        started = time.perf_counter()
+        targets = sorted(language for language in plan.translate_to if language != source_language)
+        results = await asyncio.gather(*(
+            self.translate_fn(content, language, source_language) for language in targets
+        ))
+        translations = {language: result["translated_text"] for language, result in zip(targets, results)}
+        # Always include original language
+        translations[source_language] = content
+        self.metrics.translations += len(targets)
+        self.metrics.translate_total += time.perf_counter() - started
+        return translations
+
+    async def deliver(self, template, plan: FanoutPlan, translations: Dict[str, str],
+                      fallback_content: Optional[str]) -> int:
+        """
+        Send one frame per language bucket to its recipients, a chunk of concurrent sends at a time
+
+        Recipients with no socket on any worker get the event in the offline queue instead.
+        """
+        started = time.perf_counter()
+        delivered = 0
+        for language, user_ids in plan.buckets.items():
+            frame = template.for_recipient(translations.get(language, fallback_content), language)
+            for start in range(0, len(user_ids), self.chunk_size):
+                chunk = user_ids[start:start + self.chunk_size]
+                results = await asyncio.gather(*(
+                    self.manager.send_personal_message(frame, user_id) for user_id in chunk
+                ), return_exceptions=True)
+                offline = []
+                for user_id, result in zip(chunk, results):
+                    if isinstance(result, Exception):
+                        self.metrics.send_errors += 1
+                        logger.error(f"Fan-out send to {user_id} failed: {result}")
+                    elif result:
+                        delivered += result
+                    elif not self.manager.is_online(user_id):
+                        offline.append(user_id)
+                if offline and self.offline_queue is not None:
+                    await self.offline_queue.enqueue_many(offline, template.message.id, frame.to_event())
+                    self.metrics.queued_offline += len(offline)
+
+        elapsed = time.perf_counter() - started
+        metrics = self.metrics
+        metrics.fanouts += 1
+        metrics.recipients += plan.recipients
+        metrics.delivered += delivered
+        metrics.largest_fanout = max(metrics.largest_fanout, plan.recipients)
+        metrics.deliver_total += elapsed
+        metrics.deliver_max = max(metrics.deliver_max, elapsed)
+        return delivered
+
+    def stats(self) -> Dict:
+        return self.metrics.snapshot()
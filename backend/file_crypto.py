@@ -0,0 +1,298 @@
+"""
+Chunked AES-GCM encryption for stored attachments
+Files are encrypted while they stream to disk and any chunk can be decrypted on its own
+"""
+import io
+import logging
+import math
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import BinaryIO
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from key_ring import KeyRing
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WGF1"
+DEFAULT_CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+FILE_ID_SIZE = 16
+
+# Encrypted blobs are named <sha256>.wge<ext>; variants keep the marker (<sha256>.wge.thumb.webp)
+ENCRYPTED_MARKER = "wge"
+
+
+class InvalidEncryptedFile(Exception):
+    pass
+
+
+def is_encrypted_name(filename: str) -> bool:
+    return filename.split(".")[1:2] == [ENCRYPTED_MARKER]
+
+
+def file_id_for(content_hash: str) -> bytes:
+    """
+    Files are keyed by their content: identical plaintext encrypts to an
+    identical file, so content-addressed dedup keeps working
+    """
+    return bytes.fromhex(content_hash)[:FILE_ID_SIZE]
+
+
+def _nonce(index: int) -> bytes:
+    # Every file has its own derived key, so a chunk counter is a unique nonce
+    return index.to_bytes(12, "big")
+
+
+def _aad(header: bytes, last: bool) -> bytes:
+    # The flag stops a truncated file from passing as complete
+    return header + (b"\x01" if last else b"\x00")
+
+
+class ChunkEncryptor:
+    """
+    Incremental encryption: update() with plaintext, finalize() at the end
+
+    Layout: MAGIC | key id length (1) | key id | chunk size (4) | file id (16),
+    then chunks of chunk_size plaintext + 16 byte tag; the last one may be
+    shorter (or empty) and is sealed with the last-chunk flag.
+    """
+
+    def __init__(self, key_ring: KeyRing, file_id: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        key_id, _ = key_ring.current
+        encoded_id = key_id.encode()
+        self.header = MAGIC + bytes([len(encoded_id)]) + encoded_id + struct.pack(">I", chunk_size) + file_id
+        self.chunk_size = chunk_size
+        self._aead = AESGCM(key_ring.derive(key_id, b"file:" + file_id))
+        self._buffer = bytearray()
+        self._index = 0
+        self._header_written = False
+
+    def _start(self) -> bytes:
+        if self._header_written:
+            return b""
+        self._header_written = True
+        return self.header
+
+    def _seal(self, data: bytes, last: bool) -> bytes:
+        sealed = self._aead.encrypt(_nonce(self._index), data, _aad(self.header, last))
+        self._index += 1
+        return sealed
+
+    def update(self, data: bytes) -> bytes:
+        out = [self._start()]
+        self._buffer.extend(data)
+        # Hold back a full chunk: it can only be sealed once we know whether it is the last
+        while len(self._buffer) > self.chunk_size:
+            out.append(self._seal(bytes(self._buffer[:self.chunk_size]), False))
+            del self._buffer[:self.chunk_size]
+        return b"".join(out)
+
+    def finalize(self) -> bytes:
+        out = self._start() + self._seal(bytes(self._buffer), True)
+        self._buffer.clear()
+        return out
+
+
+class EncryptedFileReader:
+    """Random access to the plaintext of an encrypted file"""
+
+    def __init__(self, handle: BinaryIO, key_ring: KeyRing):
+        self.handle = handle
+        prefix = handle.read(len(MAGIC) + 1)
+        if len(prefix) < len(MAGIC) + 1 or prefix[:len(MAGIC)] != MAGIC:
+            raise InvalidEncryptedFile("Not an encrypted attachment")
+        rest = handle.read(prefix[-1] + 4 + FILE_ID_SIZE)
+        key_id = rest[:prefix[-1]].decode()
+        (self.chunk_size,) = struct.unpack(">I", rest[prefix[-1]:prefix[-1] + 4])
+        file_id = rest[prefix[-1] + 4:]
+        self.header = prefix + rest
+        self.key_id = key_id
+
+        try:
+            self._aead = AESGCM(key_ring.derive(key_id, b"file:" + file_id))
+        except KeyError:
+            raise InvalidEncryptedFile(f"Unknown key id {key_id!r}")
+
+        body = os.fstat(handle.fileno()).st_size - len(self.header)
+        self.chunk_count = max(math.ceil(body / (self.chunk_size + TAG_SIZE)), 1)
+        self.size = body - self.chunk_count * TAG_SIZE
+        if self.size < 0:
+            raise InvalidEncryptedFile("Encrypted attachment is truncated")
+
+    def read_chunk(self, index: int) -> bytes:
+        self.handle.seek(len(self.header) + index * (self.chunk_size + TAG_SIZE))
+        sealed = self.handle.read(self.chunk_size + TAG_SIZE)
+        last = index == self.chunk_count - 1
+        return self._aead.decrypt(_nonce(index), sealed, _aad(self.header, last))
+
+    def read_at(self, position: int, length: int) -> bytes:
+        """Up to `length` plaintext bytes from `position`, never crossing a chunk boundary"""
+        index, offset = divmod(position, self.chunk_size)
+        return self.read_chunk(index)[offset:offset + length]
+
+    def read_all(self) -> bytes:
+        return b"".join(self.read_chunk(index) for index in range(self.chunk_count))
+
+    def close(self):
+        self.handle.close()
+
+
+class PlaintextFile(io.RawIOBase):
+    """
+    Seekable plaintext of an encrypted file, decrypted one chunk at a time
+
+    Only the current chunk is held in memory, however large the file. Wrap it
+    in a BufferedReader for libraries that expect read(n) to return n bytes.
+    """
+
+    def __init__(self, reader: EncryptedFileReader):
+        self.reader = reader
+        self.position = 0
+        self._index = None
+        self._chunk = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.reader.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.reader.size:
+            return 0
+        index, offset = divmod(self.position, self.reader.chunk_size)
+        if index != self._index:
+            self._chunk = self.reader.read_chunk(index)
+            self._index = index
+        data = self._chunk[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.reader.close()
+        super().close()
+
+
+class PartStream:
+    """
+    Seekable AES-CTR for the partial file of a resumable upload
+
+    Ciphertext offsets equal plaintext offsets, so a part file can be appended
+    to, truncated and resumed at any byte exactly like a plaintext one. Each
+    session has its own derived key, and a resumed chunk rewrites the bytes of
+    the same file at the same offset. There is no tag: part files are
+    temporary and re-sealed with AES-GCM when the upload completes.
+    """
+
+    BLOCK = 16
+
+    def __init__(self, key: bytes, offset: int = 0):
+        block, skip = divmod(offset, self.BLOCK)
+        self._context = Cipher(algorithms.AES(key), modes.CTR(block.to_bytes(16, "big"))).encryptor()
+        self._context.update(bytes(skip))
+
+    def update(self, data: bytes) -> bytes:
+        return self._context.update(data)
+
+
+class PartReader:
+    """Plaintext reads from an encrypted part file, from the start"""
+
+    def __init__(self, handle: BinaryIO, key: bytes):
+        self.handle = handle
+        self._stream = PartStream(key)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.update(self.handle.read(size))
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileCipher:
+    """Encrypt and decrypt attachment files with keys from a KeyRing"""
+
+    def __init__(self, key_ring: KeyRing, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.key_ring = key_ring
+        self.chunk_size = chunk_size
+
+    def encryptor(self, file_id: bytes) -> ChunkEncryptor:
+        return ChunkEncryptor(self.key_ring, file_id, self.chunk_size)
+
+    def open(self, path: Path) -> EncryptedFileReader:
+        handle = open(path, "rb")
+        try:
+            return EncryptedFileReader(handle, self.key_ring)
+        except BaseException:
+            handle.close()
+            raise
+
+    def _encrypt_into(self, destination: Path, file_id: bytes, reader: BinaryIO):
+        """Encrypt everything `reader` yields into `destination`, written under a temporary name first"""
+        encryptor = self.encryptor(file_id)
+        temp_path = destination.parent / f".{uuid.uuid4().hex}.part"
+        try:
+            with open(temp_path, "wb") as writer:
+                while True:
+                    data = reader.read(self.chunk_size)
+                    if not data:
+                        break
+                    writer.write(encryptor.update(data))
+                writer.write(encryptor.finalize())
+            os.replace(temp_path, destination)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def encrypt_file(self, source: Path, destination: Path, file_id: bytes, opener=None):
+        """`opener` reads the source's plaintext when it is not stored in the clear (e.g. open_part)"""
+        with (opener or open)(source, "rb") as reader:
+            self._encrypt_into(destination, file_id, reader)
+
+    def _part_key(self, key_id: str, session_id: str) -> bytes:
+        return self.key_ring.derive(key_id, b"part:" + session_id.encode())
+
+    def part_stream(self, key_id: str, session_id: str, offset: int) -> PartStream:
+        return PartStream(self._part_key(key_id, session_id), offset)
+
+    def part_opener(self, key_id: str, session_id: str):
+        """An open()-like callable giving the plaintext of an upload session's part file"""
+        key = self._part_key(key_id, session_id)
+        return lambda path, mode="rb": PartReader(open(path, mode), key)
+
+    def write_bytes(self, data: bytes, destination: Path, file_id: bytes):
+        self._encrypt_into(destination, file_id, io.BytesIO(data))
+
+    def plaintext(self, path: Path) -> BinaryIO:
+        """A seekable plaintext stream, for libraries that want a file (e.g. Pillow); close it when done"""
+        reader = self.open(path)
+        return io.BufferedReader(PlaintextFile(reader), buffer_size=reader.chunk_size)
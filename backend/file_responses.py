@@ -0,0 +1,270 @@
+"""
+Download responses for stored files
+Byte ranges, ETag revalidation and cache headers, or hand-off to a front proxy that sends the bytes itself
+"""
+import logging
+import mimetypes
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from file_crypto import EncryptedFileReader, FileCipher, is_encrypted_name
+
+logger = logging.getLogger(__name__)
+
+# Blob filenames start with a random id (older blobs: the SHA-256 of their bytes) that is never reused
+CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{32}([0-9a-f]{32})?(\.|$)")
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Decrypted WhatGram files: the browser may keep them, shared caches and proxies may not
+PRIVATE_IMMUTABLE = "private, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+SENDFILE_MODES = ("", "x-accel", "x-sendfile")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    A single byte range as (start, end inclusive), or None to send the whole file
+
+    Multi-range and malformed headers are ignored, which HTTP allows; a range
+    starting past the end raises RangeNotSatisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, separator, last = spec.strip().partition("-")
+    if not separator:
+        return None
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match comparison (weak: a W/ prefix on either side is ignored)"""
+    tag = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or (candidate[2:] if candidate.startswith("W/") else candidate) == tag:
+            return True
+    return False
+
+
+class FileServer:
+    """
+    Serve files from the uploads directory
+
+    sendfile_mode "x-accel" (nginx) or "x-sendfile" (Apache, lighttpd) answers
+    with headers only and lets the proxy stream the file, ranges included;
+    conditional requests are still decided here.
+
+    Encrypted files are always served from here, decrypted chunk by chunk, so
+    memory stays constant and ranges only decrypt the chunks they touch.
+    """
+
+    def __init__(self, root: Path, cipher: Optional[FileCipher] = None, sendfile_mode: str = "",
+                 accel_prefix: str = "/protected-uploads/", chunk_size: int = 256 * 1024):
+        if sendfile_mode not in SENDFILE_MODES:
+            raise ValueError(f"Unknown sendfile mode {sendfile_mode!r}, expected one of {SENDFILE_MODES}")
+        self.root = root
+        self.cipher = cipher
+        self.sendfile_mode = sendfile_mode
+        self.accel_prefix = accel_prefix.rstrip("/") + "/"
+        self.chunk_size = chunk_size
+
+        self.served = 0
+        self.partial = 0
+        self.not_modified = 0
+        self.offloaded = 0
+        self.unsatisfiable = 0
+        self.decrypted = 0
+        self.decrypt_failures = 0
+
+    def etag(self, filename: str, stat_result: os.stat_result) -> str:
+        if CONTENT_ADDRESSED.match(filename):
+            # Variants share the blob's id, so the tag keeps everything but the extension
+            return f'"{filename.rsplit(".", 1)[0] if "." in filename else filename}"'
+        return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+    @staticmethod
+    def cache_control(filename: str, immutable: bool) -> str:
+        if not immutable or not CONTENT_ADDRESSED.match(filename):
+            return REVALIDATE
+        return PRIVATE_IMMUTABLE if is_encrypted_name(filename) else IMMUTABLE
+
+    def _headers(self, filename: str, stat_result: os.stat_result, immutable: bool) -> Dict[str, str]:
+        return {
+            "etag": self.etag(filename, stat_result),
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "cache-control": self.cache_control(filename, immutable),
+            "accept-ranges": "bytes",
+        }
+
+    @staticmethod
+    def _not_modified(request: Request, headers: Dict[str, str], stat_result: os.stat_result) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, headers["etag"])
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def response(self, request: Request, filename: str, immutable: bool = True) -> Response:
+        """
+        Response for GET/HEAD of a stored file; raises FileNotFoundError when missing
+
+        immutable=False keeps a content-addressed file revalidating, for when
+        the URL may later resolve to a different file (a variant not yet ready).
+        """
+        path = self.root / filename
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise FileNotFoundError(filename)
+
+        headers = self._headers(filename, stat_result, immutable)
+        if self._not_modified(request, headers, stat_result):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+
+        media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        if is_encrypted_name(filename):
+            return await self._encrypted_response(request, path, headers, media_type)
+        if self.sendfile_mode:
+            self.offloaded += 1
+            if self.sendfile_mode == "x-accel":
+                headers["x-accel-redirect"] = self.accel_prefix + quote(filename)
+            else:
+                headers["x-sendfile"] = str(path.resolve())
+            return Response(headers=headers, media_type=media_type)
+
+        size = stat_result.st_size
+        try:
+            byte_range = self._byte_range(request, headers, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+
+        if byte_range is None:
+            self.served += 1
+            return FileResponse(path, stat_result=stat_result, headers=headers, media_type=media_type)
+
+        start, end = byte_range
+        status_code = self._partial_headers(headers, start, end, size)
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            self._read(path, start, end - start + 1), status_code=status_code, headers=headers, media_type=media_type
+        )
+
+    def _byte_range(self, request: Request, headers: Dict[str, str], size: int) -> Optional[Tuple[int, int]]:
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if not range_header or (if_range is not None and if_range.strip() not in (headers["etag"], headers["last-modified"])):
+            return None
+        try:
+            return parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            self.unsatisfiable += 1
+            raise
+
+    def _partial_headers(self, headers: Dict[str, str], start: int, end: int, size: int) -> int:
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+        headers["content-length"] = str(end - start + 1)
+        self.partial += 1
+        return 206
+
+    async def _encrypted_response(self, request: Request, path: Path, headers: Dict[str, str],
+                                  media_type: str) -> Response:
+        if self.cipher is None:
+            raise RuntimeError("Encrypted file requested but no FileCipher is configured")
+        reader = await anyio.to_thread.run_sync(self.cipher.open, path)
+        size = reader.size
+        try:
+            byte_range = self._byte_range(request, headers, size)
+        except RangeNotSatisfiable:
+            reader.close()
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+
+        if byte_range is None:
+            start, end, status_code = 0, size - 1, 200
+            headers["content-length"] = str(size)
+            self.served += 1
+        else:
+            start, end = byte_range
+            status_code = self._partial_headers(headers, start, end, size)
+
+        if request.method == "HEAD" or size == 0:
+            reader.close()
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        self.decrypted += 1
+        return StreamingResponse(
+            self._decrypt(reader, start, end - start + 1), status_code=status_code,
+            headers=headers, media_type=media_type
+        )
+
+    async def _decrypt(self, reader: EncryptedFileReader, start: int, length: int) -> AsyncIterator[bytes]:
+        position = start
+        try:
+            while length > 0:
+                chunk = await anyio.to_thread.run_sync(reader.read_at, position, length)
+                if not chunk:
+                    return
+                position += len(chunk)
+                length -= len(chunk)
+                yield chunk
+        except Exception as e:
+            # Headers are already sent; all that is left is to cut the response short
+            self.decrypt_failures += 1
+            logger.error(f"Decrypting {reader.handle.name} failed at byte {position}: {e!r}")
+            raise
+        finally:
+            reader.close()
+
+    async def _read(self, path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+        async with await anyio.open_file(path, "rb") as handle:
+            await handle.seek(start)
+            while length > 0:
+                chunk = await handle.read(min(self.chunk_size, length))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+
+    def stats(self) -> Dict:
+        return {
+            "sendfile_mode": self.sendfile_mode or None,
+            "served": self.served,
+            "partial": self.partial,
+            "not_modified": self.not_modified,
+            "offloaded": self.offloaded,
+            "unsatisfiable": self.unsatisfiable,
+            "decrypted": self.decrypted,
+            "decrypt_failures": self.decrypt_failures,
+        }
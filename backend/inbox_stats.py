@@ -0,0 +1,208 @@
+"""
+Incrementally maintained inbox statistics
+One small document per user, bumped with $inc as messages and conversations are created
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+CHAT_TYPES = ("private", "group", "channel")
+
+
+class InboxStats:
+    """
+    inbox_stats documents: {user_id, platforms: {platform: {count, latest}},
+    chats: {private, group, channel, total}, unread: {conversation_id: count},
+    reconciled_at, stale}
+
+    Unread counts go up by one for every recipient of a new message, up to
+    the read cursors' count cap, and are reset from the read cursors when a
+    reader's cursor moves.
+
+    Counters can drift (racing writes, migrations, membership changes), so a
+    background job recomputes documents older than reconcile_interval, and a
+    document flagged stale is recomputed on its next read.
+    """
+
+    def __init__(self, db, read_cursors=None, reconcile_interval: float = 3600.0, batch_size: int = 200,
+                 write_batch: int = 5000):
+        self.db = db
+        self.read_cursors = read_cursors
+        self.collection = db.inbox_stats
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        self.write_batch = write_batch
+        # Same cap as the recount, so reconciliation doesn't "correct" a long backlog
+        self.unread_cap = read_cursors.count_cap if read_cursors is not None else None
+        self._task: Optional[asyncio.Task] = None
+        self._updates: Set[asyncio.Task] = set()
+
+        self.increments = 0
+        self.reconciled = 0
+        self.corrections = 0
+        self.failed_updates = 0
+
+    async def _update_users(self, user_ids: Iterable[str], update: Dict, condition: Optional[Dict] = None):
+        user_ids = list(set(user_ids))
+        for start in range(0, len(user_ids), self.write_batch):
+            await self.collection.update_many(
+                {"user_id": {"$in": user_ids[start:start + self.write_batch]}, **(condition or {})}, update
+            )
+        self.increments += 1
+
+    def schedule_message_added(self, participant_ids: Iterable[str], platform: str, timestamp: datetime,
+                               conversation_id: Optional[str] = None, sender_id: Optional[str] = None):
+        """message_added off the caller's path; a big group's counters shouldn't delay its sender"""
+        task = asyncio.create_task(self.message_added(
+            list(participant_ids), platform, timestamp, conversation_id=conversation_id, sender_id=sender_id
+        ))
+        self._updates.add(task)
+        task.add_done_callback(self._update_done)
+
+    def _update_done(self, task: asyncio.Task):
+        self._updates.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # The next reconciliation repairs whatever the update missed
+            self.failed_updates += 1
+            logger.error(f"Inbox stats update failed: {task.exception()}")
+
+    async def message_added(self, participant_ids: Iterable[str], platform: str, timestamp: datetime,
+                            conversation_id: Optional[str] = None, sender_id: Optional[str] = None):
+        participant_ids = list(participant_ids)
+        counters = {f"platforms.{platform}.count": 1}
+        latest = {f"platforms.{platform}.latest": timestamp}
+        recipients = [user_id for user_id in participant_ids if user_id != sender_id]
+        if conversation_id is None or not recipients:
+            await self._update_users(participant_ids, {"$inc": counters, "$max": latest})
+            return
+        # The message is unread for everyone but its sender
+        if sender_id in participant_ids:
+            await self._update_users([sender_id], {"$inc": counters, "$max": latest})
+        unread = f"unread.{conversation_id}"
+        if self.unread_cap is None:
+            await self._update_users(recipients, {"$inc": {**counters, unread: 1}, "$max": latest})
+            return
+        # At-cap first: a count the second update lifts to the cap must not match both
+        await self._update_users(
+            recipients, {"$inc": counters, "$max": latest}, {unread: {"$gte": self.unread_cap}}
+        )
+        await self._update_users(
+            recipients, {"$inc": {**counters, unread: 1}, "$max": latest},
+            {unread: {"$not": {"$gte": self.unread_cap}}}
+        )
+
+    async def unread_changed(self, user_id: str, counts: Dict[str, int]):
+        """Overwrite a user's unread counts for these conversations, e.g. after their read cursor moved"""
+        update = {}
+        cleared = {f"unread.{conversation_id}": "" for conversation_id, count in counts.items() if not count}
+        if cleared:
+            update["$unset"] = cleared
+        unread = {f"unread.{conversation_id}": count for conversation_id, count in counts.items() if count}
+        if unread:
+            update["$set"] = unread
+        if update:
+            await self.collection.update_one({"user_id": user_id}, update)
+
+    async def conversation_added(self, participant_ids: Iterable[str], conversation_type: str):
+        await self._update_users(participant_ids, {
+            "$inc": {f"chats.{conversation_type}": 1, "chats.total": 1}
+        })
+
+    async def invalidate(self, user_ids: Iterable[str]):
+        """Recompute these users' stats on their next read"""
+        await self._update_users(user_ids, {"$set": {"stale": True}})
+
+    async def compute(self, user_id: str) -> Dict:
+        """Full recount from conversations and messages; the slow path the counters replace"""
+        conversations = await self.db.conversations.find(
+            {"participant_ids": user_id},
+            {"_id": 0, "id": 1, "conversation_type": 1, "last_message_at": 1}
+        ).to_list(None)
+
+        chats = {chat_type: 0 for chat_type in CHAT_TYPES}
+        for conv in conversations:
+            if conv.get("conversation_type") in chats:
+                chats[conv["conversation_type"]] += 1
+        chats["total"] = len(conversations)
+
+        platforms = {}
+        if conversations:
+            cursor = self.db.messages.aggregate([
+                {"$match": {"conversation_id": {"$in": [conv["id"] for conv in conversations]}}},
+                {"$group": {"_id": "$platform", "count": {"$sum": 1}, "latest": {"$max": "$timestamp"}}}
+            ])
+            async for row in cursor:
+                platforms[row["_id"]] = {"count": row["count"], "latest": row["latest"]}
+
+        unread = {}
+        if conversations and self.read_cursors is not None:
+            counts = await self.read_cursors.unread_counts(user_id, conversations)
+            unread = {conversation_id: count for conversation_id, count in counts.items() if count}
+
+        return {"user_id": user_id, "platforms": platforms, "chats": chats, "unread": unread}
+
+    async def reconcile_user(self, user_id: str, current: Optional[Dict] = None) -> Dict:
+        fresh = await self.compute(user_id)
+        if current is not None and (
+            current.get("platforms") != fresh["platforms"] or current.get("chats") != fresh["chats"]
+            or current.get("unread") != fresh["unread"]
+        ):
+            self.corrections += 1
+        fresh["reconciled_at"] = datetime.utcnow()
+        fresh["stale"] = False
+        await self.collection.replace_one({"user_id": user_id}, fresh, upsert=True)
+        self.reconciled += 1
+        return fresh
+
+    async def get(self, user_id: str) -> Dict:
+        stats = await self.collection.find_one({"user_id": user_id}, {"_id": 0})
+        if stats is None or stats.get("stale"):
+            stats = await self.reconcile_user(user_id)
+        return stats
+
+    async def reconcile_due(self) -> int:
+        """Recompute a batch of documents not reconciled within the interval"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.reconcile_interval)
+        due: List[Dict] = await self.collection.find(
+            {"reconciled_at": {"$lt": cutoff}}, {"_id": 0}
+        ).limit(self.batch_size).to_list(self.batch_size)
+        for stats in due:
+            await self.reconcile_user(stats["user_id"], stats)
+        return len(due)
+
+    async def _run(self):
+        while True:
+            try:
+                started = time.perf_counter()
+                count = await self.reconcile_due()
+                if count:
+                    logger.info(f"Reconciled inbox stats for {count} users in {time.perf_counter() - started:.2f}s")
+                    if count == self.batch_size:
+                        continue  # More are due; keep going
+            except Exception as e:
+                logger.error(f"Inbox stats reconciliation failed: {e}")
+            await asyncio.sleep(min(self.reconcile_interval, 60.0))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._updates:
+            await asyncio.gather(*self._updates, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "increments": self.increments,
+            "reconciled": self.reconciled,
+            "corrections": self.corrections,
+            "pending_updates": len(self._updates),
+            "failed_updates": self.failed_updates,
+        }
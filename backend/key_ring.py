@@ -0,0 +1,100 @@
+"""
+Persisted, versioned master keys
+A JSON file of base64 keys by id; the current id encrypts, every id still decrypts
+
+Rotate with: python key_ring.py rotate <path>, then restart the workers
+"""
+import base64
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 32
+
+
+class KeyRing:
+    """
+    {"current": "k1", "keys": {"k1": "<base64>"}}
+
+    Master keys are never used directly: derive() produces a separate key per
+    purpose (and per file), so one master key can safely serve many formats.
+    """
+
+    def __init__(self, keys: Dict[str, bytes], current: str):
+        if current not in keys:
+            raise ValueError(f"Current key {current!r} is not in the key ring")
+        self.keys = keys
+        self.current_id = current
+
+    @property
+    def current(self) -> Tuple[str, bytes]:
+        return self.current_id, self.keys[self.current_id]
+
+    def get(self, key_id: str) -> bytes:
+        return self.keys[key_id]
+
+    def derive(self, key_id: str, purpose: bytes, length: int = KEY_SIZE) -> bytes:
+        return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=purpose).derive(self.keys[key_id])
+
+    def rotated(self) -> "KeyRing":
+        """A ring with a fresh current key; the previous keys stay for decryption"""
+        number = len(self.keys) + 1
+        while f"k{number}" in self.keys:
+            number += 1
+        return KeyRing({**self.keys, f"k{number}": os.urandom(KEY_SIZE)}, f"k{number}")
+
+    def save(self, path: Path):
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as handle:
+            handle.write(self.to_json())
+        os.replace(temp_path, path)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "current": self.current_id,
+            "keys": {key_id: base64.b64encode(key).decode() for key_id, key in self.keys.items()}
+        }, indent=2)
+
+    @classmethod
+    def from_json(cls, data: str) -> "KeyRing":
+        parsed = json.loads(data)
+        return cls({key_id: base64.b64decode(key) for key_id, key in parsed["keys"].items()}, parsed["current"])
+
+    @classmethod
+    def load_or_create(cls, path: Path) -> "KeyRing":
+        """Load the ring, creating it with one fresh key on first boot (safe when workers race)"""
+        try:
+            return cls.from_json(path.read_text())
+        except FileNotFoundError:
+            pass
+        ring = cls({"k1": os.urandom(KEY_SIZE)}, "k1")
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as handle:
+            handle.write(ring.to_json())
+        try:
+            # link() never replaces an existing file, so only one worker's ring is published
+            os.link(temp_path, path)
+        except FileExistsError:
+            return cls.from_json(path.read_text())
+        finally:
+            os.unlink(temp_path)
+        logger.warning(f"Created a new key ring at {path}; back it up, data encrypted with it is unreadable without it")
+        return ring
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "rotate":
+        sys.exit("usage: python key_ring.py rotate <path>")
+    ring = KeyRing.from_json(Path(sys.argv[2]).read_text()).rotated()
+    ring.save(Path(sys.argv[2]))
+    print(f"Current key is now {ring.current_id}; messages are re-encrypted in the background after a restart")
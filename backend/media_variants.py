@@ -0,0 +1,274 @@
+"""
+Image thumbnails and downscaled variants, audio metadata
+Rendered on a process pool after upload; variant files sit next to the original in the uploads directory
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from audio_metadata import extract_audio_metadata
+from file_crypto import FileCipher, file_id_for, is_encrypted_name
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional dependency: uploads are stored without variants
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels, largest first so each variant is scaled from the previous one
+VARIANT_SIZES: Dict[str, int] = {"medium": 1280, "thumb": 320}
+THUMBNAIL = "thumb"
+
+
+def variant_filename(filename: str, size: str) -> str:
+    return f"{Path(filename).stem}.{size}.webp"
+
+
+def write_atomically(data: bytes, destination: Path):
+    """Write under a temporary name in the same directory, then rename into place"""
+    temp_path = destination.parent / f".{uuid.uuid4().hex}.part"
+    try:
+        with open(temp_path, "wb") as writer:
+            writer.write(data)
+        os.replace(temp_path, destination)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def render_variants(root: str, filename: str, sizes: Dict[str, int], quality: int,
+                    cipher: Optional[FileCipher] = None) -> Tuple[Dict[str, str], float]:
+    """
+    Process pool entry point: write the variants of one image
+
+    Returns {size: variant filename} and the seconds spent. Variants already on
+    disk (the same blob uploaded again) are reused, and no image is upscaled:
+    a size at or above the original's longest edge is skipped, except the
+    thumbnail, which is always written so clients have something small to show.
+    Variants of an encrypted original are encrypted too. Each variant appears
+    under its final name only once it is complete, so a crashed render never
+    leaves a truncated file for the reuse check to pick up.
+    """
+    started = time.perf_counter()
+    root_path = Path(root)
+    targets = {size: variant_filename(filename, size) for size in sizes}
+    if all((root_path / name).exists() for name in targets.values()):
+        return targets, time.perf_counter() - started
+
+    encrypted = is_encrypted_name(filename)
+    variants = {}
+    opened = cipher.plaintext(root_path / filename) if encrypted else open(root_path / filename, "rb")
+    with opened, Image.open(opened) as source:
+        largest = max(sizes.values())
+        # JPEG can decode at a reduced scale directly, which is far cheaper than a full decode
+        source.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        longest = max(image.size)
+
+        for size, edge in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            if edge >= longest and size != THUMBNAIL:
+                continue
+            if edge < longest:
+                image = image.copy()
+                image.thumbnail((edge, edge), Image.LANCZOS)
+                longest = max(image.size)
+            encoded = io.BytesIO()
+            image.save(encoded, "WEBP", quality=quality, method=4)
+            data = encoded.getvalue()
+            if encrypted:
+                cipher.write_bytes(data, root_path / targets[size], file_id_for(hashlib.sha256(data).hexdigest()))
+            else:
+                write_atomically(data, root_path / targets[size])
+            variants[size] = targets[size]
+    return variants, time.perf_counter() - started
+
+
+class MediaProcessor:
+    """
+    Generate image variants and voice note metadata in the background
+
+    Work goes to a process pool so resizing never competes with the event loop
+    for the GIL. When more than max_pending images are waiting, new ones are
+    skipped; clients fall back to the original file. Audio metadata has a pool
+    and a pending limit of its own, so a slow decode never holds up image
+    variants. A decode that overruns audio_timeout keeps running in its worker,
+    so it keeps its slot until it ends: at most audio_workers jobs are ever in
+    the pool, and timed-out ones can't pile up behind it.
+    """
+
+    def __init__(self, db, root: Path, cipher: Optional[FileCipher] = None, max_workers: int = 2,
+                 max_pending: int = 200, sizes: Optional[Dict[str, int]] = None, quality: int = 80,
+                 audio_timeout: float = 10.0, audio_workers: int = 1):
+        self.db = db
+        self.root = root
+        self.cipher = cipher
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.sizes = sizes or VARIANT_SIZES
+        self.quality = quality
+        self.audio_timeout = audio_timeout
+        self.audio_workers = audio_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._audio_executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._audio_tasks: Set[asyncio.Task] = set()
+        self._audio_slots = asyncio.Semaphore(audio_workers)
+
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.process_seconds = 0.0
+        self.max_process_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.audio_processed = 0
+        self.audio_failed = 0
+        self.audio_timeouts = 0
+        self.audio_skipped = 0
+        self.audio_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    @staticmethod
+    def _spawn_pool(max_workers: int) -> ProcessPoolExecutor:
+        # spawn: forking a process that runs Motor's threads is not safe
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = self._spawn_pool(self.max_workers)
+        return self._executor
+
+    def _audio_pool(self) -> ProcessPoolExecutor:
+        if self._audio_executor is None:
+            self._audio_executor = self._spawn_pool(self.audio_workers)
+        return self._audio_executor
+
+    def submit(self, message_id: str, filename: str, mime_type: str) -> bool:
+        """Queue variants for an image message or metadata for an audio one; returns whether it was queued"""
+        if mime_type.startswith("audio/"):
+            return self._queue(self._audio_tasks, self._process_audio(message_id, filename), "audio_skipped")
+        if not self.enabled or not mime_type.startswith("image/") or mime_type == "image/svg+xml":
+            return False
+        return self._queue(self._tasks, self._process(message_id, filename), "skipped")
+
+    def _queue(self, tasks: Set[asyncio.Task], job, skipped: str) -> bool:
+        if len(tasks) >= self.max_pending:
+            job.close()
+            setattr(self, skipped, getattr(self, skipped) + 1)
+            return False
+        task = asyncio.create_task(job)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return True
+
+    async def _process(self, message_id: str, filename: str):
+        queued = time.perf_counter()
+        try:
+            variants, seconds = await asyncio.get_running_loop().run_in_executor(
+                self._pool(), render_variants, str(self.root), filename, self.sizes, self.quality,
+                self.cipher if is_encrypted_name(filename) else None
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Could not render variants of {filename} for message {message_id}: {e}")
+            return
+
+        self.processed += 1
+        self.process_seconds += seconds
+        self.max_process_seconds = max(self.max_process_seconds, seconds)
+        self.queue_seconds += max(time.perf_counter() - queued - seconds, 0.0)
+        if not variants:
+            return
+        update = {"file_message.variants": {size: f"/uploads/{name}" for size, name in variants.items()}}
+        if THUMBNAIL in variants:
+            update["file_message.thumbnail_path"] = f"/uploads/{variants[THUMBNAIL]}"
+        await self.db.messages.update_one({"id": message_id}, {"$set": update})
+
+    async def _process_audio(self, message_id: str, filename: str):
+        async with self._audio_slots:
+            metadata = await self.audio_metadata(filename)
+        if metadata:
+            await self.db.messages.update_one({"id": message_id}, {"$set": {
+                "file_message.duration_ms": metadata["duration_ms"],
+                "file_message.waveform": metadata["waveform"],
+            }})
+
+    async def audio_metadata(self, filename: str) -> Optional[Dict]:
+        """Duration and waveform of a stored audio file, or None if it can't be read in audio_timeout"""
+        started = time.perf_counter()
+        job = asyncio.get_running_loop().run_in_executor(
+            self._audio_pool(), extract_audio_metadata, str(self.root), filename,
+            self.cipher if is_encrypted_name(filename) else None
+        )
+        try:
+            metadata = await asyncio.wait_for(asyncio.shield(job), self.audio_timeout)
+        except asyncio.TimeoutError:
+            self.audio_failed += 1
+            self.audio_timeouts += 1
+            logger.warning(f"Gave up on audio metadata of {filename} after {self.audio_timeout}s")
+            # A worker can't be interrupted; wait for it so the caller's slot covers the whole job
+            await asyncio.wait([job])
+            return None
+        except Exception as e:
+            self.audio_failed += 1
+            logger.warning(f"Could not read audio metadata of {filename}: {e!r}")
+            return None
+        self.audio_processed += 1
+        self.audio_seconds += time.perf_counter() - started
+        return metadata
+
+    def resolve(self, filename: str, size: Optional[str]) -> str:
+        """Filename to serve for a requested size; the original until the variant exists"""
+        if size is None or size == "original":
+            return filename
+        if size not in self.sizes:
+            raise KeyError(size)
+        variant = variant_filename(filename, size)
+        return variant if (self.root / variant).exists() else filename
+
+    async def stop(self):
+        for task in list(self._tasks) + list(self._audio_tasks):
+            task.cancel()
+        for executor in (self._executor, self._audio_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._audio_executor = None
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "pending": self.pending,
+            "processed": self.processed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "process_avg_ms": round(self.process_seconds / self.processed * 1000, 2) if self.processed else 0.0,
+            "process_max_ms": round(self.max_process_seconds * 1000, 2),
+            "queue_wait_avg_ms": round(self.queue_seconds / self.processed * 1000, 2) if self.processed else 0.0,
+            "audio_pending": len(self._audio_tasks),
+            "audio_processed": self.audio_processed,
+            "audio_failed": self.audio_failed,
+            "audio_timeouts": self.audio_timeouts,
+            "audio_skipped": self.audio_skipped,
+            "audio_avg_ms": round(self.audio_seconds / self.audio_processed * 1000, 2) if self.audio_processed else 0.0,
+        }
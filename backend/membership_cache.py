@@ -0,0 +1,151 @@
+"""
+Conversation membership cache
+Keeps participant sets in memory so permission checks skip the conversation round trip
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(NamedTuple):
+    participant_ids: FrozenSet[str]
+    expires_at: float
+    group_id: Optional[str]
+    channel_id: Optional[str]
+
+
+class MembershipCache:
+    """Bounded LRU of conversation_id -> participant ids, loaded with a projection on miss"""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Bumped by every write and invalidation; a load that raced one doesn't cache its result.
+        # Cache-wide because a group/channel invalidation can't name a conversation it never cached.
+        self._generation = 0
+        # Secondary indexes so group/channel changes can find their conversation
+        self._by_group: Dict[str, str] = {}
+        self._by_channel: Dict[str, str] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _store(self, conversation_id: str, participant_ids: Iterable[str],
+               group_id: Optional[str] = None, channel_id: Optional[str] = None):
+        self._entries[conversation_id] = _Entry(
+            frozenset(participant_ids), time.monotonic() + self.ttl_seconds, group_id, channel_id
+        )
+        self._entries.move_to_end(conversation_id)
+        if group_id:
+            self._by_group[group_id] = conversation_id
+        if channel_id:
+            self._by_channel[channel_id] = conversation_id
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._drop_secondary(evicted)
+
+    def _drop_secondary(self, entry: _Entry):
+        if entry.group_id:
+            self._by_group.pop(entry.group_id, None)
+        if entry.channel_id:
+            self._by_channel.pop(entry.channel_id, None)
+
+    async def _load(self, db, conversation_id: str) -> Optional[FrozenSet[str]]:
+        generation = self._generation
+        conversation = await db.conversations.find_one(
+            {"id": conversation_id},
+            {"_id": 0, "participant_ids": 1, "group_id": 1, "channel_id": 1}
+        )
+        if not conversation:
+            return None
+        participant_ids = frozenset(conversation.get("participant_ids", []))
+        if generation == self._generation:
+            self._store(conversation_id, participant_ids, conversation.get("group_id"), conversation.get("channel_id"))
+        return participant_ids
+
+    async def get_participants(self, db, conversation_id: str) -> Optional[FrozenSet[str]]:
+        """Return the participant set, or None if the conversation does not exist"""
+        entry = self._entries.get(conversation_id)
+        if entry and entry.expires_at > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(conversation_id)
+            return entry.participant_ids
+
+        self.misses += 1
+        # Concurrent misses for the same conversation share one query
+        future = self._inflight.get(conversation_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(db, conversation_id))
+            self._inflight[conversation_id] = future
+            future.add_done_callback(lambda done: self._forget_load(conversation_id, done))
+        return await asyncio.shield(future)
+
+    def _forget_load(self, conversation_id: str, future: asyncio.Future):
+        # An invalidation may already have replaced it with a newer load
+        if self._inflight.get(conversation_id) is future:
+            del self._inflight[conversation_id]
+
+    async def is_participant(self, db, conversation_id: str, user_id: str) -> bool:
+        participants = await self.get_participants(db, conversation_id)
+        return participants is not None and user_id in participants
+
+    def put(self, conversation: Dict):
+        """Record a conversation that was just written"""
+        self._generation += 1
+        self._store(
+            conversation["id"],
+            conversation.get("participant_ids", []),
+            conversation.get("group_id"),
+            conversation.get("channel_id")
+        )
+
+    def invalidate(self, conversation_id: str):
+        self._generation += 1
+        # Later misses must not join a query that may have read the old members
+        self._inflight.pop(conversation_id, None)
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.invalidations += 1
+            self._drop_secondary(entry)
+
+    def invalidate_group(self, group_id: str):
+        self._generation += 1
+        conversation_id = self._by_group.get(group_id)
+        if conversation_id:
+            self.invalidate(conversation_id)
+
+    def invalidate_channel(self, channel_id: str):
+        self._generation += 1
+        conversation_id = self._by_channel.get(channel_id)
+        if conversation_id:
+            self.invalidate(conversation_id)
+
+    def invalidate_scope(self, scope: str, key: str):
+        """Invalidate by ("conversation" | "group" | "channel", id), as relayed between workers"""
+        if scope == "group":
+            self.invalidate_group(key)
+        elif scope == "channel":
+            self.invalidate_channel(key)
+        else:
+            self.invalidate(key)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
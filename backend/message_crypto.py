@@ -0,0 +1,311 @@
+"""
+Message body encryption at rest
+WhatGram bodies and their translations are stored only as AES-GCM ciphertext, decrypted a page at a time
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bson import Binary
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from pymongo import UpdateOne
+
+from key_ring import KeyRing
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+NONCE_SIZE = 12
+# Fields that only exist inside the ciphertext of a sealed message
+SEALED_FIELDS = ("content", "translations")
+
+
+class InvalidCiphertext(Exception):
+    pass
+
+
+class MessageCipher:
+    """
+    version (1) | key id length (1) | key id | nonce (12) | AES-GCM ciphertext + tag
+
+    The plaintext is compact JSON of {"content", "translations"}. The header and
+    the message id are authenticated, so a ciphertext can't be moved onto
+    another message. `purpose` selects the derived key, so ciphers for other
+    payloads (e.g. queued delivery events) never share one with stored bodies.
+    """
+
+    def __init__(self, key_ring: KeyRing, purpose: bytes = b"message"):
+        self.key_ring = key_ring
+        self.purpose = purpose
+        self._aeads: Dict[str, AESGCM] = {}
+
+    def _aead(self, key_id: str) -> AESGCM:
+        aead = self._aeads.get(key_id)
+        if aead is None:
+            aead = self._aeads[key_id] = AESGCM(self.key_ring.derive(key_id, self.purpose))
+        return aead
+
+    @staticmethod
+    def key_id_of(data: bytes) -> str:
+        return data[2:2 + data[1]].decode()
+
+    def encrypt_bytes(self, message_id: str, plaintext: bytes) -> bytes:
+        key_id, _ = self.key_ring.current
+        encoded_id = key_id.encode()
+        header = bytes([FORMAT_VERSION, len(encoded_id)]) + encoded_id
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + self._aead(key_id).encrypt(nonce, plaintext, header + message_id.encode())
+
+    def encrypt(self, message_id: str, payload: Dict) -> bytes:
+        return self.encrypt_bytes(
+            message_id, json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        )
+
+    def decrypt_bytes(self, message_id: str, data: bytes) -> bytes:
+        if len(data) < 2 or data[0] != FORMAT_VERSION:
+            raise InvalidCiphertext(f"Unknown message ciphertext version for {message_id}")
+        header_size = 2 + data[1]
+        header = data[:header_size]
+        nonce = data[header_size:header_size + NONCE_SIZE]
+        try:
+            aead = self._aead(header[2:].decode())
+        except KeyError:
+            raise InvalidCiphertext(f"Unknown key id {header[2:]!r} for {message_id}")
+        return aead.decrypt(nonce, data[header_size + NONCE_SIZE:], header + message_id.encode())
+
+    def decrypt(self, message_id: str, data: bytes) -> Dict:
+        return json.loads(self.decrypt_bytes(message_id, data))
+
+    def sealed_fields(self, message_id: str, payload: Dict) -> Dict:
+        """Document fields that replace the plaintext ones"""
+        data = self.encrypt(message_id, payload)
+        return {"ciphertext": Binary(data), "cipher_key": self.key_id_of(data), "is_encrypted": True}
+
+    def seal(self, document: Dict) -> Dict:
+        """Replace the body and translations of a message document with ciphertext, in place"""
+        payload = {field: document.pop(field, None) for field in SEALED_FIELDS}
+        document.pop("encrypted_content", None)
+        document.update(self.sealed_fields(document["id"], payload))
+        return document
+
+    def unseal(self, document: Dict) -> Dict:
+        """The plaintext fields of a sealed message document"""
+        return self.decrypt(document["id"], document["ciphertext"])
+
+
+class PageDecryptor:
+    """
+    Fill in the plaintext fields of the sealed messages on a page
+
+    Entries are keyed by message id and remember the ciphertext they came from,
+    so a message whose ciphertext changes (e.g. re-encrypted under a new key) is
+    decrypted again rather than served stale. Small batches are decrypted
+    inline: a thread hop costs more than a handful of decryptions.
+    """
+
+    def __init__(self, decrypt: Callable[[Dict], Dict], max_entries: int = 5000, inline_limit: int = 4):
+        self.decrypt = decrypt
+        self.max_entries = max_entries
+        self.inline_limit = inline_limit
+        self._entries: "OrderedDict[str, Tuple[bytes, Dict]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.batches = 0
+        self.decrypt_seconds = 0.0
+
+    def _store(self, message_id: str, ciphertext: bytes, fields: Dict):
+        self._entries[message_id] = (ciphertext, fields)
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _decrypt_all(self, pending: List[Dict]) -> Tuple[List[Tuple[str, bytes, Dict]], List[str]]:
+        """Worker side: touches only its arguments, never the cache"""
+        decrypted = []
+        failed = []
+        for message in pending:
+            try:
+                decrypted.append((message["id"], message["ciphertext"], self.decrypt(message)))
+            except Exception:
+                failed.append(message["id"])
+        return decrypted, failed
+
+    async def decrypt_page(self, messages: List[Dict]):
+        """
+        Decrypt raw message documents in place
+
+        Messages that fail to decrypt are returned without a body; failures are
+        logged once per page and counted.
+        """
+        pending = []
+        by_id = {}
+        for message in messages:
+            ciphertext = message.get("ciphertext")
+            if not ciphertext:
+                continue
+            entry = self._entries.get(message["id"])
+            if entry is not None and entry[0] == ciphertext:
+                self.hits += 1
+                self._entries.move_to_end(message["id"])
+                message.update(entry[1])
+                continue
+            self.misses += 1
+            pending.append(message)
+            by_id[message["id"]] = message
+        if not pending:
+            return
+
+        started = time.perf_counter()
+        if len(pending) <= self.inline_limit:
+            decrypted, failed = self._decrypt_all(pending)
+        else:
+            decrypted, failed = await asyncio.to_thread(self._decrypt_all, pending)
+        self.batches += 1
+        self.decrypt_seconds += time.perf_counter() - started
+
+        for message_id, ciphertext, fields in decrypted:
+            by_id[message_id].update(fields)
+            self._store(message_id, ciphertext, fields)
+        if failed:
+            self.failures += len(failed)
+            logger.warning(f"Could not decrypt {len(failed)} of {len(pending)} messages (first: {failed[0]})")
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "failures": self.failures,
+            "batches": self.batches,
+            "batch_avg_ms": round(self.decrypt_seconds / self.batches * 1000, 2) if self.batches else 0.0,
+        }
+
+
+class MessageRewrapper:
+    """
+    Re-encrypt stored WhatGram messages in the background, a batch at a time
+
+    Two kinds of documents are rewritten: ones sealed under a key that is no
+    longer current (after a rotation), and legacy ones that still hold their
+    body in plaintext. Each update is conditional on the state it was computed
+    from, so concurrent workers never overwrite each other's result.
+    """
+
+    def __init__(self, db, cipher: MessageCipher, platform: str, batch_size: int = 200,
+                 interval: float = 300.0, pause: float = 0.1):
+        self.collection = db.messages
+        self.cipher = cipher
+        self.platform = platform
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._task: Optional[asyncio.Task] = None
+        # Legacy plaintext only shrinks, so one clean pass per worker is enough
+        self._legacy_done = False
+
+        self.rewrapped = 0
+        self.migrated = 0
+        self.failures = 0
+        self.sweeps = 0
+
+    def _stale_query(self) -> Dict:
+        old_keys = [key_id for key_id in self.cipher.key_ring.keys if key_id != self.cipher.key_ring.current_id]
+        return {"cipher_key": {"$in": old_keys}}
+
+    def _legacy_query(self) -> Dict:
+        return {"platform": self.platform, "ciphertext": {"$exists": False}, "content": {"$type": "string"}}
+
+    def _rewrite(self, documents: List[Dict]) -> Tuple[List[UpdateOne], int]:
+        """Worker side: the updates for one batch, and how many documents could not be decrypted"""
+        operations = []
+        failed = 0
+        for document in documents:
+            if "ciphertext" in document:
+                try:
+                    payload = self.cipher.unseal(document)
+                except Exception:
+                    failed += 1
+                    continue
+                condition = {"cipher_key": document["cipher_key"]}
+            else:
+                payload = {field: document.get(field) for field in SEALED_FIELDS}
+                condition = {"ciphertext": {"$exists": False}}
+            operations.append(UpdateOne(
+                {"id": document["id"], **condition},
+                {
+                    "$set": self.cipher.sealed_fields(document["id"], payload),
+                    "$unset": {"content": "", "translations": "", "encrypted_content": ""},
+                }
+            ))
+        return operations, failed
+
+    async def _sweep(self, query: Dict) -> Tuple[int, int]:
+        """Walk every match in _id order; returns (rewritten, failed)"""
+        rewritten = 0
+        failed = 0
+        last_id = None
+        projection = {"_id": 1, "id": 1, "ciphertext": 1, "cipher_key": 1, "content": 1, "translations": 1}
+        while True:
+            page_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            documents = await self.collection.find(page_query, projection).sort("_id", 1).to_list(self.batch_size)
+            if not documents:
+                return rewritten, failed
+            last_id = documents[-1]["_id"]
+            operations, batch_failed = await asyncio.to_thread(self._rewrite, documents)
+            failed += batch_failed
+            if operations:
+                result = await self.collection.bulk_write(operations, ordered=False)
+                rewritten += result.modified_count
+            await asyncio.sleep(self.pause)
+
+    async def run_once(self) -> Dict:
+        rewrapped, failed = await self._sweep(self._stale_query())
+        migrated = 0
+        if not self._legacy_done:
+            migrated, legacy_failed = await self._sweep(self._legacy_query())
+            failed += legacy_failed
+            self._legacy_done = True
+        self.rewrapped += rewrapped
+        self.migrated += migrated
+        self.failures += failed
+        self.sweeps += 1
+        if failed:
+            logger.warning(f"Could not re-encrypt {failed} messages")
+        return {"rewrapped": rewrapped, "migrated": migrated, "failed": failed}
+
+    async def _run(self):
+        while True:
+            try:
+                result = await self.run_once()
+                if result["rewrapped"] or result["migrated"]:
+                    logger.info(f"Message re-encryption: {result}")
+            except Exception as e:
+                logger.error(f"Message re-encryption failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "key_id": self.cipher.key_ring.current_id,
+            "rewrapped": self.rewrapped,
+            "migrated": self.migrated,
+            "failures": self.failures,
+            "sweeps": self.sweeps,
+        }
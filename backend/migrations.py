@@ -0,0 +1,159 @@
+"""
+Startup data migrations and index setup
+Each migration is idempotent so every worker can run it on boot
+"""
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+PARTICIPANT_KEY_INDEX = "private_participant_key"
+
+
+def participant_key(participant_ids: Iterable[str]) -> str:
+    """Canonical key for a private conversation: sorted, de-duplicated participant ids"""
+    return "|".join(sorted(set(participant_ids)))
+
+
+async def merge_duplicate_private_conversations(db) -> Dict:
+    """
+    Backfill participant_key on private conversations and merge duplicates
+
+    For every (participant_key, platform) pair the most recently active
+    conversation survives; messages of the others are moved onto it and the
+    duplicates are deleted.
+    """
+    private_filter = {
+        "conversation_type": {"$in": ["private", None]},
+        "group_id": None,
+        "channel_id": None,
+    }
+
+    missing = await db.conversations.count_documents(
+        {**private_filter, "participant_key": {"$exists": False}}, limit=1
+    )
+    if not missing:
+        return {"backfilled": 0, "merged": 0}
+
+    cursor = db.conversations.find(
+        private_filter,
+        {"_id": 0, "id": 1, "participant_ids": 1, "platform": 1,
+         "last_activity": 1, "last_message_id": 1, "participant_key": 1}
+    )
+    buckets: Dict[Tuple[str, str], List[dict]] = {}
+    async for conv in cursor:
+        key = participant_key(conv.get("participant_ids", []))
+        buckets.setdefault((key, conv.get("platform")), []).append(conv)
+
+    backfilled = 0
+    merged = 0
+    for (key, platform), convs in buckets.items():
+        convs.sort(key=lambda c: c.get("last_activity") or datetime.min, reverse=True)
+        survivor, duplicates = convs[0], convs[1:]
+
+        if duplicates:
+            duplicate_ids = [c["id"] for c in duplicates]
+            await db.messages.update_many(
+                {"conversation_id": {"$in": duplicate_ids}},
+                {"$set": {"conversation_id": survivor["id"]}}
+            )
+            await db.conversations.delete_many({"id": {"$in": duplicate_ids}})
+            merged += len(duplicate_ids)
+            logger.info(f"Merged {len(duplicate_ids)} duplicate conversations into {survivor['id']}")
+
+        if survivor.get("participant_key") != key:
+            await db.conversations.update_one(
+                {"id": survivor["id"]},
+                {"$set": {"participant_key": key}}
+            )
+            backfilled += 1
+
+    return {"backfilled": backfilled, "merged": merged}
+
+
+async def ensure_conversation_indexes(db):
+    """Unique lookup index for private conversations; group/channel docs are excluded"""
+    await db.conversations.create_index(
+        [("participant_key", ASCENDING), ("platform", ASCENDING)],
+        name=PARTICIPANT_KEY_INDEX,
+        unique=True,
+        partialFilterExpression={"participant_key": {"$type": "string"}}
+    )
+
+
+async def ensure_delivery_indexes(db):
+    """One offline-queue document per user"""
+    await db.pending_deliveries.create_index("user_id", unique=True)
+
+
+async def ensure_read_indexes(db):
+    """One read cursor per (user, conversation); unread counts are range counts on messages"""
+    await db.read_cursors.create_index(
+        [("user_id", ASCENDING), ("conversation_id", ASCENDING)],
+        unique=True
+    )
+    await db.messages.create_index([("conversation_id", ASCENDING), ("timestamp", ASCENDING)])
+
+
+async def ensure_inbox_stats_indexes(db):
+    await db.inbox_stats.create_index("user_id", unique=True)
+    await db.inbox_stats.create_index("reconciled_at")
+
+
+async def flag_inbox_stats_without_unread(db) -> int:
+    """Stats documents from before unread counts were kept in them are recomputed on their next read"""
+    result = await db.inbox_stats.update_many({"unread": {"$exists": False}}, {"$set": {"stale": True}})
+    return result.modified_count
+
+
+async def ensure_blob_indexes(db):
+    """Blob lookup by hash and by file, the collector's scan, and the reference check on messages"""
+    # Encryption made (hash, encrypted) the identity; the original unique index on hash alone must go
+    existing = await db.blobs.index_information()
+    if "hash_1" in existing:
+        await db.blobs.drop_index("hash_1")
+    await db.blobs.create_index([("hash", ASCENDING), ("encrypted", ASCENDING)], unique=True)
+    await db.blobs.create_index("filename", unique=True)
+    await db.blobs.create_index([("ref_count", ASCENDING), ("last_referenced_at", ASCENDING)])
+    existing = await db.messages.index_information()
+    if "file_message.content_hash_1" in existing:
+        await db.messages.drop_index("file_message.content_hash_1")
+    await db.messages.create_index("file_message.filename", sparse=True)
+
+
+async def ensure_upload_session_indexes(db):
+    """Session lookup by id and the expiry sweep"""
+    await db.upload_sessions.create_index("id", unique=True)
+    await db.upload_sessions.create_index("expires_at")
+
+
+async def ensure_direct_upload_indexes(db):
+    """Reservation lookup by key, the expiry sweep, and the message lookup behind /api/media"""
+    await db.direct_uploads.create_index("key", unique=True)
+    await db.direct_uploads.create_index("expires_at")
+    await db.messages.create_index("file_message.storage_key", sparse=True)
+
+
+async def ensure_message_cipher_indexes(db):
+    """Finds messages sealed under a rotated-out key"""
+    await db.messages.create_index("cipher_key", sparse=True)
+
+
+async def run_migrations(db):
+    result = await merge_duplicate_private_conversations(db)
+    if result["backfilled"] or result["merged"]:
+        logger.info(f"Private conversation migration: {result}")
+    await ensure_conversation_indexes(db)
+    await ensure_delivery_indexes(db)
+    await ensure_read_indexes(db)
+    await ensure_inbox_stats_indexes(db)
+    flagged = await flag_inbox_stats_without_unread(db)
+    if flagged:
+        logger.info(f"Flagged {flagged} inbox stats documents for recount")
+    await ensure_blob_indexes(db)
+    await ensure_upload_session_indexes(db)
+    await ensure_direct_upload_indexes(db)
+    await ensure_message_cipher_indexes(db)
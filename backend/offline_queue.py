@@ -0,0 +1,194 @@
+"""
+Offline delivery queue
+Events for users with no live socket are kept in MongoDB and flushed in batches when they reconnect
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from bson import Binary
+from pymongo import UpdateOne
+
+from message_crypto import MessageCipher
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineQueueMetrics:
+    """Worker-wide counters for queued and flushed events"""
+
+    def __init__(self):
+        self.queued = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.flush_total = 0.0
+        self.flush_max = 0.0
+
+    def snapshot(self) -> Dict:
+        return {
+            "queued": self.queued,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "flush_avg_ms": round(self.flush_total / self.flushes * 1000, 3) if self.flushes else 0.0,
+            "flush_max_ms": round(self.flush_max * 1000, 3),
+        }
+
+
+class OfflineQueue:
+    """
+    One pending_deliveries document per user holding a capped list of events
+
+    Appends use $push with $slice, so the newest max_per_user events survive
+    without a separate trim step. With a cipher, events carry message bodies
+    and are stored sealed ({id, message_id, sealed_event, queued_at}) rather
+    than as plaintext ({id, message_id, event, queued_at}). A message can be
+    queued more than once (e.g. new_message, then an edit), so a flush removes
+    what it delivered by entry id.
+    """
+
+    def __init__(self, db, max_per_user: int = 1000, batch_size: int = 100,
+                 cipher: Optional[MessageCipher] = None):
+        self.db = db
+        self.collection = db.pending_deliveries
+        self.max_per_user = max_per_user
+        self.batch_size = batch_size
+        self.cipher = cipher
+        self.metrics = OfflineQueueMetrics()
+        self._flushing: Set[str] = set()
+
+    def _seal(self, message_id: str, event: Dict) -> Dict:
+        if self.cipher is None:
+            return {"event": event}
+        return {"sealed_event": Binary(self.cipher.encrypt(message_id, event))}
+
+    def _open(self, entry: Dict) -> Optional[Dict]:
+        """The event of a queued entry, or None if it can't be decrypted"""
+        if "sealed_event" not in entry:
+            return entry.get("event")
+        try:
+            return self.cipher.decrypt(entry["message_id"], entry["sealed_event"])
+        except Exception as e:
+            logger.warning(f"Dropping queued event for message {entry['message_id']}: {e!r}")
+            return None
+
+    async def enqueue_many(self, user_ids: Iterable[str], message_id: str, event: Dict):
+        """Queue the same event for several offline users in one bulk write"""
+        now = datetime.utcnow()
+        entry = {"id": uuid.uuid4().hex, "message_id": message_id, **self._seal(message_id, event), "queued_at": now}
+        operations = [
+            UpdateOne(
+                {"user_id": user_id},
+                {
+                    "$push": {"events": {"$each": [entry], "$slice": -self.max_per_user}},
+                    "$set": {"updated_at": now}
+                },
+                upsert=True
+            )
+            for user_id in user_ids
+        ]
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+            self.metrics.queued += len(operations)
+
+    async def enqueue(self, user_id: str, message_id: str, event: Dict):
+        await self.enqueue_many([user_id], message_id, event)
+
+    async def _remove(self, user_id: str, entries: List[Dict]):
+        ids = [entry["id"] for entry in entries if "id" in entry]
+        if ids:
+            await self.collection.update_one({"user_id": user_id}, {"$pull": {"events": {"id": {"$in": ids}}}})
+        # Entries from before ids existed; none can have been queued since the flush read them
+        legacy = [entry["message_id"] for entry in entries if "id" not in entry]
+        if legacy:
+            await self.collection.update_one(
+                {"user_id": user_id},
+                {"$pull": {"events": {"id": {"$exists": False}, "message_id": {"$in": legacy}}}}
+            )
+
+    async def flush(self, connection) -> int:
+        """Deliver a user's queued events to a freshly connected socket, a batch at a time"""
+        user_id = connection.user_id
+        if user_id in self._flushing:
+            return 0  # Another socket of this user is already draining the queue
+        self._flushing.add(user_id)
+        started = time.perf_counter()
+        flushed = 0
+        try:
+            pending = await self.collection.find_one({"user_id": user_id}, {"_id": 0, "events": 1})
+            events: List[Dict] = (pending or {}).get("events", [])
+            for start in range(0, len(events), self.batch_size):
+                batch = events[start:start + self.batch_size]
+                # Leave room in the socket's send queue rather than tripping backpressure
+                while connection.queue_depth > connection.max_queue - len(batch):
+                    if connection.closed:
+                        return flushed
+                    await asyncio.sleep(0.05)
+
+                sent = []
+                unreadable = []
+                for entry in batch:
+                    event = self._open(entry)
+                    if event is None:
+                        unreadable.append(entry)
+                        continue
+                    if not connection.enqueue(event):
+                        break
+                    sent.append(entry)
+                if sent:
+                    await self.db.messages.update_many(
+                        {"id": {"$in": [entry["message_id"] for entry in sent]}},
+                        {"$set": {"is_delivered": True}}
+                    )
+                    flushed += len(sent)
+                if sent or unreadable:
+                    await self._remove(user_id, sent + unreadable)
+                if len(sent) + len(unreadable) < len(batch):
+                    return flushed
+            # Drop the document once empty; an append that raced the flush keeps it alive
+            await self.collection.delete_one({"user_id": user_id, "events": {"$size": 0}})
+            return flushed
+        finally:
+            self._flushing.discard(user_id)
+            if flushed:
+                elapsed = time.perf_counter() - started
+                self.metrics.flushes += 1
+                self.metrics.flushed += flushed
+                self.metrics.flush_total += elapsed
+                self.metrics.flush_max = max(self.metrics.flush_max, elapsed)
+
+    async def seal_legacy(self) -> int:
+        """Seal entries queued in plaintext before the queue had a cipher; returns the users rewritten"""
+        if self.cipher is None:
+            return 0
+        rewritten = 0
+        cursor = self.collection.find({"events.event": {"$exists": True}}, {"_id": 0, "user_id": 1, "events": 1})
+        async for pending in cursor:
+            events = [
+                {
+                    **{key: value for key, value in entry.items() if key != "event"},
+                    **self._seal(entry["message_id"], entry["event"])
+                } if "event" in entry else entry
+                for entry in pending["events"]
+            ]
+            # Skipped if an append or flush got there first; the next start picks it up
+            result = await self.collection.update_one(
+                {"user_id": pending["user_id"], "events": pending["events"]},
+                {"$set": {"events": events}}
+            )
+            rewritten += result.modified_count
+        return rewritten
+
+    async def depth(self) -> Dict:
+        """Total queued events across users (one aggregation; meant for the metrics endpoint)"""
+        result = await self.collection.aggregate([
+            {"$group": {"_id": None, "users": {"$sum": 1}, "events": {"$sum": {"$size": "$events"}}}}
+        ]).to_list(1)
+        if not result:
+            return {"users": 0, "events": 0}
+        return {"users": result[0]["users"], "events": result[0]["events"]}
+
+    async def stats(self) -> Dict:
+        return {**self.metrics.snapshot(), "depth": await self.depth()}
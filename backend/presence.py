@@ -0,0 +1,207 @@
+"""
+Presence tracking
+Online state follows live sockets; last_seen is written through in coalesced batches
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceService:
+    """
+    Per-worker presence: this worker's sockets plus what the delivery bus reports for others
+
+    Subscribed sockets get a `presence` event when a watched user goes online
+    or offline, at most once per throttle window per user; flapping inside the
+    window collapses into the final state.
+    """
+
+    def __init__(self, db, manager, flush_interval: float = 2.0, throttle_seconds: float = 5.0,
+                 refresh_interval: float = 60.0, max_watch: int = 1000):
+        self.db = db
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.throttle_seconds = throttle_seconds
+        self.refresh_interval = refresh_interval
+        self.max_watch = max_watch
+
+        # last_seen writes waiting for the next batch
+        self._dirty: Dict[str, datetime] = {}
+        # watched user -> subscribed connections, and the reverse for cleanup
+        self._watchers: Dict[str, Set] = {}
+        self._watching: Dict[str, Set[str]] = {}
+        # users whose state changed since their last event, and what was last sent
+        self._changed: Set[str] = set()
+        self._emitted: Dict[str, tuple] = {}
+
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.write_batches = 0
+        self.events_sent = 0
+        self.events_suppressed = 0
+
+    # Socket lifecycle, called by ConnectionManager
+    def user_online(self, user_id: str):
+        self._dirty[user_id] = datetime.utcnow()
+        self.users_changed([user_id])
+
+    def user_offline(self, user_id: str):
+        self._dirty[user_id] = datetime.utcnow()
+        self.users_changed([user_id])
+
+    def users_changed(self, user_ids: Iterable[str]):
+        """Local or remote (delivery bus) online state changed for these users"""
+        for user_id in user_ids:
+            if user_id in self._watchers:
+                self._changed.add(user_id)
+
+    def connection_closed(self, connection):
+        for user_id in self._watching.pop(connection.id, ()):
+            watchers = self._watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(connection)
+                if not watchers:
+                    del self._watchers[user_id]
+                    self._emitted.pop(user_id, None)
+
+    # Subscriptions from WebSocket clients
+    async def subscribe(self, connection, user_ids: List[str]) -> Dict:
+        watching = self._watching.setdefault(connection.id, set())
+        for user_id in user_ids:
+            if len(watching) >= self.max_watch:
+                break
+            watching.add(user_id)
+            self._watchers.setdefault(user_id, set()).add(connection)
+        return await self.lookup(user_ids)
+
+    def unsubscribe(self, connection, user_ids: List[str]):
+        watching = self._watching.get(connection.id, set())
+        for user_id in user_ids:
+            watching.discard(user_id)
+            watchers = self._watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(connection)
+                if not watchers:
+                    del self._watchers[user_id]
+                    self._emitted.pop(user_id, None)
+
+    async def lookup(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """Presence for many users: memory for online and just-changed users, one projected query for the rest"""
+        now = datetime.utcnow()
+        result = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            if self.manager.is_online(user_id):
+                result[user_id] = {"is_online": True, "last_seen": now}
+            elif user_id in self._dirty:
+                result[user_id] = {"is_online": False, "last_seen": self._dirty[user_id]}
+            else:
+                missing.append(user_id)
+        if missing:
+            cursor = self.db.users.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "last_seen": 1})
+            async for user in cursor:
+                result[user["id"]] = {"is_online": False, "last_seen": user.get("last_seen")}
+        return result
+
+    # Background work
+    async def flush(self):
+        """Write pending last_seen values in one bulk write; never moves last_seen backwards"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        operations = [
+            UpdateOne(
+                {"id": user_id, "$or": [{"last_seen": None}, {"last_seen": {"$lt": seen}}]},
+                {"$set": {"last_seen": seen}}
+            )
+            for user_id, seen in dirty.items()
+        ]
+        try:
+            await self.db.users.bulk_write(operations, ordered=False)
+            self.writes += len(operations)
+            self.write_batches += 1
+        except Exception as e:
+            logger.error(f"Presence flush of {len(operations)} users failed: {e}")
+            for user_id, seen in dirty.items():
+                self._dirty.setdefault(user_id, seen)
+
+    def _refresh_online(self):
+        """Heartbeat for users still connected here, so a crashed worker leaves a recent last_seen"""
+        now = datetime.utcnow()
+        for user_id in self.manager.user_connections:
+            self._dirty[user_id] = now
+
+    async def _emit_changes(self):
+        now = time.monotonic()
+        ready = [
+            user_id for user_id in self._changed
+            if now - self._emitted.get(user_id, (0.0, None))[0] >= self.throttle_seconds
+        ]
+        if not ready:
+            return
+        self._changed.difference_update(ready)
+        states = await self.lookup(ready)
+        for user_id in ready:
+            state = states.get(user_id)
+            watchers = self._watchers.get(user_id)
+            if state is None or not watchers:
+                continue
+            if self._emitted.get(user_id, (0.0, None))[1] == state["is_online"]:
+                # Went offline and back (or the reverse) within the window
+                self.events_suppressed += 1
+                continue
+            self._emitted[user_id] = (now, state["is_online"])
+            event = {
+                "type": "presence",
+                "user_id": user_id,
+                "is_online": state["is_online"],
+                "last_seen": state["last_seen"],
+            }
+            for connection in list(watchers):
+                connection.enqueue(event, coalesce_key=f"presence:{user_id}")
+            self.events_sent += 1
+
+    async def _run(self):
+        last_flush = last_refresh = time.monotonic()
+        tick = min(1.0, self.flush_interval, self.throttle_seconds)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                await self._emit_changes()
+                now = time.monotonic()
+                if now - last_refresh >= self.refresh_interval:
+                    self._refresh_online()
+                    last_refresh = now
+                if now - last_flush >= self.flush_interval:
+                    await self.flush()
+                    last_flush = now
+            except Exception as e:
+                logger.error(f"Presence loop error: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._refresh_online()
+        await self.flush()
+
+    def stats(self) -> Dict:
+        return {
+            "online_here": len(self.manager.user_connections),
+            "watched_users": len(self._watchers),
+            "pending_writes": len(self._dirty),
+            "writes": self.writes,
+            "write_batches": self.write_batches,
+            "events_sent": self.events_sent,
+            "events_suppressed": self.events_suppressed,
+        }
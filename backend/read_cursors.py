@@ -0,0 +1,96 @@
+"""
+Per-user, per-conversation read cursors
+Unread counts are range counts on the (conversation_id, timestamp) message index past each cursor
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+
+class ReadCursorStore:
+    """read_cursors documents: {user_id, conversation_id, last_read_at, last_read_message_id}"""
+
+    def __init__(self, db, count_cap: int = 999, max_concurrent_counts: int = 32):
+        self.db = db
+        self.collection = db.read_cursors
+        # Badges show "999+" anyway; stop counting there so a huge backlog stays cheap
+        self.count_cap = count_cap
+        self._count_slots = asyncio.Semaphore(max_concurrent_counts)
+
+    async def advance(self, receipts: List[Dict]):
+        """Move cursors forward to each receipt's timestamp; one bulk write, never backwards"""
+        if not receipts:
+            return
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"user_id": receipt["user_id"], "conversation_id": receipt["conversation_id"]},
+                {
+                    "$max": {"last_read_at": receipt["timestamp"]},
+                    "$set": {"updated_at": now}
+                },
+                upsert=True
+            )
+            for receipt in receipts
+        ]
+        await self.collection.bulk_write(operations, ordered=False)
+        # The message id only follows when it is the one the cursor now points at
+        message_updates = [
+            UpdateOne(
+                {
+                    "user_id": receipt["user_id"],
+                    "conversation_id": receipt["conversation_id"],
+                    "last_read_at": receipt["timestamp"]
+                },
+                {"$set": {"last_read_message_id": receipt["message_id"]}}
+            )
+            for receipt in receipts if receipt.get("message_id")
+        ]
+        if message_updates:
+            await self.collection.bulk_write(message_updates, ordered=False)
+
+    async def cursors(self, user_id: str, conversation_ids: Iterable[str]) -> Dict[str, datetime]:
+        cursor = self.collection.find(
+            {"user_id": user_id, "conversation_id": {"$in": list(conversation_ids)}},
+            {"_id": 0, "conversation_id": 1, "last_read_at": 1}
+        )
+        return {doc["conversation_id"]: doc["last_read_at"] async for doc in cursor}
+
+    async def _count(self, user_id: str, conversation_id: str, since: Optional[datetime]) -> int:
+        query = {"conversation_id": conversation_id, "sender_id": {"$ne": user_id}}
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        else:
+            # No cursor yet (history from before cursors existed): fall back to the read flags
+            query["is_read"] = False
+        async with self._count_slots:
+            return await self.db.messages.count_documents(query, limit=self.count_cap)
+
+    async def unread_counts(self, user_id: str, conversations: List[Dict]) -> Dict[str, int]:
+        """
+        Unread messages per conversation for a user
+
+        `conversations` need id and last_message_at (the timestamp of their
+        newest message); a conversation with nothing newer than the cursor is
+        zero without touching the messages.
+        """
+        cursors = await self.cursors(user_id, [conv["id"] for conv in conversations])
+        counts = {}
+        to_count = []
+        for conv in conversations:
+            since = cursors.get(conv["id"])
+            last_message_at = conv.get("last_message_at")
+            if since is not None and last_message_at is not None and last_message_at <= since:
+                counts[conv["id"]] = 0
+            else:
+                to_count.append((conv["id"], since))
+        results = await asyncio.gather(*(
+            self._count(user_id, conversation_id, since) for conversation_id, since in to_count
+        ))
+        counts.update({conversation_id: count for (conversation_id, _), count in zip(to_count, results)})
+        return counts
@@ -1,27 +1,27 @@
-from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Form, Depends, status
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Form, Depends, Request, status
+from fastapi.responses import RedirectResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set
 import uuid
+import re
+import hmac
 from datetime import datetime, timedelta
 from enum import Enum
-import shutil
 import mimetypes
 import jwt
 import bcrypt
-from cryptography.fernet import Fernet
 import asyncio
 from fastapi import WebSocket, WebSocketDisconnect
-import json
 from bson import ObjectId
 import random
 import aiohttp
@@ -30,6 +30,27 @@ import langdetect
 # Import new LLM service and mock integrations
 from llm_service import translation_service, stt_service
 from mock_integrations import whatsapp_mock, telegram_mock
+from data_loader import DataLoader
+from membership_cache import MembershipCache
+from migrations import participant_key, run_migrations
+from connection_manager import ConnectionManager, BackpressurePolicy
+from delivery_bus import create_delivery_bus
+from ws_protocol import negotiate_codec, message_event, EventTemplate
+from fanout import FanoutEngine
+from offline_queue import OfflineQueue
+from presence import PresenceService
+from conversation_signals import TypingThrottle, ReadReceiptBuffer
+from read_cursors import ReadCursorStore
+from inbox_stats import InboxStats
+from upload_writer import UploadWriter, UploadSizeLimit, UploadTooLarge
+from blob_store import Blob, BlobStore
+from upload_sessions import UploadSessionStore, OffsetMismatch, SessionBusy
+from media_variants import MediaProcessor
+from file_responses import FileServer
+from file_crypto import FileCipher
+from key_ring import KeyRing
+from storage import DirectUploads, LocalStorage, S3Storage
+from message_crypto import MessageCipher, MessageRewrapper, PageDecryptor
 
 # Language settings
 SUPPORTED_LANGUAGES = {
@@ -97,60 +118,138 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'whatgram-secret-key-2024')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours for mobile apps
 
-# Encryption key for E2E
-ENCRYPTION_KEY = Fernet.generate_key()
-cipher_suite = Fernet(ENCRYPTION_KEY)
-
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Conversation membership cache (per worker)
+membership_cache = MembershipCache(
+    max_entries=int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.environ.get('MEMBERSHIP_CACHE_TTL', '300'))
+)
+
 # Create the main app
 app = FastAPI(title="WhatGram API", description="Unified Messaging Platform")
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Serve static files
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
+# Streaming upload writer (thread pool disk I/O, size limit enforced while streaming)
+upload_writer = UploadWriter(
+    max_bytes=int(os.environ.get('MAX_UPLOAD_BYTES', str(100 * 1024 * 1024))),
+    chunk_size=int(os.environ.get('UPLOAD_CHUNK_BYTES', str(1024 * 1024)))
+)
+
+# WhatGram attachments and message bodies are encrypted at rest with keys from a persisted ring
+key_ring = KeyRing.load_or_create(Path(os.environ.get('FILE_KEYS_PATH', str(ROOT_DIR / 'file_keys.json'))))
+file_cipher = FileCipher(key_ring)
+message_cipher = MessageCipher(key_ring)
+# Delivery events persisted on their way to a socket (offline queue, Mongo broker) are sealed too
+delivery_cipher = MessageCipher(key_ring, purpose=b"delivery")
+
+# Content-addressed, reference-counted file storage; identical uploads share one blob
+blob_store = BlobStore(
+    db, UPLOAD_DIR, upload_writer, file_cipher,
+    gc_interval=float(os.environ.get('BLOB_GC_INTERVAL', '3600')),
+    gc_grace_seconds=float(os.environ.get('BLOB_GC_GRACE', '86400'))
+)
+
+# Resumable chunked uploads; partial files live outside the served uploads directory
+upload_sessions = UploadSessionStore(
+    db, ROOT_DIR / "upload_sessions", upload_writer, blob_store, file_cipher,
+    ttl_seconds=float(os.environ.get('UPLOAD_SESSION_TTL', '86400'))
+)
+
+# Image thumbnails and downscaled WebP variants, rendered on a process pool after upload;
+# audio metadata runs on a pool of its own
+media_processor = MediaProcessor(
+    db, UPLOAD_DIR, file_cipher,
+    max_workers=int(os.environ.get('MEDIA_WORKERS', '2')),
+    max_pending=int(os.environ.get('MEDIA_MAX_PENDING', '200')),
+    audio_workers=int(os.environ.get('MEDIA_AUDIO_WORKERS', '1'))
+)
+
+# Downloads: ranges, ETags and cache headers, optionally handed to a front proxy
+file_server = FileServer(
+    UPLOAD_DIR, file_cipher,
+    sendfile_mode=os.environ.get('FILE_SENDFILE_MODE', ''),
+    accel_prefix=os.environ.get('FILE_ACCEL_PREFIX', '/protected-uploads/')
+)
+
+# Direct media uploads: clients PUT to presigned URLs (S3-compatible or signed local URLs)
+if os.environ.get('STORAGE_BACKEND', 'local') == 's3':
+    media_storage = S3Storage(
+        os.environ['S3_BUCKET'],
+        prefix=os.environ.get('S3_PREFIX', 'media/'),
+        endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+        region=os.environ.get('S3_REGION') or None,
+        server_side_encryption=os.environ.get('S3_SSE') or None
+    )
+else:
+    media_storage = LocalStorage(
+        ROOT_DIR / "media",
+        file_cipher.key_ring.derive(file_cipher.key_ring.current_id, b"storage-url")
+    )
+direct_uploads = DirectUploads(
+    db, media_storage, upload_writer.max_bytes,
+    url_ttl=int(os.environ.get('PRESIGNED_URL_TTL', '3600'))
+)
+local_media_server = FileServer(media_storage.root) if isinstance(media_storage, LocalStorage) else None
 
 # Security
 security = HTTPBearer(auto_error=False)
 
-# WebSocket Manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: dict = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        self.user_connections[user_id] = websocket
-    
-    def disconnect(self, websocket: WebSocket, user_id: str):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if user_id in self.user_connections:
-            del self.user_connections[user_id]
-    
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.user_connections:
-            websocket = self.user_connections[user_id]
-            try:
-                await websocket.send_text(message)
-            except:
-                pass
-    
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
+# WebSocket Manager (several sockets per user, bounded per-socket send queues)
+manager = ConnectionManager(
+    max_queue=int(os.environ.get('WS_SEND_QUEUE_SIZE', '256')),
+    policy=BackpressurePolicy(os.environ.get('WS_BACKPRESSURE_POLICY', 'drop')),
+    heartbeat_interval=float(os.environ.get('WS_HEARTBEAT_INTERVAL', '25')),
+    idle_timeout=float(os.environ.get('WS_IDLE_TIMEOUT', '75'))
+)
 
-manager = ConnectionManager()
+# Delivery bus: "inprocess" for a single worker, "mongo" to fan out across workers/nodes
+delivery_bus = create_delivery_bus(os.environ.get('DELIVERY_BUS', 'inprocess'), db, delivery_cipher)
+manager.attach_bus(delivery_bus)
+delivery_bus.set_invalidation_handler(membership_cache.invalidate_scope)
+
+
+def invalidate_membership(scope: str, key: str):
+    """Drop cached membership on this worker and every other one"""
+    membership_cache.invalidate_scope(scope, key)
+    delivery_bus.invalidate(scope, key)
+
+# Events for users with no live socket, flushed when they reconnect
+offline_queue = OfflineQueue(
+    db,
+    max_per_user=int(os.environ.get('OFFLINE_QUEUE_SIZE', '1000')),
+    batch_size=int(os.environ.get('OFFLINE_FLUSH_BATCH', '100')),
+    cipher=delivery_cipher
+)
+
+# Message fan-out: one translation per language, concurrent sends in chunks
+fanout = FanoutEngine(
+    db, manager, translate_text,
+    chunk_size=int(os.environ.get('FANOUT_CHUNK_SIZE', '500')),
+    offline_queue=offline_queue
+)
+
+# Presence: online state from live sockets, last_seen written through in batches
+presence = PresenceService(
+    db, manager,
+    flush_interval=float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '2')),
+    throttle_seconds=float(os.environ.get('PRESENCE_THROTTLE', '5'))
+)
+manager.attach_presence(presence)
+
+# Typing indicators and read receipts (coalesced per user and conversation)
+typing_throttle = TypingThrottle(interval=float(os.environ.get('TYPING_THROTTLE', '3')))
+
+# Read cursors; unread counts stop at UNREAD_COUNT_CAP per conversation
+read_cursors = ReadCursorStore(db, count_cap=int(os.environ.get('UNREAD_COUNT_CAP', '999')))
+
+# Per-user inbox counters, reconciled in the background every INBOX_STATS_RECONCILE_INTERVAL seconds
+inbox_stats = InboxStats(db, read_cursors, reconcile_interval=float(os.environ.get('INBOX_STATS_RECONCILE_INTERVAL', '3600')))
 
 
 class Platform(str, Enum):
@@ -185,6 +284,9 @@ class User(BaseModel):
     preferred_language: str = "tr"  # tr, en, de, fr, es, etc.
     auto_translate: bool = True
     interface_language: str = "tr"
+    
+    # Presence (written by the presence service)
+    last_seen: Optional[datetime] = None
 
 
 class PhoneVerification(BaseModel):
@@ -240,6 +342,11 @@ class FileMessage(BaseModel):
     encrypted: bool = False
     uploaded_at: datetime = Field(default_factory=datetime.utcnow)
     thumbnail_path: Optional[str] = None  # For images/videos
+    variants: Optional[Dict[str, str]] = None  # Size name -> path, filled in after upload
+    content_hash: Optional[str] = None  # SHA-256 of the stored bytes
+    storage_key: Optional[str] = None  # Object key when uploaded directly to the storage backend
+    duration_ms: Optional[int] = None  # Audio only
+    waveform: Optional[str] = None  # Audio only: base64 of 64 peak bytes (0-255)
 
 
 class Translation(BaseModel):
@@ -264,7 +371,8 @@ class Message(BaseModel):
     is_sent: bool = True
     is_delivered: bool = False
     is_read: bool = False
-    encrypted_content: Optional[str] = None  # E2E encrypted content
+    encrypted_content: Optional[str] = None  # Legacy; bodies are now stored sealed in `ciphertext`
+    is_encrypted: bool = False  # Content and translations are encrypted at rest
     message_type: str = "text"  # text, image, video, file, audio
     
     # Translation support
@@ -317,6 +425,8 @@ class Conversation(BaseModel):
     last_activity: datetime = Field(default_factory=datetime.utcnow)
     created_by: str
     is_encrypted: bool = True
+    # Sorted participant ids, set only for private conversations (unique per platform)
+    participant_key: Optional[str] = None
     # For group/channel conversations
     group_id: Optional[str] = None
     channel_id: Optional[str] = None
@@ -337,6 +447,36 @@ class MessageCreate(BaseModel):
     message_type: str = "text"
 
 
+class PresenceQuery(BaseModel):
+    user_ids: List[str] = Field(..., max_length=500)
+
+
+class MarkReadItem(BaseModel):
+    conversation_id: str
+    message_id: Optional[str] = None  # Defaults to the conversation's last message
+
+
+class MarkReadRequest(BaseModel):
+    conversations: List[MarkReadItem] = Field(..., max_length=500)
+
+
+class UploadSessionCreate(BaseModel):
+    conversation_id: str
+    receiver_id: str
+    platform: Platform
+    filename: str
+    size: int = Field(ge=0)
+
+
+class DirectUploadCreate(BaseModel):
+    conversation_id: str
+    receiver_id: str
+    platform: Platform
+    filename: str
+    size: int = Field(ge=0)
+    content_type: Optional[str] = None
+
+
 class GroupCreate(BaseModel):
     name: str
     description: Optional[str] = None
@@ -406,26 +546,37 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_data_loader(request: Request) -> DataLoader:
+    """Create the request-scoped loader; FastAPI caches it for the rest of the request"""
+    loader = DataLoader(db)
+    request.state.data_loader = loader
+    return loader
+
+
+def decode_access_token(token: str) -> Optional[str]:
+    """Return the user id from a valid access token, or None"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    return payload.get("sub")
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    loader: DataLoader = Depends(get_data_loader)
+):
     if not credentials:
         return None
     
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            return None
-    except jwt.PyJWTError:
+    user_id = decode_access_token(credentials.credentials)
+    if user_id is None:
         return None
     
-    user = await db.users.find_one({"id": user_id})
+    user = await loader.load("users", user_id)
     if user is None:
         return None
     
-    # Convert ObjectId to string if present
-    if "_id" in user:
-        user.pop("_id")
-    
     return User(**user)
 
 
@@ -435,14 +586,37 @@ async def get_current_user_required(current_user: User = Depends(get_current_use
     return current_user
 
 
-def encrypt_message(content: str) -> str:
-    """Encrypt message content for E2E encryption"""
-    return cipher_suite.encrypt(content.encode()).decode()
+def message_document(message: Message) -> Dict:
+    """
+    Stored form of a message; WhatGram bodies and translations are kept only as ciphertext
+    
+    Marks the message itself as encrypted, so the copy sent to clients says so too.
+    """
+    if message.platform == Platform.WHATGRAM and message.content:
+        message.is_encrypted = True
+        return message_cipher.seal(message.dict())
+    return message.dict()
+
+
+# History pages decrypt in a worker thread; recent plaintext stays cached (per worker)
+page_decryptor = PageDecryptor(
+    message_cipher.unseal,
+    max_entries=int(os.environ.get('DECRYPTED_CACHE_SIZE', '5000'))
+)
 
+# Re-encrypts messages under the current key after a rotation, and seals legacy plaintext ones
+message_rewrapper = MessageRewrapper(
+    db, message_cipher, Platform.WHATGRAM.value,
+    batch_size=int(os.environ.get('MESSAGE_REWRAP_BATCH', '200')),
+    interval=float(os.environ.get('MESSAGE_REWRAP_INTERVAL', '300'))
+)
 
-def decrypt_message(encrypted_content: str) -> str:
-    """Decrypt message content"""
-    return cipher_suite.decrypt(encrypted_content.encode()).decode()
+
+async def decrypt_messages(messages: List[Dict]):
+    """Decrypt the WhatGram messages of a page of raw documents in place"""
+    await page_decryptor.decrypt_page(
+        [msg for msg in messages if msg.get("platform") == Platform.WHATGRAM.value]
+    )
 
 
 # Routes
@@ -584,6 +758,15 @@ async def get_contacts(
     # Remove MongoDB ObjectId
     for contact in contacts:
         contact.pop("_id", None)
+    
+    # Live presence for contacts that are WhatGram users
+    states = await presence.lookup([c.get("platform_user_id") or c["id"] for c in contacts])
+    for contact in contacts:
+        state = states.get(contact.get("platform_user_id") or contact["id"])
+        if state:
+            contact["is_online"] = state["is_online"]
+            if state["last_seen"]:
+                contact["last_seen"] = state["last_seen"]
     return [Contact(**contact) for contact in contacts]
 
 
@@ -599,6 +782,41 @@ async def create_contact(
     return contact_obj
 
 
+# Presence Routes
+async def presence_visible(user: User, user_ids: List[str]) -> List[str]:
+    """The requested users whose presence `user` may see: contacts and people they share a chat with"""
+    requested = list(dict.fromkeys(user_ids))
+    if not requested:
+        return []
+    allowed = {user.id}
+    async for contact in db.contacts.find(
+        {"user_id": user.id, "$or": [{"platform_user_id": {"$in": requested}}, {"id": {"$in": requested}}]},
+        {"_id": 0, "id": 1, "platform_user_id": 1}
+    ):
+        allowed.add(contact.get("platform_user_id") or contact["id"])
+    async for conversation in db.conversations.find(
+        {"participant_ids": {"$all": [user.id], "$in": requested}},
+        {"_id": 0, "participant_ids": 1}
+    ):
+        allowed.update(conversation["participant_ids"])
+    return [user_id for user_id in requested if user_id in allowed]
+
+
+@api_router.post("/presence")
+async def get_presence(
+    query: PresenceQuery,
+    current_user: User = Depends(get_current_user_required)
+):
+    """Online state and last_seen for up to 500 users in one call (contacts and chat partners only)"""
+    states = await presence.lookup(await presence_visible(current_user, query.user_ids))
+    return {
+        "presence": [
+            {"user_id": user_id, **states[user_id]}
+            for user_id in query.user_ids if user_id in states
+        ]
+    }
+
+
 # Conversation Routes
 @api_router.get("/conversations", response_model=List[Conversation])
 async def get_conversations(
@@ -622,24 +840,91 @@ async def create_conversation(
     platform: Platform,
     current_user: User = Depends(get_current_user_required)
 ):
-    # Check if conversation already exists
-    existing_conv = await db.conversations.find_one({
-        "participant_ids": {"$all": [current_user.id, participant_id]},
-        "platform": platform.value
-    })
-    
-    if existing_conv:
-        existing_conv.pop("_id", None)
-        return Conversation(**existing_conv)
+    key = participant_key([current_user.id, participant_id])
+    lookup = {"participant_key": key, "platform": platform.value}
     
     conversation = Conversation(
         participant_ids=[current_user.id, participant_id],
         platform=platform,
-        created_by=current_user.id
+        created_by=current_user.id,
+        participant_key=key
     )
+    new_fields = conversation.dict()
+    for field in lookup:
+        new_fields.pop(field)
     
-    await db.conversations.insert_one(conversation.dict())
-    return conversation
+    # Atomic lookup-or-create; the unique index turns racing inserts into DuplicateKeyError
+    try:
+        conv = await db.conversations.find_one_and_update(
+            lookup,
+            {"$setOnInsert": new_fields},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        conv = await db.conversations.find_one(lookup, {"_id": 0})
+    
+    membership_cache.put(conv)
+    if conv["id"] == conversation.id:
+        await inbox_stats.conversation_added(conv["participant_ids"], "private")
+    return Conversation(**conv)
+
+
+@api_router.post("/conversations/read")
+async def mark_conversations_read(
+    request: MarkReadRequest,
+    current_user: User = Depends(get_current_user_required)
+):
+    """Bulk mark-read: moves read cursors and flags messages for up to 500 conversations"""
+    items = [
+        item for item in request.conversations
+        if await membership_cache.is_participant(db, item.conversation_id, current_user.id)
+    ]
+    
+    # Conversations without an explicit message are read up to their last message
+    latest = {}
+    implicit = [item.conversation_id for item in items if not item.message_id]
+    if implicit:
+        async for conv in db.conversations.find(
+            {"id": {"$in": implicit}}, {"_id": 0, "id": 1, "last_message_id": 1}
+        ):
+            latest[conv["id"]] = conv.get("last_message_id")
+    targets = {item.conversation_id: item.message_id or latest.get(item.conversation_id) for item in items}
+    
+    messages = {}
+    message_ids = [message_id for message_id in targets.values() if message_id]
+    if message_ids:
+        async for message in db.messages.find(
+            {"id": {"$in": message_ids}}, {"_id": 0, "id": 1, "conversation_id": 1, "timestamp": 1}
+        ):
+            messages[message["id"]] = message
+    
+    receipts = [
+        {
+            "user_id": current_user.id,
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "timestamp": messages[message_id]["timestamp"]
+        }
+        for conversation_id, message_id in targets.items()
+        if message_id in messages and messages[message_id]["conversation_id"] == conversation_id
+    ]
+    await read_receipts.apply(receipts)
+    return {"marked": [receipt["conversation_id"] for receipt in receipts]}
+
+
+@api_router.get("/unread-counts")
+async def get_unread_counts(
+    current_user: User = Depends(get_current_user_required)
+):
+    """Unread messages per conversation (capped at UNREAD_COUNT_CAP each) and in total"""
+    conversations = await db.conversations.find(
+        {"participant_ids": current_user.id},
+        {"_id": 0, "id": 1, "last_message_at": 1}
+    ).to_list(1000)
+    counts = await read_cursors.unread_counts(current_user.id, conversations)
+    return {"conversations": counts, "total": sum(counts.values())}
 
 
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[Message])
@@ -648,41 +933,31 @@ async def get_conversation_messages(
     current_user: User = Depends(get_current_user_required)
 ):
     # Verify user is participant
-    conversation = await db.conversations.find_one({"id": conversation_id})
-    if not conversation or current_user.id not in conversation["participant_ids"]:
+    if not await membership_cache.is_participant(db, conversation_id, current_user.id):
         raise HTTPException(status_code=403, detail="Access denied")
     
-    messages = await db.messages.find({"conversation_id": conversation_id}).sort("timestamp", 1).to_list(1000)
+    messages = await db.messages.find(
+        {"conversation_id": conversation_id}, {"_id": 0}
+    ).sort("timestamp", 1).to_list(1000)
     
     # Decrypt messages if encrypted
-    decrypted_messages = []
-    for msg in messages:
-        # Remove MongoDB ObjectId
-        msg.pop("_id", None)
-        message_obj = Message(**msg)
-        if message_obj.encrypted_content and message_obj.platform == Platform.WHATGRAM:
-            try:
-                message_obj.content = decrypt_message(message_obj.encrypted_content)
-            except:
-                pass  # Keep original if decryption fails
-        decrypted_messages.append(message_obj)
-    
-    return decrypted_messages
+    await decrypt_messages(messages)
+    return [Message(**msg) for msg in messages]
 
 
-@api_router.post("/messages", response_model=Message)
-async def send_message(
-    message: MessageCreate,
-    current_user: User = Depends(get_current_user_required)
-):
+async def create_message(message: MessageCreate, current_user: User) -> Message:
+    """Store, translate and fan out a new message; shared by HTTP and WebSocket sends"""
     # Verify conversation exists and user is participant
-    conversation = await db.conversations.find_one({"id": message.conversation_id})
-    if not conversation or current_user.id not in conversation["participant_ids"]:
+    participant_ids = await membership_cache.get_participants(db, message.conversation_id)
+    if not participant_ids or current_user.id not in participant_ids:
         raise HTTPException(status_code=403, detail="Access denied")
     
     message_dict = message.dict()
     message_dict["sender_id"] = current_user.id
     
+    # Other participants grouped by preferred language; reused for translations and notifications
+    plan = await fanout.plan(participant_ids, current_user.id)
+    
     # Add translation support
     if message.content:
         # Detect original language
@@ -690,34 +965,17 @@ async def send_message(
         message_dict["auto_detected_language"] = detected_lang
         message_dict["original_language"] = detected_lang
         
-        # Get languages of conversation participants for translations
-        participant_users = []
-        for participant_id in conversation["participant_ids"]:
-            if participant_id != current_user.id:
-                user = await db.users.find_one({"id": participant_id})
-                if user:
-                    participant_users.append(user)
-        
-        # Generate translations for participants who have auto_translate enabled
-        translations = {}
-        for participant in participant_users:
-            if participant.get("auto_translate", True) and participant.get("preferred_language", "tr") != detected_lang:
-                target_lang = participant.get("preferred_language", "tr")
-                translation_result = await translate_text(message.content, target_lang, detected_lang)
-                translations[target_lang] = translation_result["translated_text"]
-        
-        # Always include original language
-        translations[detected_lang] = message.content
-        message_dict["translations"] = translations
-    
-    # Encrypt content for WhatGram platform
-    if message.platform == Platform.WHATGRAM and message.content:
-        message_dict["encrypted_content"] = encrypt_message(message.content)
+        # One translation per language wanted by participants who have auto_translate enabled
+        message_dict["translations"] = await fanout.translate(message.content, detected_lang, plan)
     
     message_obj = Message(**message_dict)
     
-    # Insert message
-    await db.messages.insert_one(message_obj.dict())
+    # Insert message (WhatGram content is encrypted)
+    await db.messages.insert_one(message_document(message_obj))
+    inbox_stats.schedule_message_added(
+        participant_ids, message_obj.platform.value, message_obj.timestamp,
+        conversation_id=message_obj.conversation_id, sender_id=current_user.id
+    )
     
     # Update conversation
     await db.conversations.update_one(
@@ -725,6 +983,7 @@ async def send_message(
         {
             "$set": {
                 "last_message_id": message_obj.id,
+                "last_message_at": message_obj.timestamp,
                 "last_activity": datetime.utcnow()
             }
         }
@@ -732,33 +991,27 @@ async def send_message(
     
     # Send real-time notification with translations
     try:
-        # Notify each participant with their preferred language translation
-        for participant_id in conversation["participant_ids"]:
-            if participant_id != current_user.id:
-                participant = await db.users.find_one({"id": participant_id})
-                if participant:
-                    # Get translation for this user's preferred language
-                    user_lang = participant.get("preferred_language", "tr")
-                    translated_content = message_dict.get("translations", {}).get(user_lang, message.content)
-                    
-                    notification_message = message_obj.dict()
-                    notification_message["content"] = translated_content
-                    
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "new_message",
-                            "message": notification_message,
-                            "conversation_id": message.conversation_id,
-                            "translated_for": user_lang
-                        }),
-                        participant_id
-                    )
-    except:
-        pass
+        # The shared part of the event is encoded once; each language's content is spliced in
+        await fanout.deliver(
+            EventTemplate("new_message", message_obj),
+            plan,
+            message_dict.get("translations", {}),
+            message.content
+        )
+    except Exception as e:
+        logger.error(f"Failed to notify participants of message {message_obj.id}: {e}")
     
     return message_obj
 
 
+@api_router.post("/messages", response_model=Message)
+async def send_message(
+    message: MessageCreate,
+    current_user: User = Depends(get_current_user_required)
+):
+    return await create_message(message, current_user)
+
+
 # File Upload Routes
 @api_router.post("/upload")
 async def upload_file(
@@ -770,97 +1023,342 @@ async def upload_file(
 ):
     try:
         # Verify conversation
-        conversation = await db.conversations.find_one({"id": conversation_id})
-        if not conversation or current_user.id not in conversation["participant_ids"]:
+        if not await membership_cache.is_participant(db, conversation_id, current_user.id):
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # Generate unique filename
+        # Save file (skipped when the same bytes are already stored)
         file_extension = Path(file.filename).suffix
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = UPLOAD_DIR / unique_filename
-        
-        # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Get file info
-        file_size = file_path.stat().st_size
-        mime_type = mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
-        
-        # Determine message type
-        message_type = "file"
-        if mime_type.startswith("image/"):
-            message_type = "image"
-        elif mime_type.startswith("video/"):
-            message_type = "video"
-        elif mime_type.startswith("audio/"):
-            message_type = "audio"
-        
-        # Create file message
-        file_message = FileMessage(
-            filename=unique_filename,
-            original_name=file.filename,
-            file_path=f"/uploads/{unique_filename}",
-            file_size=file_size,
-            mime_type=mime_type,
-            encrypted=platform == Platform.WHATGRAM
-        )
+        try:
+            blob = await blob_store.store(file, file_extension, encrypt=platform == Platform.WHATGRAM)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
         
-        # Create message with file
-        message = Message(
-            conversation_id=conversation_id,
-            sender_id=current_user.id,
-            receiver_id=receiver_id,
-            file_message=file_message,
-            platform=platform,
-            message_type=message_type
+        return await create_file_message(
+            current_user, conversation_id, receiver_id, platform, blob_file_message(blob, file.filename)
         )
         
-        # Save to database
-        await db.messages.insert_one(message.dict())
-        
-        # Update conversation
-        await db.conversations.update_one(
-            {"id": conversation_id},
-            {
-                "$set": {
-                    "last_message_id": message.id,
-                    "last_activity": datetime.utcnow()
-                }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
+
+
+def blob_file_message(blob: Blob, original_name: str) -> FileMessage:
+    return FileMessage(
+        filename=blob.filename,
+        original_name=original_name,
+        file_path=f"/uploads/{blob.filename}",
+        file_size=blob.size,
+        mime_type=mimetypes.guess_type(original_name)[0] or "application/octet-stream",
+        encrypted=blob.encrypted,
+        content_hash=blob.content_hash
+    )
+
+
+async def create_file_message(
+    current_user: User,
+    conversation_id: str,
+    receiver_id: str,
+    platform: Platform,
+    file_message: FileMessage
+) -> Dict:
+    """Turn a stored file into a message and notify the receiver"""
+    mime_type = file_message.mime_type
+    
+    # Determine message type
+    message_type = "file"
+    if mime_type.startswith("image/"):
+        message_type = "image"
+    elif mime_type.startswith("video/"):
+        message_type = "video"
+    elif mime_type.startswith("audio/"):
+        message_type = "audio"
+    
+    # Create message with file
+    message = Message(
+        conversation_id=conversation_id,
+        sender_id=current_user.id,
+        receiver_id=receiver_id,
+        file_message=file_message,
+        platform=platform,
+        message_type=message_type
+    )
+    
+    # Save to database
+    await db.messages.insert_one(message.dict())
+    inbox_stats.schedule_message_added(
+        await membership_cache.get_participants(db, conversation_id) or (),
+        message.platform.value,
+        message.timestamp,
+        conversation_id=conversation_id,
+        sender_id=current_user.id
+    )
+    
+    # Update conversation
+    await db.conversations.update_one(
+        {"id": conversation_id},
+        {
+            "$set": {
+                "last_message_id": message.id,
+                "last_message_at": message.timestamp,
+                "last_activity": datetime.utcnow()
             }
-        )
-        
-        # Send real-time notification
-        try:
-            await manager.send_personal_message(
-                json.dumps({
-                    "type": "new_file",
-                    "message": message.dict(),
-                    "conversation_id": conversation_id
-                }),
-                receiver_id
-            )
-        except:
-            pass
-        
-        return {
-            "message": "File uploaded successfully",
-            "file_message": file_message,
-            "message_id": message.id,
-            "message_type": message_type
         }
-        
+    )
+    
+    # Thumbnails, smaller variants and voice note waveforms are filled in from the background (local blobs only)
+    if file_message.storage_key is None:
+        media_processor.submit(message.id, file_message.filename, mime_type)
+    
+    # Send real-time notification
+    try:
+        event = message_event("new_file", message)
+        if not await manager.send_personal_message(event, receiver_id) and not manager.is_online(receiver_id):
+            await offline_queue.enqueue(receiver_id, message.id, event)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
+        logger.error(f"Failed to notify {receiver_id} of file message {message.id}: {e}")
+    
+    return {
+        "message": "File uploaded successfully",
+        "file_message": file_message,
+        "message_id": message.id,
+        "message_type": message_type
+    }
+
+
+# Resumable Upload Routes
+def upload_session_status(session: Dict) -> Dict:
+    return {
+        "upload_id": session["id"],
+        "offset": session["offset"],
+        "size": session["size"],
+        "chunk_size": upload_writer.chunk_size,
+        "expires_at": session["expires_at"]
+    }
+
+
+async def get_upload_session(upload_id: str, current_user: User) -> Dict:
+    session = await upload_sessions.get(upload_id, current_user.id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    return session
+
+
+def offset_conflict(e: OffsetMismatch) -> HTTPException:
+    return HTTPException(status_code=409, detail={"message": str(e), "offset": e.offset})
+
+
+@api_router.post("/uploads")
+async def create_upload_session(
+    upload: UploadSessionCreate,
+    current_user: User = Depends(get_current_user_required)
+):
+    if not await membership_cache.is_participant(db, upload.conversation_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    try:
+        session = await upload_sessions.create(
+            current_user.id, upload.conversation_id, upload.receiver_id,
+            upload.platform.value, upload.filename, upload.size,
+            encrypt=upload.platform == Platform.WHATGRAM
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return upload_session_status(session)
+
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload_status(upload_id: str, current_user: User = Depends(get_current_user_required)):
+    return upload_session_status(await get_upload_session(upload_id, current_user))
+
+
+@api_router.put("/uploads/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    offset: int,
+    request: Request,
+    current_user: User = Depends(get_current_user_required)
+):
+    """Append the raw request body at `offset`; a dropped connection keeps the bytes received so far"""
+    session = await get_upload_session(upload_id, current_user)
+    try:
+        await upload_sessions.write_chunk(session, offset, request.stream())
+    except OffsetMismatch as e:
+        raise offset_conflict(e)
+    except SessionBusy:
+        raise HTTPException(status_code=409, detail="Another chunk for this upload is in progress")
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Chunk extends past the declared upload size")
+    return upload_session_status(session)
+
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, current_user: User = Depends(get_current_user_required)):
+    session = await get_upload_session(upload_id, current_user)
+    if not await membership_cache.is_participant(db, session["conversation_id"], current_user.id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    try:
+        blob = await upload_sessions.complete(session, encrypt=session["platform"] == Platform.WHATGRAM.value)
+    except OffsetMismatch as e:
+        raise offset_conflict(e)
+    except SessionBusy:
+        raise HTTPException(status_code=409, detail="A chunk for this upload is still in progress")
+    return await create_file_message(
+        current_user, session["conversation_id"], session["receiver_id"],
+        Platform(session["platform"]), blob_file_message(blob, session["filename"])
+    )
+
+
+@api_router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: User = Depends(get_current_user_required)):
+    await upload_sessions.abort(await get_upload_session(upload_id, current_user))
+    return {"message": "Upload cancelled"}
 
 
-@api_router.get("/files/{filename}")
-async def get_file(filename: str):
-    file_path = UPLOAD_DIR / filename
-    if not file_path.exists():
+async def can_read_file(user_id: str, filename: str) -> bool:
+    """
+    Whether the user is in a conversation with a message carrying this file
+
+    Variants (<id>.thumb.webp) and encrypted copies (<id>.wge.jpg) share the
+    blob's leading id, so one prefix lookup covers them all.
+    """
+    file_id = filename.split(".", 1)[0]
+    if not file_id:
+        return False
+    conversation_ids = await db.messages.distinct(
+        "conversation_id",
+        {"file_message.filename": {"$regex": f"^{re.escape(file_id)}(\\.|$)"}}
+    )
+    for conversation_id in conversation_ids:
+        if await membership_cache.is_participant(db, conversation_id, user_id):
+            return True
+    return False
+
+
+@api_router.api_route("/files/{filename}", methods=["GET", "HEAD"])
+async def get_file(
+    request: Request,
+    filename: str,
+    size: Optional[str] = None,
+    current_user: User = Depends(get_current_user_required)
+):
+    """`size` picks a rendered variant (thumb, medium); the original is served until it exists"""
+    # 404 rather than 403: a stranger can't tell whether the file exists
+    if not await can_read_file(current_user.id, filename):
         raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(file_path)
+    try:
+        resolved = media_processor.resolve(filename, size)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown size: {size}")
+    # A variant that is still rendering falls back to the original; don't let that get cached for good
+    final = resolved != filename or size in (None, "original")
+    try:
+        return await file_server.response(request, resolved, immutable=final)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+# Direct Upload Routes
+# Direct uploads bypass the server, so they can't be sealed with the file key ring
+WHATGRAM_DIRECT_UPLOAD = HTTPException(
+    status_code=400,
+    detail="WhatGram files are stored encrypted; upload them through /api/uploads"
+)
+
+
+@api_router.post("/media/presign")
+async def presign_media_upload(
+    upload: DirectUploadCreate,
+    current_user: User = Depends(get_current_user_required)
+):
+    """Reserve a storage key and a presigned URL; register the key once the bytes are uploaded"""
+    if not await membership_cache.is_participant(db, upload.conversation_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if upload.platform == Platform.WHATGRAM:
+        raise WHATGRAM_DIRECT_UPLOAD
+    content_type = upload.content_type or mimetypes.guess_type(upload.filename)[0] or "application/octet-stream"
+    try:
+        return await direct_uploads.reserve(
+            current_user.id, upload.conversation_id, upload.receiver_id, upload.platform.value,
+            upload.filename, upload.size, content_type
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+@api_router.post("/media/{key}/register")
+async def register_media_upload(key: str, current_user: User = Depends(get_current_user_required)):
+    reservation = await direct_uploads.get(key, current_user.id)
+    if not reservation:
+        raise HTTPException(status_code=404, detail="Upload reservation not found or expired")
+    if not await membership_cache.is_participant(db, reservation["conversation_id"], current_user.id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if reservation["platform"] == Platform.WHATGRAM.value:
+        raise WHATGRAM_DIRECT_UPLOAD
+    try:
+        size = await direct_uploads.confirm(reservation)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if size is None:
+        raise HTTPException(status_code=409, detail="The file has not been uploaded yet")
+
+    file_message = FileMessage(
+        filename=key,
+        original_name=reservation["filename"],
+        file_path=f"/api/media/{key}",
+        file_size=size,
+        mime_type=reservation["content_type"],
+        storage_key=key
+    )
+    return await create_file_message(
+        current_user, reservation["conversation_id"], reservation["receiver_id"],
+        Platform(reservation["platform"]), file_message
+    )
+
+
+@api_router.get("/media/{key}")
+async def get_media(key: str, current_user: User = Depends(get_current_user_required)):
+    """Stable link for a directly uploaded file; redirects to a fresh presigned download URL"""
+    message = await db.messages.find_one({"file_message.storage_key": key}, {"_id": 0, "conversation_id": 1})
+    # 404 rather than 403, as for /api/files
+    if not message or not await membership_cache.is_participant(db, message["conversation_id"], current_user.id):
+        raise HTTPException(status_code=404, detail="File not found")
+    url = await media_storage.presign_download(key, direct_uploads.url_ttl)
+    # Cache the redirect for well under the URL lifetime
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": f"private, max-age={direct_uploads.url_ttl // 4}"})
+
+
+@api_router.put("/storage/{key}")
+async def put_local_object(key: str, op: str, expires: int, sig: str, size: int, request: Request):
+    """Upload target of LocalStorage presigned URLs"""
+    if local_media_server is None or op != "put" or not media_storage.verify("put", key, expires, sig, size):
+        raise HTTPException(status_code=403, detail="Invalid or expired upload URL")
+    # The signature outlives registration; once registered the object must not change
+    if not await direct_uploads.is_pending(key):
+        raise HTTPException(status_code=403, detail="Invalid or expired upload URL")
+    path = media_storage.path_for(key)
+    try:
+        result = await upload_writer.write(request.stream(), path, size)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if result.size != size:
+        await media_storage.delete(key)
+        raise HTTPException(status_code=400, detail=f"Received {result.size} bytes, the URL was signed for {size}")
+    return Response(status_code=200)
+
+
+@api_router.api_route("/storage/{key}", methods=["GET", "HEAD"])
+async def get_local_object(key: str, op: str, expires: int, sig: str, request: Request):
+    """Download target of LocalStorage presigned URLs"""
+    if local_media_server is None or op != "get" or not media_storage.verify("get", key, expires, sig):
+        raise HTTPException(status_code=403, detail="Invalid or expired download URL")
+    try:
+        return await local_media_server.response(request, key)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+# file_path values stored on messages point here
+app.add_api_route("/uploads/{filename}", get_file, methods=["GET", "HEAD"], include_in_schema=False)
 
 
 # Group Management Routes
@@ -927,6 +1425,8 @@ async def create_group(
         group_id=group.id
     )
     await db.conversations.insert_one(conversation.dict())
+    membership_cache.put(conversation.dict())
+    await inbox_stats.conversation_added(conversation.participant_ids, "group")
     
     return group
 
@@ -935,10 +1435,11 @@ async def create_group(
 async def manage_group_member(
     group_id: str,
     action_data: GroupMemberAction,
-    current_user: User = Depends(get_current_user_required)
+    current_user: User = Depends(get_current_user_required),
+    loader: DataLoader = Depends(get_data_loader)
 ):
     # Find group
-    group = await db.groups.find_one({"id": group_id})
+    group = await loader.load("groups", group_id)
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     
@@ -957,6 +1458,7 @@ async def manage_group_member(
     target_user_id = target_user["id"]
     
     # Perform action
+    member_ids_before = set(group_obj.member_ids)
     if action_data.action == "add":
         if target_user_id not in group_obj.member_ids:
             group_obj.member_ids.append(target_user_id)
@@ -985,6 +1487,10 @@ async def manage_group_member(
         {"group_id": group_id},
         {"$set": {"participant_ids": group_obj.member_ids}}
     )
+    invalidate_membership("group", group_id)
+    if set(group_obj.member_ids) != member_ids_before:
+        # Joining or leaving changes which messages count towards the member's stats
+        await inbox_stats.invalidate([target_user_id])
     
     return {"message": f"Member {action_data.action} successful", "member_count": group_obj.member_count}
 
@@ -1045,6 +1551,8 @@ async def create_channel(
         channel_id=channel.id
     )
     await db.conversations.insert_one(conversation.dict())
+    membership_cache.put(conversation.dict())
+    await inbox_stats.conversation_added(conversation.participant_ids, "channel")
     
     return channel
 
@@ -1052,10 +1560,11 @@ async def create_channel(
 @api_router.post("/channels/{channel_id}/subscribe")
 async def subscribe_to_channel(
     channel_id: str,
-    current_user: User = Depends(get_current_user_required)
+    current_user: User = Depends(get_current_user_required),
+    loader: DataLoader = Depends(get_data_loader)
 ):
     # Find channel
-    channel = await db.channels.find_one({"id": channel_id})
+    channel = await loader.load("channels", channel_id)
     if not channel:
         raise HTTPException(status_code=404, detail="Channel not found")
     
@@ -1071,6 +1580,7 @@ async def subscribe_to_channel(
             {"id": channel_id},
             {"$set": channel_obj.dict()}
         )
+        invalidate_membership("channel", channel_id)
     
     return {"message": "Successfully subscribed to channel", "subscriber_count": channel_obj.subscriber_count}
 
@@ -1259,7 +1769,8 @@ async def update_user_language_settings(
 async def get_unified_inbox(
     limit: int = 50,
     offset: int = 0,
-    current_user: User = Depends(get_current_user_required)
+    current_user: User = Depends(get_current_user_required),
+    loader: DataLoader = Depends(get_data_loader)
 ):
     """Get unified inbox with all messages from all platforms sorted chronologically"""
     
@@ -1275,6 +1786,33 @@ async def get_unified_inbox(
         "conversation_id": {"$in": conversation_ids}
     }).sort("timestamp", -1).skip(offset).limit(limit).to_list(limit)
     
+    conversations_by_id = {conv["id"]: conv for conv in user_conversations}
+    
+    # Decrypt WhatGram messages if needed
+    await decrypt_messages(messages)
+    
+    # Prefetch every contact, group and channel on this page with one query per collection
+    contact_ids = set()
+    group_ids = set()
+    channel_ids = set()
+    for msg in messages:
+        conversation = conversations_by_id.get(msg["conversation_id"])
+        if not conversation:
+            continue
+        if msg["sender_id"] != current_user.id:
+            contact_ids.add(msg["sender_id"])
+        if conversation.get("group_id"):
+            group_ids.add(conversation["group_id"])
+        elif conversation.get("channel_id"):
+            channel_ids.add(conversation["channel_id"])
+        else:
+            contact_ids.update(pid for pid in conversation["participant_ids"] if pid != current_user.id)
+    await asyncio.gather(
+        loader.load_many("contacts", contact_ids),
+        loader.load_many("groups", group_ids),
+        loader.load_many("channels", channel_ids)
+    )
+    
     # Enrich messages with conversation and contact info
     enriched_messages = []
     for msg in messages:
@@ -1282,16 +1820,9 @@ async def get_unified_inbox(
         message_obj = Message(**msg)
         
         # Get conversation info
-        conversation = next((conv for conv in user_conversations if conv["id"] == msg["conversation_id"]), None)
+        conversation = conversations_by_id.get(msg["conversation_id"])
         if not conversation:
             continue
-            
-        # Decrypt WhatGram messages if needed
-        if message_obj.encrypted_content and message_obj.platform == Platform.WHATGRAM:
-            try:
-                message_obj.content = decrypt_message(message_obj.encrypted_content)
-            except:
-                pass
         
         # Get contact/group/channel info
         sender_info = None
@@ -1299,16 +1830,14 @@ async def get_unified_inbox(
         
         if message_obj.sender_id != current_user.id:
             # Get sender contact info
-            sender_contact = await db.contacts.find_one({"id": message_obj.sender_id})
+            sender_contact = await loader.load("contacts", message_obj.sender_id)
             if sender_contact:
-                sender_contact.pop("_id", None)
                 sender_info = Contact(**sender_contact)
         
         # Get chat info (individual, group, or channel)
         if conversation.get("group_id"):
-            group = await db.groups.find_one({"id": conversation["group_id"]})
+            group = await loader.load("groups", conversation["group_id"])
             if group:
-                group.pop("_id", None)
                 chat_info = {
                     "type": "group",
                     "name": group["name"],
@@ -1316,9 +1845,8 @@ async def get_unified_inbox(
                     "member_count": group.get("member_count", 0)
                 }
         elif conversation.get("channel_id"):
-            channel = await db.channels.find_one({"id": conversation["channel_id"]})
+            channel = await loader.load("channels", conversation["channel_id"])
             if channel:
-                channel.pop("_id", None)
                 chat_info = {
                     "type": "channel",
                     "name": channel["name"],
@@ -1329,9 +1857,8 @@ async def get_unified_inbox(
             # Individual chat
             other_participant_id = next((pid for pid in conversation["participant_ids"] if pid != current_user.id), None)
             if other_participant_id:
-                contact = await db.contacts.find_one({"id": other_participant_id})
+                contact = await loader.load("contacts", other_participant_id)
                 if contact:
-                    contact.pop("_id", None)
                     chat_info = {
                         "type": "contact",
                         "name": contact["name"],
@@ -1379,61 +1906,332 @@ async def get_inbox_stats(
 ):
     """Get inbox statistics for dashboard"""
     
-    # Get all user conversations
-    user_conversations = await db.conversations.find({
-        "participant_ids": current_user.id
-    }).to_list(1000)
-    
-    conversation_ids = [conv["id"] for conv in user_conversations]
-    
-    # Count messages by platform
-    pipeline = [
-        {"$match": {"conversation_id": {"$in": conversation_ids}}},
-        {"$group": {
-            "_id": "$platform", 
-            "count": {"$sum": 1},
-            "latest": {"$max": "$timestamp"}
-        }}
-    ]
-    
-    platform_stats = await db.messages.aggregate(pipeline).to_list(100)
-    
-    # Count unread messages (simplified - all recent messages)
-    recent_messages = await db.messages.count_documents({
-        "conversation_id": {"$in": conversation_ids},
-        "sender_id": {"$ne": current_user.id},
-        "timestamp": {"$gte": datetime.utcnow() - timedelta(hours=24)}
-    })
-    
-    # Count by chat type
-    individual_chats = len([conv for conv in user_conversations if conv.get("conversation_type") == "private"])
-    group_chats = len([conv for conv in user_conversations if conv.get("conversation_type") == "group"])
-    channel_chats = len([conv for conv in user_conversations if conv.get("conversation_type") == "channel"])
+    # Counters, unread included, are kept up to date on writes and read cursor moves
+    stats = await inbox_stats.get(current_user.id)
     
+    chats = stats.get("chats", {})
     return {
-        "platform_stats": platform_stats,
-        "unread_count": recent_messages,
+        "platform_stats": [
+            {"_id": platform, "count": counts["count"], "latest": counts.get("latest")}
+            for platform, counts in stats.get("platforms", {}).items()
+        ],
+        "unread_count": sum(stats.get("unread", {}).values()),
         "chat_counts": {
-            "individual": individual_chats,
-            "groups": group_chats,
-            "channels": channel_chats,
-            "total": len(user_conversations)
+            "individual": chats.get("private", 0),
+            "groups": chats.get("group", 0),
+            "channels": chats.get("channel", 0),
+            "total": chats.get("total", 0)
         },
         "supported_platforms": ["whatsapp", "telegram", "whatgram"]
     }
 
 
+# Shared secret for /api/metrics; without one only loopback callers (a local agent) may read them
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+async def require_metrics_access(request: Request):
+    if METRICS_TOKEN:
+        if hmac.compare_digest(request.headers.get("x-metrics-token", ""), METRICS_TOKEN):
+            return
+    elif request.client and request.client.host in ("127.0.0.1", "::1"):
+        return
+    raise HTTPException(status_code=403, detail="Metrics are internal")
+
+
+@api_router.get("/metrics", dependencies=[Depends(require_metrics_access)])
+async def get_metrics(connections: bool = False, queue_depth: bool = False):
+    """
+    Per-worker runtime metrics
+    
+    ?connections=true adds per-socket bandwidth counters; ?queue_depth=true adds
+    offline queue depth, which aggregates over the whole collection.
+    """
+    metrics = {
+        "worker_pid": os.getpid(),
+        "membership_cache": membership_cache.stats(),
+        "message_decryption": page_decryptor.stats(),
+        "message_rewrap": message_rewrapper.stats(),
+        "websocket": manager.stats(),
+        "delivery_bus": delivery_bus.stats(),
+        "fanout": fanout.stats(),
+        "offline_queue": await offline_queue.stats() if queue_depth else offline_queue.metrics.snapshot(),
+        "presence": presence.stats(),
+        "typing": typing_throttle.stats(),
+        "read_receipts": read_receipts.stats(),
+        "inbox_stats": inbox_stats.stats(),
+        "uploads": upload_writer.stats(),
+        "blobs": blob_store.stats(),
+        "upload_sessions": upload_sessions.stats(),
+        "media": media_processor.stats(),
+        "downloads": file_server.stats(),
+        "direct_uploads": direct_uploads.stats()
+    }
+    if connections:
+        metrics["connections"] = manager.connection_stats()
+    return metrics
+
+
 # WebSocket endpoint
+WS_MAX_INFLIGHT_SENDS = int(os.environ.get('WS_MAX_INFLIGHT_SENDS', '32'))
+
+
+async def authenticate_websocket(token: Optional[str], user_id: str) -> Optional[User]:
+    """Resolve a WebSocket token to its user; the token must belong to the path's user_id"""
+    if not token or decode_access_token(token) != user_id:
+        return None
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    return User(**user) if user else None
+
+
+class WebSocketSendPipeline:
+    """
+    Runs `send` frames from one socket through create_message and queues acks
+
+    Frames for different conversations are processed concurrently (bounded by
+    WS_MAX_INFLIGHT_SENDS); frames for the same conversation keep their order.
+    Acks carry the client's sequence number, so they may arrive out of order.
+    """
+    
+    def __init__(self, connection, user: User):
+        self.connection = connection
+        self.user = user
+        self.slots = asyncio.Semaphore(WS_MAX_INFLIGHT_SENDS)
+        self.conversation_locks: Dict[str, asyncio.Lock] = {}
+        self.pending: Dict[str, int] = {}
+        self.tasks = set()
+    
+    def submit(self, frame: dict):
+        task = asyncio.create_task(self._process(frame))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    def _ack(self, payload: dict):
+        self.connection.enqueue(payload)
+    
+    async def _process(self, frame: dict):
+        seq = frame.get("seq")
+        try:
+            message = MessageCreate(**(frame.get("message") or {}))
+        except ValueError as e:
+            self._ack({"type": "nack", "seq": seq, "status": 422, "error": str(e)})
+            return
+        
+        conversation_id = message.conversation_id
+        lock = self.conversation_locks.setdefault(conversation_id, asyncio.Lock())
+        self.pending[conversation_id] = self.pending.get(conversation_id, 0) + 1
+        try:
+            async with lock, self.slots:
+                message_obj = await create_message(message, self.user)
+        except HTTPException as e:
+            self._ack({"type": "nack", "seq": seq, "status": e.status_code, "error": e.detail})
+            return
+        except Exception as e:
+            logger.error(f"WebSocket send failed for {self.user.id}: {e}")
+            self._ack({"type": "nack", "seq": seq, "status": 500, "error": "Message send failed"})
+            return
+        finally:
+            self.pending[conversation_id] -= 1
+            if not self.pending[conversation_id]:
+                del self.pending[conversation_id]
+                del self.conversation_locks[conversation_id]
+        
+        self._ack({
+            "type": "ack",
+            "seq": seq,
+            "message_id": message_obj.id,
+            "conversation_id": message_obj.conversation_id,
+            "timestamp": message_obj.timestamp.isoformat()
+        })
+
+
+async def refresh_unread(receipts: List[Dict]):
+    """Recount the readers' unread messages in the conversations their cursors moved in"""
+    conversation_ids = {}
+    for receipt in receipts:
+        conversation_ids.setdefault(receipt["user_id"], set()).add(receipt["conversation_id"])
+    conversations = await db.conversations.find(
+        {"id": {"$in": list({cid for cids in conversation_ids.values() for cid in cids})}},
+        {"_id": 0, "id": 1, "last_message_at": 1}
+    ).to_list(None)
+    for user_id, cids in conversation_ids.items():
+        counts = await read_cursors.unread_counts(user_id, [conv for conv in conversations if conv["id"] in cids])
+        await inbox_stats.unread_changed(user_id, counts)
+
+
+async def on_read_receipts(receipts: List[Dict]):
+    """Move the readers' cursors, then tell the other participants how far each reader got"""
+    await read_cursors.advance(receipts)
+    await refresh_unread(receipts)
+    for receipt in receipts:
+        participant_ids = await membership_cache.get_participants(db, receipt["conversation_id"]) or ()
+        event = {"type": "read", **receipt}
+        for participant_id in participant_ids:
+            if participant_id != receipt["user_id"]:
+                await manager.send_personal_message(
+                    event, participant_id,
+                    coalesce_key=f"read:{receipt['conversation_id']}:{receipt['user_id']}"
+                )
+
+
+read_receipts = ReadReceiptBuffer(
+    db,
+    flush_interval=float(os.environ.get('READ_RECEIPT_FLUSH_INTERVAL', '2')),
+    on_flush=on_read_receipts
+)
+
+
+async def handle_typing(user: User, frame: dict):
+    conversation_id = frame.get("conversation_id")
+    is_typing = bool(frame.get("is_typing", True))
+    participant_ids = await membership_cache.get_participants(db, conversation_id)
+    if not participant_ids or user.id not in participant_ids:
+        return
+    if not typing_throttle.allow(user.id, conversation_id, is_typing):
+        return
+    event = {
+        "type": "typing",
+        "conversation_id": conversation_id,
+        "user_id": user.id,
+        "is_typing": is_typing,
+        # Clients clear the indicator themselves if no refresh arrives
+        "expires_in": typing_throttle.interval * 2,
+    }
+    for participant_id in participant_ids:
+        if participant_id != user.id:
+            await manager.send_personal_message(
+                event, participant_id, coalesce_key=f"typing:{conversation_id}:{user.id}"
+            )
+
+
+async def handle_read_receipt(user: User, frame: dict):
+    conversation_id = frame.get("conversation_id")
+    message_id = frame.get("message_id")
+    if not message_id or not await membership_cache.is_participant(db, conversation_id, user.id):
+        return
+    read_receipts.add(user.id, conversation_id, message_id)
+
+
+# Work started from a socket handler without awaiting it; held here so it isn't collected mid-flight
+background_tasks: Set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+
+
+def background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()!r}")
+
+
+async def flush_offline_queue(connection):
+    """Deliver what was queued while the user had no socket; only authenticated sockets get history"""
+    try:
+        flushed = await offline_queue.flush(connection)
+        if flushed:
+            logger.info(f"Flushed {flushed} queued events to {connection.user_id}/{connection.id}")
+    except Exception as e:
+        logger.error(f"Offline queue flush for {connection.user_id} failed: {e}")
+
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: str,
+    token: Optional[str] = None,
+    encoding: Optional[str] = None
+):
+    # JSON text frames by default; MessagePack binary frames when negotiated
+    codec, subprotocol = negotiate_codec(websocket.scope.get("subprotocols"), encoding)
+    connection = await manager.connect(websocket, user_id, codec=codec, subprotocol=subprotocol)
+    pipeline = None
+    user = await authenticate_websocket(token, user_id)
+    if user:
+        manager.register(connection)
+        pipeline = WebSocketSendPipeline(connection, user)
+        run_in_background(flush_offline_queue(connection))
     try:
         while True:
-            data = await websocket.receive_text()
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            data = received.get("text")
+            if data is None:
+                data = received.get("bytes") or b""
+            connection.touch(len(data))
+            
+            # Heartbeats: answer client pings, pongs only refresh activity
+            try:
+                frame = codec.decode(data)
+            except Exception:
+                frame = None
+            if isinstance(frame, dict) and frame.get("type") == "pong":
+                continue
+            if isinstance(frame, dict) and frame.get("type") == "ping":
+                connection.enqueue({"type": "pong", "ts": frame.get("ts")})
+                continue
+            
+            # Authentication for clients that did not pass ?token= on connect
+            if isinstance(frame, dict) and frame.get("type") == "auth":
+                user = await authenticate_websocket(frame.get("token"), user_id)
+                pipeline = WebSocketSendPipeline(connection, user) if user else None
+                connection.enqueue({"type": "auth", "ok": pipeline is not None})
+                if pipeline is not None:
+                    manager.register(connection)
+                    run_in_background(flush_offline_queue(connection))
+                continue
+            
+            if isinstance(frame, dict) and frame.get("type") == "send":
+                if pipeline is None:
+                    connection.enqueue({
+                        "type": "nack", "seq": frame.get("seq"), "status": 401, "error": "Authentication required"
+                    })
+                else:
+                    pipeline.submit(frame)
+                continue
+            
+            # Typing indicators and read receipts; both are coalesced, neither is acked
+            if isinstance(frame, dict) and frame.get("type") in ("typing", "read"):
+                if pipeline is None:
+                    connection.enqueue({
+                        "type": "nack", "seq": frame.get("seq"), "status": 401, "error": "Authentication required"
+                    })
+                elif frame["type"] == "typing":
+                    await handle_typing(user, frame)
+                else:
+                    await handle_read_receipt(user, frame)
+                continue
+            
+            # Presence subscriptions: current state now, throttled changes later
+            if isinstance(frame, dict) and frame.get("type") in ("presence_subscribe", "presence_unsubscribe"):
+                user_ids = [str(u) for u in frame.get("user_ids") or []]
+                if pipeline is None:
+                    connection.enqueue({
+                        "type": "nack", "seq": frame.get("seq"), "status": 401, "error": "Authentication required"
+                    })
+                elif frame["type"] == "presence_unsubscribe":
+                    presence.unsubscribe(connection, user_ids)
+                else:
+                    states = await presence.subscribe(connection, await presence_visible(user, user_ids))
+                    connection.enqueue({
+                        "type": "presence_snapshot",
+                        "seq": frame.get("seq"),
+                        "presence": [{"user_id": u, **state} for u, state in states.items()]
+                    })
+                continue
+            
             # Handle incoming WebSocket messages
-            await websocket.send_text(f"Message received: {data}")
+            if isinstance(data, bytes):
+                data = data.decode(errors="replace")
+            connection.enqueue(f"Message received: {data}")
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user_id)
+        pass
+    finally:
+        await manager.disconnect(connection)
 
 
 # Mock Data for Testing
@@ -1509,7 +2307,8 @@ async def init_mock_data():
             conversation = Conversation(
                 participant_ids=[demo_user.id, contact.id],
                 platform=platform,
-                created_by=demo_user.id
+                created_by=demo_user.id,
+                participant_key=participant_key([demo_user.id, contact.id])
             )
             conversations.append(conversation)
             await db.conversations.insert_one(conversation.dict())
@@ -1540,10 +2339,7 @@ async def init_mock_data():
             ]
             
             for msg in sample_messages:
-                # Encrypt WhatGram messages
-                if msg.platform == Platform.WHATGRAM and msg.content:
-                    msg.encrypted_content = encrypt_message(msg.content)
-                await db.messages.insert_one(msg.dict())
+                await db.messages.insert_one(message_document(msg))
     
     # Create demo groups for each platform
     demo_groups = []
@@ -1595,9 +2391,7 @@ async def init_mock_data():
         ]
         
         for msg in group_messages:
-            if msg.platform == Platform.WHATGRAM and msg.content:
-                msg.encrypted_content = encrypt_message(msg.content)
-            await db.messages.insert_one(msg.dict())
+            await db.messages.insert_one(message_document(msg))
     
     # Create demo channels
     demo_channels = []
@@ -1641,9 +2435,9 @@ async def init_mock_data():
             message_type="announcement"
         )
         
-        if announcement.platform == Platform.WHATGRAM and announcement.content:
-            announcement.encrypted_content = encrypt_message(announcement.content)
-        await db.messages.insert_one(announcement.dict())
+        await db.messages.insert_one(message_document(announcement))
+    
+    await inbox_stats.invalidate([demo_user.id])
     
     # Create demo user token
     access_token = create_access_token(data={"sub": demo_user.id}, expires_delta=timedelta(hours=24))
@@ -1666,6 +2460,21 @@ async def init_mock_data():
 # Include the router in the main app
 app.include_router(api_router)
 
+
+@app.middleware("http")
+async def report_query_counts(request: Request, call_next):
+    """Expose how many batched reads the request-scoped loader issued"""
+    response = await call_next(request)
+    loader = getattr(request.state, "data_loader", None)
+    if loader is not None:
+        response.headers["X-DB-Queries"] = str(loader.query_count)
+        logger.debug(f"{request.method} {request.url.path} loader stats: {loader.stats()}")
+    return response
+
+# Refuse oversized upload bodies before Starlette spools them to disk
+app.add_middleware(UploadSizeLimit, max_bytes=upload_writer.max_bytes, paths=["/api/upload"],
+                   metrics=upload_writer.metrics)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1681,6 +2490,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def migrate_db():
+    await run_migrations(db)
+    sealed = await offline_queue.seal_legacy()
+    if sealed:
+        logger.info(f"Sealed plaintext offline queue entries for {sealed} users")
+
+@app.on_event("startup")
+async def start_delivery_bus():
+    await delivery_bus.start()
+    manager.start_heartbeat()
+    presence.start()
+    read_receipts.start()
+    inbox_stats.start()
+    blob_store.start()
+    upload_sessions.start()
+    direct_uploads.start()
+    message_rewrapper.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await manager.stop()
+    await presence.stop()
+    await read_receipts.stop()
+    await inbox_stats.stop()
+    await blob_store.stop()
+    await upload_sessions.stop()
+    await direct_uploads.stop()
+    await message_rewrapper.stop()
+    await media_processor.stop()
+    await delivery_bus.stop()
+    client.close()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    
+    # permessage-deflate trades CPU for bandwidth on text-heavy JSON frames; off by default here
+    uvicorn.run(
+        app,
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', '8001')),
+        ws_per_message_deflate=os.environ.get('WS_PER_MESSAGE_DEFLATE', 'false').lower() == 'true'
+    )
\ No newline at end of file
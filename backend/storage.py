@@ -0,0 +1,284 @@
+"""
+Object storage for direct media uploads
+Clients move the bytes through presigned URLs; the API only hands out URLs and registers the result
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import quote, urlencode
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # Optional dependency: only the local backend is available without it
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+
+class Storage:
+    """Interface of a storage backend; keys are flat names like <uuid>.<ext>"""
+
+    name = "base"
+
+    async def presign_upload(self, key: str, content_type: str, size: int, expires_in: int) -> Dict:
+        """{"url", "method", "headers"} the client uses to send the bytes"""
+        raise NotImplementedError
+
+    async def presign_download(self, key: str, expires_in: int, filename: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    async def size_of(self, key: str) -> Optional[int]:
+        """Stored size in bytes, or None when the object does not exist"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """
+    Files on local disk behind HMAC-signed URLs served by this API
+
+    Meant for development and single-node setups; the signed URLs mirror what
+    S3 hands out, so clients use the same flow against either backend.
+    """
+
+    name = "local"
+
+    def __init__(self, root: Path, secret: bytes, url_prefix: str = "/api/storage"):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.secret = secret
+        self.url_prefix = url_prefix.rstrip("/")
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key
+
+    def _signature(self, operation: str, key: str, expires: int, size: Optional[int] = None) -> str:
+        message = f"{operation}\n{key}\n{expires}\n{'' if size is None else size}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def signed_url(self, operation: str, key: str, expires_in: int, size: Optional[int] = None) -> str:
+        expires = int(time.time()) + expires_in
+        query = {"op": operation, "expires": expires}
+        if size is not None:
+            query["size"] = size
+        query["sig"] = self._signature(operation, key, expires, size)
+        return f"{self.url_prefix}/{quote(key)}?{urlencode(query)}"
+
+    def verify(self, operation: str, key: str, expires: int, signature: str, size: Optional[int] = None) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(operation, key, expires, size), signature)
+
+    async def presign_upload(self, key: str, content_type: str, size: int, expires_in: int) -> Dict:
+        return {
+            "url": self.signed_url("put", key, expires_in, size),
+            "method": "PUT",
+            "headers": {"Content-Type": content_type},
+        }
+
+    async def presign_download(self, key: str, expires_in: int, filename: Optional[str] = None) -> str:
+        return self.signed_url("get", key, expires_in)
+
+    async def size_of(self, key: str) -> Optional[int]:
+        try:
+            return (await asyncio.to_thread(os.stat, self.path_for(key))).st_size
+        except FileNotFoundError:
+            return None
+
+    async def delete(self, key: str):
+        try:
+            await asyncio.to_thread(os.unlink, self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(Storage):
+    """
+    Any S3-compatible service (AWS, MinIO, Ceph, or a local stand-in via endpoint_url)
+
+    boto3 is synchronous, so every call runs on a small thread pool; presigning
+    is local computation but shares the pool to keep the event loop clean.
+    """
+
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "media/", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, server_side_encryption: Optional[str] = None,
+                 max_workers: int = 8):
+        if boto3 is None:
+            raise RuntimeError("S3 storage needs boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.server_side_encryption = server_side_encryption
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            # Path-style URLs work with stand-ins that have no wildcard DNS
+            config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path" if endpoint_url else "auto"}),
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3")
+
+    async def _call(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    async def presign_upload(self, key: str, content_type: str, size: int, expires_in: int) -> Dict:
+        params = {"Bucket": self.bucket, "Key": self.prefix + key, "ContentType": content_type}
+        headers = {"Content-Type": content_type}
+        if self.server_side_encryption:
+            params["ServerSideEncryption"] = self.server_side_encryption
+            headers["x-amz-server-side-encryption"] = self.server_side_encryption
+        url = await self._call(
+            self.client.generate_presigned_url, "put_object", Params=params, ExpiresIn=expires_in
+        )
+        return {"url": url, "method": "PUT", "headers": headers}
+
+    async def presign_download(self, key: str, expires_in: int, filename: Optional[str] = None) -> str:
+        params = {"Bucket": self.bucket, "Key": self.prefix + key}
+        if filename:
+            params["ResponseContentDisposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+        return await self._call(
+            self.client.generate_presigned_url, "get_object", Params=params, ExpiresIn=expires_in
+        )
+
+    async def size_of(self, key: str) -> Optional[int]:
+        try:
+            head = await self._call(self.client.head_object, Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head["ContentLength"]
+
+    async def delete(self, key: str):
+        await self._call(self.client.delete_object, Bucket=self.bucket, Key=self.prefix + key)
+
+
+class DirectUploads:
+    """
+    Presigned uploads waiting to be registered as messages
+
+    direct_uploads documents: {key, user_id, conversation_id, receiver_id, platform,
+    filename, size, content_type, expires_at}. A reservation that is never registered is
+    swept after it expires, together with whatever the client uploaded.
+    """
+
+    def __init__(self, db, storage: Storage, max_bytes: int, url_ttl: int = 3600,
+                 registration_ttl: float = 86400.0, sweep_interval: float = 600.0):
+        self.collection = db.direct_uploads
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.url_ttl = url_ttl
+        self.registration_ttl = registration_ttl
+        self.sweep_interval = sweep_interval
+        self._task: Optional[asyncio.Task] = None
+
+        self.presigned = 0
+        self.registered = 0
+        self.size_mismatches = 0
+        self.expired = 0
+
+    async def reserve(self, user_id: str, conversation_id: str, receiver_id: str, platform: str,
+                      filename: str, size: int, content_type: str) -> Dict:
+        """Reserve a key and presign its upload; raises ValueError when over the size limit"""
+        if size > self.max_bytes:
+            raise ValueError(f"Upload exceeds the {self.max_bytes} byte limit")
+        key = f"{uuid.uuid4().hex}{Path(filename).suffix.lower()}"
+        upload = await self.storage.presign_upload(key, content_type, size, self.url_ttl)
+        await self.collection.insert_one({
+            "key": key,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "receiver_id": receiver_id,
+            "platform": platform,
+            "filename": filename,
+            "size": size,
+            "content_type": content_type,
+            "expires_at": datetime.utcnow() + timedelta(seconds=self.registration_ttl),
+        })
+        self.presigned += 1
+        return {"key": key, "upload": upload, "url_expires_in": self.url_ttl}
+
+    async def get(self, key: str, user_id: str) -> Optional[Dict]:
+        return await self.collection.find_one(
+            {"key": key, "user_id": user_id, "expires_at": {"$gt": datetime.utcnow()}}, {"_id": 0}
+        )
+
+    async def is_pending(self, key: str) -> bool:
+        """Whether the key still has a reservation waiting for its bytes"""
+        return await self.collection.count_documents(
+            {"key": key, "expires_at": {"$gt": datetime.utcnow()}}, limit=1
+        ) > 0
+
+    async def confirm(self, reservation: Dict) -> Optional[int]:
+        """
+        Check the object arrived with the declared size and retire the reservation
+
+        Returns the size, or None if nothing has been uploaded yet (or another
+        request registered it first). A size mismatch deletes the object and
+        raises ValueError.
+        """
+        size = await self.storage.size_of(reservation["key"])
+        if size is None:
+            return None
+        if size != reservation["size"]:
+            self.size_mismatches += 1
+            await self.storage.delete(reservation["key"])
+            await self.collection.delete_one({"key": reservation["key"]})
+            raise ValueError(f"Uploaded {size} bytes, {reservation['size']} were declared")
+        result = await self.collection.delete_one({"key": reservation["key"]})
+        if not result.deleted_count:
+            # Registered concurrently by another request
+            return None
+        self.registered += 1
+        return size
+
+    async def expire(self) -> int:
+        stale = await self.collection.find(
+            {"expires_at": {"$lte": datetime.utcnow()}}, {"_id": 0, "key": 1}
+        ).to_list(1000)
+        for reservation in stale:
+            await self.storage.delete(reservation["key"])
+            await self.collection.delete_one({"key": reservation["key"]})
+        self.expired += len(stale)
+        return len(stale)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await self.expire()
+                if expired:
+                    logger.info(f"Removed {expired} unregistered direct uploads")
+            except Exception as e:
+                logger.error(f"Direct upload sweep failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.storage.name,
+            "presigned": self.presigned,
+            "registered": self.registered,
+            "size_mismatches": self.size_mismatches,
+            "expired": self.expired,
+        }
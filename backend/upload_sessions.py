@@ -0,0 +1,297 @@
+"""
+Resumable upload sessions
+A file arrives as a series of offset-addressed chunks appended to a partial file on disk
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from starlette.requests import ClientDisconnect
+
+from blob_store import Blob, BlobStore
+from file_crypto import FileCipher
+from upload_writer import UploadTooLarge, UploadWriter
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetMismatch(Exception):
+    """The chunk does not start where the session currently ends"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class SessionBusy(Exception):
+    """Another request is already writing to this session"""
+
+
+async def until_disconnect(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """End the stream quietly when the client drops, keeping what already arrived"""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except ClientDisconnect:
+        return
+
+
+class UploadSessionStore:
+    """
+    upload_sessions documents: {id, user_id, conversation_id, receiver_id, platform,
+    filename, size, offset, part_key, created_at, expires_at, lease, lease_until}
+
+    The stored offset only moves after the bytes are on disk, so it is always
+    safe to resume from. Each chunk pushes expires_at forward; sessions idle
+    past the TTL are removed together with their partial file.
+
+    Writes take a lease on the session document, so two workers never append
+    to the same partial file at once. A lease outlived by its request (e.g.
+    a stalled client) lapses after lease_seconds; the late writer then finds
+    the offset moved, drops what it wrote and reports the recorded offset.
+
+    Sessions created with encrypt=True keep their partial file under a
+    per-session AES-CTR key (part_key names the ring key it derives from);
+    completion re-seals the plaintext stream as an encrypted blob, so those
+    bytes never sit on disk in the clear.
+    """
+
+    def __init__(self, db, root: Path, writer: UploadWriter, blob_store: BlobStore,
+                 cipher: Optional[FileCipher] = None, ttl_seconds: float = 86400.0, sweep_interval: float = 600.0,
+                 lease_seconds: float = 900.0):
+        self.collection = db.upload_sessions
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.writer = writer
+        self.blob_store = blob_store
+        self.cipher = cipher
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self.lease_seconds = lease_seconds
+        self.writing = 0
+        self._task: Optional[asyncio.Task] = None
+
+        self.created = 0
+        self.chunks = 0
+        self.completed = 0
+        self.expired = 0
+        self.lost_leases = 0
+
+    def part_path(self, session_id: str) -> Path:
+        return self.root / f"{session_id}.part"
+
+    def _expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+
+    async def create(self, user_id: str, conversation_id: str, receiver_id: str, platform: str,
+                     filename: str, size: int, encrypt: bool = False) -> Dict:
+        if encrypt and self.cipher is None:
+            raise RuntimeError("Encrypted upload sessions need a FileCipher")
+        if size > self.writer.max_bytes:
+            self.writer.metrics.rejected_too_large += 1
+            raise UploadTooLarge(self.writer.max_bytes)
+        now = datetime.utcnow()
+        session = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "receiver_id": receiver_id,
+            "platform": platform,
+            "filename": filename,
+            "size": size,
+            "offset": 0,
+            "part_key": self.cipher.key_ring.current_id if encrypt else None,
+            "created_at": now,
+            "expires_at": self._expiry(),
+        }
+        await self.collection.insert_one(dict(session))
+        self.created += 1
+        return session
+
+    async def get(self, session_id: str, user_id: str) -> Optional[Dict]:
+        return await self.collection.find_one(
+            {"id": session_id, "user_id": user_id, "expires_at": {"$gt": datetime.utcnow()}},
+            {"_id": 0}
+        )
+
+    @staticmethod
+    def _unleased(now: datetime) -> Dict:
+        return {"$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]}
+
+    async def _acquire(self, session_id: str) -> Tuple[str, Dict]:
+        """Take the write lease; returns (lease, session as stored) or raises SessionBusy"""
+        now = datetime.utcnow()
+        lease = uuid.uuid4().hex
+        current = await self.collection.find_one_and_update(
+            {"id": session_id, **self._unleased(now)},
+            {"$set": {"lease": lease, "lease_until": now + timedelta(seconds=self.lease_seconds)}},
+            projection={"_id": 0}
+        )
+        if current is None:
+            raise SessionBusy()
+        return lease, current
+
+    async def _release(self, session_id: str, lease: str):
+        await self.collection.update_one(
+            {"id": session_id, "lease": lease}, {"$unset": {"lease": "", "lease_until": ""}}
+        )
+
+    @staticmethod
+    def _truncate(path: Path, size: int):
+        """Cut a partial file back to `size`; never extends it"""
+        try:
+            if path.stat().st_size > size:
+                os.truncate(path, size)
+        except FileNotFoundError:
+            pass
+
+    async def _discard_unrecorded(self, session_id: str, path: Path) -> int:
+        """After losing the lease: drop bytes past the recorded offset; returns that offset"""
+        try:
+            lease, current = await self._acquire(session_id)
+        except SessionBusy:
+            # The new holder truncates to the recorded offset when it opens the file
+            current = await self.collection.find_one({"id": session_id}, {"_id": 0, "offset": 1})
+            return current["offset"] if current else 0
+        try:
+            await self.writer.run_in_pool(self._truncate, path, current["offset"])
+            return current["offset"]
+        finally:
+            await self._release(session_id, lease)
+
+    async def write_chunk(self, session: Dict, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """Append a chunk at `offset`; returns the new offset"""
+        if offset != session["offset"]:
+            raise OffsetMismatch(session["offset"])
+        lease, current = await self._acquire(session["id"])
+        self.writing += 1
+        try:
+            # Another worker may have moved the session since it was read
+            if offset != current["offset"]:
+                session["offset"] = current["offset"]
+                raise OffsetMismatch(current["offset"])
+            path = self.part_path(session["id"])
+            try:
+                transform = None
+                if session.get("part_key"):
+                    transform = self.cipher.part_stream(session["part_key"], session["id"], offset)
+                written = await self.writer.append(
+                    until_disconnect(chunks), path, offset, session["size"], transform
+                )
+            except ValueError:
+                # The partial file is shorter than recorded (lost or replaced); resume from what is there
+                actual = await self.writer.run_in_pool(self._size_of, path)
+                await self.collection.update_one(
+                    {"id": session["id"], "lease": lease}, {"$set": {"offset": actual}}
+                )
+                raise OffsetMismatch(actual)
+
+            new_offset = offset + written
+            result = await self.collection.update_one(
+                {"id": session["id"], "offset": offset, "lease": lease},
+                {"$set": {"offset": new_offset, "expires_at": self._expiry()}}
+            )
+            if result.matched_count == 0:
+                # The lease lapsed mid-write; these bytes were never acknowledged
+                self.lost_leases += 1
+                recorded = await self._discard_unrecorded(session["id"], path)
+                session["offset"] = recorded
+                raise OffsetMismatch(recorded)
+            session["offset"] = new_offset
+            self.chunks += 1
+            return new_offset
+        finally:
+            self.writing -= 1
+            await self._release(session["id"], lease)
+
+    async def complete(self, session: Dict, encrypt: bool = False) -> Blob:
+        """Move the assembled file into the blob store and close the session"""
+        if session["offset"] != session["size"]:
+            raise OffsetMismatch(session["offset"])
+        lease, current = await self._acquire(session["id"])
+        try:
+            if current["offset"] != session["size"]:
+                raise OffsetMismatch(current["offset"])
+            path = self.part_path(session["id"])
+            if session["size"] == 0:
+                await self.writer.run_in_pool(path.touch)
+            # Only acknowledged bytes go into the blob
+            await self.writer.run_in_pool(self._truncate, path, session["size"])
+            opener = None
+            if session.get("part_key"):
+                opener = self.cipher.part_opener(session["part_key"], session["id"])
+            blob = await self.blob_store.store_file(path, Path(session["filename"]).suffix, encrypt, opener)
+            await self.collection.delete_one({"id": session["id"]})
+            self.completed += 1
+            return blob
+        finally:
+            await self._release(session["id"], lease)
+
+    async def abort(self, session: Dict):
+        await self.collection.delete_one({"id": session["id"]})
+        await self.writer.run_in_pool(self._discard, self.part_path(session["id"]))
+
+    @staticmethod
+    def _size_of(path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _discard(path: Path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    async def expire(self) -> int:
+        """Remove sessions idle past the TTL and their partial files"""
+        now = datetime.utcnow()
+        stale = await self.collection.find(
+            {"expires_at": {"$lte": now}}, {"_id": 0, "id": 1}
+        ).to_list(1000)
+        expired = 0
+        for session in stale:
+            # A session with a live lease is being written to right now
+            result = await self.collection.delete_one(
+                {"id": session["id"], "expires_at": {"$lte": now}, **self._unleased(now)}
+            )
+            if result.deleted_count:
+                await self.writer.run_in_pool(self._discard, self.part_path(session["id"]))
+                expired += 1
+        self.expired += expired
+        return expired
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await self.expire()
+                if expired:
+                    logger.info(f"Expired {expired} stale upload sessions")
+            except Exception as e:
+                logger.error(f"Upload session sweep failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "created": self.created,
+            "chunks": self.chunks,
+            "completed": self.completed,
+            "expired": self.expired,
+            "writing": self.writing,
+            "lost_leases": self.lost_leases,
+        }
@@ -0,0 +1,278 @@
+"""
+Streaming upload writer
+Chunks are written and hashed on a thread pool so large uploads never block the event loop
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"Upload exceeds the {limit} byte limit")
+        self.limit = limit
+
+
+class UploadResult(NamedTuple):
+    path: Optional[Path]
+    size: int
+    sha256: str
+
+
+class UploadMetrics:
+    """Worker-wide upload counters"""
+
+    def __init__(self):
+        self.uploads = 0
+        self.bytes_written = 0
+        self.rejected_too_large = 0
+        self.failures = 0
+        self.write_seconds = 0.0
+        self.peak_mb_per_s = 0.0
+
+    def record(self, size: int, seconds: float):
+        self.uploads += 1
+        self.bytes_written += size
+        self.write_seconds += seconds
+        if seconds > 0 and size >= 1024 * 1024:
+            self.peak_mb_per_s = max(self.peak_mb_per_s, size / seconds / 1e6)
+
+    def snapshot(self) -> Dict:
+        return {
+            "uploads": self.uploads,
+            "bytes_written": self.bytes_written,
+            "rejected_too_large": self.rejected_too_large,
+            "failures": self.failures,
+            "avg_mb_per_s": round(self.bytes_written / self.write_seconds / 1e6, 2) if self.write_seconds else 0.0,
+            "peak_mb_per_s": round(self.peak_mb_per_s, 2),
+        }
+
+
+async def iter_upload(upload, chunk_size: int) -> AsyncIterator[bytes]:
+    """Read a Starlette UploadFile (spooled to memory or disk) chunk by chunk"""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class UploadWriter:
+    """
+    Write an async byte stream to disk in chunks
+
+    Data lands in a temporary file next to the destination and is renamed into
+    place only once complete, so readers never see a partial file.
+    """
+
+    def __init__(self, max_bytes: int, chunk_size: int = 1024 * 1024, max_workers: int = 4):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self.metrics = UploadMetrics()
+
+    async def run_in_pool(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    @staticmethod
+    def _write_chunk(handle: BinaryIO, hasher, chunk: bytes, transform=None):
+        hasher.update(chunk)
+        handle.write(transform.update(chunk) if transform is not None else chunk)
+
+    async def write(self, chunks: AsyncIterator[bytes], destination: Path,
+                    expected_size: Optional[int] = None, transform=None) -> UploadResult:
+        """
+        `transform` (e.g. a ChunkEncryptor) rewrites the bytes on their way to disk:
+        update(chunk) -> bytes per chunk, finalize() -> bytes at the end. Size and
+        hash always describe the original bytes.
+        """
+        if expected_size is not None and expected_size > self.max_bytes:
+            self.metrics.rejected_too_large += 1
+            raise UploadTooLarge(self.max_bytes)
+
+        temp_path = destination.parent / f".{uuid.uuid4().hex}.part"
+        hasher = hashlib.sha256()
+        size = 0
+        started = time.perf_counter()
+        handle = await self.run_in_pool(open, temp_path, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_bytes:
+                    self.metrics.rejected_too_large += 1
+                    raise UploadTooLarge(self.max_bytes)
+                await self.run_in_pool(self._write_chunk, handle, hasher, chunk, transform)
+            if transform is not None:
+                await self.run_in_pool(lambda: handle.write(transform.finalize()))
+            await self.run_in_pool(handle.close)
+            await self.run_in_pool(os.replace, temp_path, destination)
+        except BaseException as e:
+            if not isinstance(e, UploadTooLarge):
+                self.metrics.failures += 1
+            await self.run_in_pool(handle.close)
+            await self.run_in_pool(self._discard, temp_path)
+            raise
+
+        self.metrics.record(size, time.perf_counter() - started)
+        return UploadResult(destination, size, hasher.hexdigest())
+
+    async def write_upload(self, upload, destination: Path, transform=None) -> UploadResult:
+        return await self.write(iter_upload(upload, self.chunk_size), destination, upload.size, transform)
+
+    async def digest_upload(self, upload) -> UploadResult:
+        """Size and SHA-256 of an UploadFile without writing it anywhere; rewinds it afterwards"""
+        if upload.size is not None and upload.size > self.max_bytes:
+            self.metrics.rejected_too_large += 1
+            raise UploadTooLarge(self.max_bytes)
+        hasher = hashlib.sha256()
+        size = 0
+        async for chunk in iter_upload(upload, self.chunk_size):
+            size += len(chunk)
+            if size > self.max_bytes:
+                self.metrics.rejected_too_large += 1
+                raise UploadTooLarge(self.max_bytes)
+            await self.run_in_pool(hasher.update, chunk)
+        await upload.seek(0)
+        return UploadResult(None, size, hasher.hexdigest())
+
+    @staticmethod
+    def _open_at(path: Path, offset: int) -> BinaryIO:
+        handle = open(path, "r+b" if path.exists() else "wb")
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() < offset:
+            handle.close()
+            raise ValueError(f"{path.name} holds fewer than {offset} bytes")
+        # Bytes past the offset were never acknowledged; the client sends them again
+        handle.truncate(offset)
+        handle.seek(offset)
+        return handle
+
+    async def append(self, chunks: AsyncIterator[bytes], path: Path, offset: int, limit: int,
+                     transform=None) -> int:
+        """
+        Write a stream into a partial file at `offset`; returns the bytes written
+
+        `limit` is the final size the file may reach. Whatever arrived before a
+        failure stays on disk, so the caller decides how much to acknowledge.
+        `transform` (e.g. a PartStream) must keep every byte at its offset.
+        """
+        handle = await self.run_in_pool(self._open_at, path, offset)
+        written = 0
+        started = time.perf_counter()
+        try:
+            async for chunk in chunks:
+                if offset + written + len(chunk) > limit:
+                    self.metrics.rejected_too_large += 1
+                    raise UploadTooLarge(limit)
+                await self.run_in_pool(handle.write, transform.update(chunk) if transform else chunk)
+                written += len(chunk)
+        except BaseException as e:
+            if not isinstance(e, UploadTooLarge):
+                self.metrics.failures += 1
+            raise
+        finally:
+            await self.run_in_pool(handle.close)
+
+        self.metrics.record(written, time.perf_counter() - started)
+        return written
+
+    @staticmethod
+    def _hash_file(path: Path, chunk_size: int, opener=None) -> UploadResult:
+        hasher = hashlib.sha256()
+        size = 0
+        with (opener or open)(path, "rb") as handle:
+            while True:
+                chunk = handle.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                hasher.update(chunk)
+        return UploadResult(path, size, hasher.hexdigest())
+
+    async def digest_file(self, path: Path, opener=None) -> UploadResult:
+        return await self.run_in_pool(self._hash_file, path, self.chunk_size, opener)
+
+    @staticmethod
+    def _discard(path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict:
+        return self.metrics.snapshot()
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware that caps multipart upload bodies before they are spooled
+
+    Starlette parses the whole form into a spooled temp file before the route
+    runs, so UploadWriter's checks alone still let an oversized body land on
+    disk. A declared Content-Length over the cap is refused without reading
+    anything; otherwise bytes are counted as they arrive and the request is
+    cut off with 413 once it passes the cap. `overhead` leaves room for the
+    multipart boundaries and the other form fields.
+    """
+
+    def __init__(self, app, max_bytes: int, paths, metrics: Optional[UploadMetrics] = None,
+                 overhead: int = 64 * 1024):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+        self.metrics = metrics
+        self.overhead = overhead
+
+    async def _reject(self, send):
+        if self.metrics is not None:
+            self.metrics.rejected_too_large += 1
+        body = json.dumps({"detail": str(UploadTooLarge(self.max_bytes))}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        cap = self.max_bytes + self.overhead
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > cap:
+            await self._reject(send)
+            return
+
+        received = 0
+        rejected = False
+
+        async def capped_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > cap:
+                    rejected = True
+                    await self._reject(send)
+                    # The form parser sees a disconnect and gives up on the body
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            # Once the 413 is out, whatever the app answers to the disconnect is dropped
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, capped_receive, guarded_send)
@@ -0,0 +1,199 @@
+"""
+WebSocket wire protocol
+Negotiates JSON text or MessagePack binary frames and builds the slim event schema
+"""
+import json
+import logging
+import uuid
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency: binary framing is disabled without it
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # Optional dependency: falls back to the stdlib encoder
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_SUBPROTOCOL = "whatgram.msgpack"
+JSON_SUBPROTOCOL = "whatgram.json"
+
+
+def _default(value):
+    """Types the stdlib and msgpack encoders do not handle natively"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, event: Any) -> str:
+        if orjson is not None:
+            return orjson.dumps(event, default=_default).decode()
+        return json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, event: Any) -> bytes:
+        return msgpack.packb(event, use_bin_type=True, default=_default)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            # Control frames from simple clients may still arrive as JSON text
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+def negotiate_codec(subprotocols, encoding: Optional[str] = None):
+    """
+    Pick the codec for a new socket
+
+    Clients opt into binary frames with the `whatgram.msgpack` subprotocol or
+    `?encoding=msgpack`. Returns (codec, subprotocol to echo in the handshake).
+    """
+    subprotocols = list(subprotocols or [])
+    wants_msgpack = MSGPACK_SUBPROTOCOL in subprotocols or encoding == "msgpack"
+    if wants_msgpack and MSGPACK_CODEC is not None:
+        return MSGPACK_CODEC, MSGPACK_SUBPROTOCOL if MSGPACK_SUBPROTOCOL in subprotocols else None
+    if wants_msgpack:
+        logger.warning("Client requested MessagePack but msgpack is not installed; using JSON")
+    return JSON_CODEC, JSON_SUBPROTOCOL if JSON_SUBPROTOCOL in subprotocols else None
+
+
+def _plain(value):
+    try:
+        return _default(value)
+    except TypeError:
+        return value
+
+
+def slim_file(file_message) -> Optional[Dict]:
+    if file_message is None:
+        return None
+    return {
+        "id": file_message.id,
+        "filename": file_message.filename,
+        "original_name": file_message.original_name,
+        "file_path": file_message.file_path,
+        "file_size": file_message.file_size,
+        "mime_type": file_message.mime_type,
+        "thumbnail_path": file_message.thumbnail_path,
+        "duration_ms": file_message.duration_ms,
+        "waveform": file_message.waveform,
+    }
+
+
+def message_event(event_type: str, message, content: Optional[str] = None,
+                  language: Optional[str] = None) -> Dict:
+    """
+    Event for one recipient: only the content in their language, no translation map,
+    ciphertext or delivery flags
+    """
+    event = {
+        "type": event_type,
+        "conversation_id": message.conversation_id,
+        "message": {
+            "id": message.id,
+            "sender_id": message.sender_id,
+            "receiver_id": message.receiver_id,
+            "content": content if content is not None else message.content,
+            "platform": _plain(message.platform),
+            "timestamp": _plain(message.timestamp),
+            "message_type": message.message_type,
+            "original_language": message.original_language,
+            "file_message": slim_file(message.file_message),
+        },
+    }
+    if language is not None:
+        event["translated_for"] = language
+    return event
+
+
+class EventTemplate:
+    """
+    Serialize-once event for fan-out
+
+    The part shared by all recipients is encoded once per codec with
+    placeholders, then each language's content is spliced in; the resulting
+    frames are cached per (codec, language, content).
+    """
+
+    _CONTENT = f"__wg_content_{uuid.uuid4().hex}__"
+    _LANGUAGE = f"__wg_language_{uuid.uuid4().hex}__"
+
+    def __init__(self, event_type: str, message):
+        self.event_type = event_type
+        self.message = message
+        self._skeletons: Dict[Tuple[str, bool], Tuple[Any, Any, Any]] = {}
+        self._frames: Dict[Tuple[str, Optional[str], Optional[str]], Union[str, bytes]] = {}
+        self.encodes = 0
+
+    def _skeleton(self, codec, translated: bool):
+        # Untranslated events have no translated_for key at all, so they get a skeleton of their own
+        skeleton = self._skeletons.get((codec.name, translated))
+        if skeleton is None:
+            language = self._LANGUAGE if translated else None
+            envelope = codec.encode(message_event(self.event_type, self.message, self._CONTENT, language))
+            head, rest = envelope.split(codec.encode(self._CONTENT), 1)
+            middle, tail = rest.split(codec.encode(self._LANGUAGE), 1) if translated else (rest, rest[:0])
+            skeleton = self._skeletons[(codec.name, translated)] = (head, middle, tail)
+            self.encodes += 1
+        return skeleton
+
+    def render(self, codec, content: Optional[str], language: Optional[str]) -> Union[str, bytes]:
+        if content is None:
+            content = self.message.content
+        key = (codec.name, language, content)
+        frame = self._frames.get(key)
+        if frame is None:
+            head, middle, tail = self._skeleton(codec, language is not None)
+            frame = head + codec.encode(content) + middle
+            if language is not None:
+                frame += codec.encode(language)
+            frame += tail
+            self._frames[key] = frame
+        return frame
+
+    def for_recipient(self, content: Optional[str], language: Optional[str]) -> "SplicedFrame":
+        return SplicedFrame(self, content, language)
+
+
+class SplicedFrame:
+    """One recipient's view of an EventTemplate; encoded lazily with the socket's codec"""
+
+    __slots__ = ("template", "content", "language")
+
+    def __init__(self, template: EventTemplate, content: Optional[str], language: Optional[str]):
+        self.template = template
+        self.content = content
+        self.language = language
+
+    def render(self, codec) -> Union[str, bytes]:
+        return self.template.render(codec, self.content, self.language)
+
+    def to_event(self) -> Dict:
+        """Plain event dict, for transports that cannot carry the template (e.g. a broker)"""
+        return message_event(self.template.event_type, self.template.message, self.content, self.language)
@@ -108,6 +108,44 @@ const LanguageSettingsModal = ({ isOpen, onClose, currentUser, token, onLanguage
   );
 };
 
+// Files are only served to conversation participants, so they are fetched with the token
+const fetchFileUrl = async (path, token) => {
+  const response = await axios.get(`${BACKEND_URL}${path}`, {
+    headers: { Authorization: `Bearer ${token}` },
+    responseType: 'blob'
+  });
+  return URL.createObjectURL(response.data);
+};
+
+// Authorized Image Component
+const AuthorizedImage = ({ path, token, alt, className, onClick }) => {
+  const [src, setSrc] = useState(null);
+
+  useEffect(() => {
+    let objectUrl = null;
+    let cancelled = false;
+    fetchFileUrl(path, token)
+      .then((url) => {
+        objectUrl = url;
+        if (cancelled) {
+          URL.revokeObjectURL(url);
+        } else {
+          setSrc(url);
+        }
+      })
+      .catch((error) => console.error('Error loading image:', error));
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [path, token]);
+
+  if (!src) {
+    return <div className={`${className} bg-gray-200 w-48 h-32 animate-pulse`} />;
+  }
+  return <img src={src} alt={alt} className={className} onClick={onClick} />;
+};
+
 // Message Translation Component
 const MessageTranslation = ({ message, userLanguage, token }) => {
   const [showTranslation, setShowTranslation] = useState(false);
@@ -591,6 +629,8 @@ const App = () => {
   const fileInputRef = useRef(null);
   const messagesEndRef = useRef(null);
   const ws = useRef(null);
+  const wsRetries = useRef(0);
+  const wsReconnect = useRef(null);
 
   // Translation helper
   const t = (key, params) => getTranslation(key, interfaceLanguage, params);
@@ -641,15 +681,35 @@ const App = () => {
   const setupWebSocket = () => {
     if (user && !ws.current) {
       try {
-        ws.current = new WebSocket(`${BACKEND_URL.replace('http', 'ws')}/ws/${user.id}`);
+        const socket = new WebSocket(`${BACKEND_URL.replace('http', 'ws')}/ws/${user.id}?token=${encodeURIComponent(token)}`);
+        ws.current = socket;
         
-        ws.current.onmessage = (event) => {
+        socket.onopen = () => {
+          wsRetries.current = 0;
+        };
+        
+        socket.onmessage = (event) => {
           const data = JSON.parse(event.data);
+          // The server closes sockets that stay silent, so answer its heartbeat
+          if (data.type === 'ping') {
+            socket.send(JSON.stringify({ type: 'pong', ts: data.ts }));
+            return;
+          }
           if (data.type === 'new_message' || data.type === 'new_file') {
             loadMessages();
             loadContent();
           }
         };
+        
+        socket.onclose = () => {
+          // Closed on purpose (logout) or already replaced
+          if (ws.current !== socket) return;
+          ws.current = null;
+          // Reconnect with exponential backoff, capped at 30 seconds
+          const delay = Math.min(1000 * 2 ** wsRetries.current, 30000);
+          wsRetries.current += 1;
+          wsReconnect.current = setTimeout(setupWebSocket, delay);
+        };
       } catch (error) {
         console.log('WebSocket connection failed:', error);
       }
@@ -685,9 +745,11 @@ const App = () => {
     setToken(null);
     setUser(null);
     setShowAuth(true);
+    clearTimeout(wsReconnect.current);
     if (ws.current) {
-      ws.current.close();
+      const socket = ws.current;
       ws.current = null;
+      socket.close();
     }
   };
 
@@ -905,21 +967,36 @@ const App = () => {
     return mimeType && mimeType.startsWith('image/');
   };
 
+  const openFile = async (path) => {
+    // Open the tab synchronously so popup blockers allow it, then point it at the blob
+    const fileWindow = window.open('', '_blank');
+    try {
+      const url = await fetchFileUrl(path, token);
+      if (fileWindow) {
+        fileWindow.location.href = url;
+      }
+    } catch (error) {
+      console.error('Error opening file:', error);
+      if (fileWindow) fileWindow.close();
+    }
+  };
+
   const renderFileMessage = (fileMessage) => {
     const isImage = isImageFile(fileMessage.mime_type);
     
     return (
       <div className="file-message">
         {isImage ? (
-          <img
-            src={`${BACKEND_URL}${fileMessage.file_path}`}
+          <AuthorizedImage
+            path={fileMessage.file_path}
+            token={token}
             alt={fileMessage.original_name}
             className="max-w-xs max-h-64 rounded-lg cursor-pointer"
-            onClick={() => window.open(`${BACKEND_URL}${fileMessage.file_path}`, '_blank')}
+            onClick={() => openFile(fileMessage.file_path)}
           />
         ) : (
           <div className="flex items-center p-3 bg-gray-100 rounded-lg cursor-pointer hover:bg-gray-200"
-               onClick={() => window.open(`${BACKEND_URL}${fileMessage.file_path}`, '_blank')}>
+               onClick={() => openFile(fileMessage.file_path)}>
             <div className="flex-shrink-0 w-10 h-10 bg-blue-500 rounded-lg flex items-center justify-center mr-3">
               <span className="text-white text-xs font-bold">
                 {fileMessage.original_name.split('.').pop()?.toUpperCase() || 'FILE'}
@@ -1354,7 +1431,7 @@ const App = () => {
                           }`}>
                             {formatTime(message.timestamp)}
                           </p>
-                          {message.encrypted_content && (
+                          {(message.is_encrypted || message.encrypted_content) && (
                             <span className="text-xs">🔒</span>
                           )}
                         </div>
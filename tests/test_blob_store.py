@@ -0,0 +1,74 @@
+"""
+Blob removal must not touch the other copy of the same bytes
+"""
+import hashlib
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from blob_store import BlobStore  # noqa: E402
+from media_variants import variant_filename  # noqa: E402
+
+
+def make_store(root):
+    return BlobStore(SimpleNamespace(blobs=None), root, writer=None)
+
+
+def write_blob(root, filename, sizes=("medium", "thumb")):
+    (root / filename).write_bytes(b"blob")
+    for size in sizes:
+        (root / variant_filename(filename, size)).write_bytes(b"variant")
+
+
+def test_removing_plaintext_blob_keeps_encrypted_copy(tmp_path):
+    content_hash = hashlib.sha256(b"same bytes").hexdigest()
+    plain = f"{content_hash}.jpg"
+    encrypted = f"{content_hash}.wge.jpg"
+    write_blob(tmp_path, plain)
+    write_blob(tmp_path, encrypted)
+
+    make_store(tmp_path)._remove(plain)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([
+        encrypted,
+        variant_filename(encrypted, "medium"),
+        variant_filename(encrypted, "thumb"),
+    ])
+
+
+def test_removing_encrypted_blob_keeps_plaintext_copy(tmp_path):
+    content_hash = hashlib.sha256(b"same bytes").hexdigest()
+    plain = f"{content_hash}.jpg"
+    encrypted = f"{content_hash}.wge.jpg"
+    write_blob(tmp_path, plain)
+    write_blob(tmp_path, encrypted)
+
+    make_store(tmp_path)._remove(encrypted)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([
+        plain,
+        variant_filename(plain, "medium"),
+        variant_filename(plain, "thumb"),
+    ])
+
+
+def test_remove_tolerates_missing_variants(tmp_path):
+    filename = f"{hashlib.sha256(b'no variants').hexdigest()}.pdf"
+    write_blob(tmp_path, filename, sizes=())
+
+    make_store(tmp_path)._remove(filename)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_new_blob_names_are_opaque():
+    plain = BlobStore._filename(".JPG", encrypted=False)
+    encrypted = BlobStore._filename(".jpg", encrypted=True)
+
+    assert plain.endswith(".jpg") and len(plain) == 32 + len(".jpg")
+    assert encrypted.split(".")[1:] == ["wge", "jpg"]
+    assert plain.split(".")[0] != encrypted.split(".")[0]
+    # An upload literally named *.wge must not pass for an encrypted blob
+    assert BlobStore._filename(".wge", encrypted=False).count(".") == 0
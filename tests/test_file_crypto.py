@@ -0,0 +1,150 @@
+"""
+Chunked attachment encryption: round trips, tampering, random access and upload part files
+"""
+import io
+import os
+import sys
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from file_crypto import FileCipher, InvalidEncryptedFile, TAG_SIZE  # noqa: E402
+from key_ring import KeyRing  # noqa: E402
+
+CHUNK = 1000
+FILE_ID = bytes(range(16))
+
+
+@pytest.fixture
+def cipher():
+    return FileCipher(KeyRing({"k1": os.urandom(32)}, "k1"), chunk_size=CHUNK)
+
+
+def encrypt(cipher, data, feed=333):
+    encryptor = cipher.encryptor(FILE_ID)
+    out = [encryptor.update(data[start:start + feed]) for start in range(0, len(data), feed)]
+    out.append(encryptor.finalize())
+    return b"".join(out), len(encryptor.header)
+
+
+def write(tmp_path, name, blob):
+    path = tmp_path / name
+    path.write_bytes(blob)
+    return path
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 5 * CHUNK + 17])
+def test_round_trip(cipher, tmp_path, size):
+    data = os.urandom(size)
+    blob, _ = encrypt(cipher, data)
+    reader = cipher.open(write(tmp_path, "f.wge.bin", blob))
+    try:
+        assert reader.size == size
+        assert reader.read_all() == data
+    finally:
+        reader.close()
+    # Short plaintexts turn up in random ciphertext by chance
+    assert size < 16 or data not in blob
+
+
+def test_same_plaintext_and_file_id_encrypt_identically(cipher):
+    data = os.urandom(3 * CHUNK)
+    assert encrypt(cipher, data, feed=100)[0] == encrypt(cipher, data, feed=CHUNK * 2)[0]
+
+
+def chunks(blob, header_size):
+    body = blob[header_size:]
+    step = CHUNK + TAG_SIZE
+    return [body[start:start + step] for start in range(0, len(body), step)]
+
+
+def test_dropping_the_last_chunk_is_detected(cipher, tmp_path):
+    blob, header_size = encrypt(cipher, os.urandom(3 * CHUNK + 10))
+    truncated = blob[:header_size] + b"".join(chunks(blob, header_size)[:-1])
+    reader = cipher.open(write(tmp_path, "f.wge.bin", truncated))
+    with pytest.raises(InvalidTag):
+        reader.read_all()
+    reader.close()
+
+
+def test_cutting_a_chunk_short_is_detected(cipher, tmp_path):
+    blob, _ = encrypt(cipher, os.urandom(3 * CHUNK + 10))
+    reader = cipher.open(write(tmp_path, "f.wge.bin", blob[:-5]))
+    with pytest.raises(InvalidTag):
+        reader.read_all()
+    reader.close()
+
+
+def test_truncated_header_is_rejected(cipher, tmp_path):
+    blob, header_size = encrypt(cipher, b"short")
+    with pytest.raises(InvalidEncryptedFile):
+        cipher.open(write(tmp_path, "f.wge.bin", blob[:header_size - 3]))
+    with pytest.raises(InvalidEncryptedFile):
+        cipher.open(write(tmp_path, "plain.bin", b"not encrypted at all"))
+
+
+def test_reordered_chunks_are_detected(cipher, tmp_path):
+    data = os.urandom(3 * CHUNK + 10)
+    blob, header_size = encrypt(cipher, data)
+    parts = chunks(blob, header_size)
+    parts[0], parts[1] = parts[1], parts[0]
+    reader = cipher.open(write(tmp_path, "f.wge.bin", blob[:header_size] + b"".join(parts)))
+    with pytest.raises(InvalidTag):
+        reader.read_chunk(0)
+    with pytest.raises(InvalidTag):
+        reader.read_chunk(1)
+    # Chunks that stayed in place still decrypt on their own
+    assert reader.read_chunk(2) == data[2 * CHUNK:3 * CHUNK]
+    reader.close()
+
+
+def test_random_access(cipher, tmp_path):
+    data = os.urandom(4 * CHUNK + 123)
+    blob, _ = encrypt(cipher, data)
+    reader = cipher.open(write(tmp_path, "f.wge.bin", blob))
+    try:
+        assert reader.chunk_count == 5
+        assert reader.read_chunk(3) == data[3 * CHUNK:4 * CHUNK]
+        assert reader.read_chunk(4) == data[4 * CHUNK:]
+        # read_at never crosses a chunk boundary
+        assert reader.read_at(CHUNK - 10, 50) == data[CHUNK - 10:CHUNK]
+        assert reader.read_at(2 * CHUNK + 5, 20) == data[2 * CHUNK + 5:2 * CHUNK + 25]
+    finally:
+        reader.close()
+
+
+def test_plaintext_stream_seeks_across_chunks(cipher, tmp_path):
+    data = os.urandom(4 * CHUNK + 123)
+    path = tmp_path / "f.wge.bin"
+    cipher.write_bytes(data, path, FILE_ID)
+    with cipher.plaintext(path) as stream:
+        assert stream.read(CHUNK + 10) == data[:CHUNK + 10]
+        stream.seek(3 * CHUNK - 7)
+        assert stream.read(20) == data[3 * CHUNK - 7:3 * CHUNK + 13]
+        stream.seek(-5, io.SEEK_END)
+        assert stream.read() == data[-5:]
+        assert stream.read(10) == b""
+
+
+@pytest.mark.parametrize("offset", [0, 1, 15, 16, 17, 1000])
+def test_part_stream_resumes_at_any_offset(cipher, offset):
+    data = os.urandom(2000)
+    whole = cipher.part_stream("k1", "session", 0).update(data)
+    resumed = cipher.part_stream("k1", "session", offset).update(data[offset:])
+    assert resumed == whole[offset:]
+    assert cipher.part_stream("k1", "other session", 0).update(data) != whole
+
+
+def test_part_opener_reads_back_plaintext(cipher, tmp_path):
+    data = os.urandom(3000)
+    path = tmp_path / "upload.part"
+    # Written in two appends, the way a resumed upload arrives
+    path.write_bytes(
+        cipher.part_stream("k1", "session", 0).update(data[:1234])
+        + cipher.part_stream("k1", "session", 1234).update(data[1234:])
+    )
+    assert data not in path.read_bytes()
+    with cipher.part_opener("k1", "session")(path) as reader:
+        assert reader.read(100) + reader.read() == data
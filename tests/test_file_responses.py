@@ -0,0 +1,149 @@
+"""
+Byte ranges and revalidation for stored file downloads, plaintext and encrypted
+"""
+import os
+import sys
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from file_crypto import FileCipher  # noqa: E402
+from file_responses import FileServer, RangeNotSatisfiable, etag_matches, parse_range  # noqa: E402
+from key_ring import KeyRing  # noqa: E402
+
+SIZE = 1000
+BLOB_ID = "0123456789abcdef0123456789abcdef"
+DATA = bytes(range(256)) * 3 + bytes(SIZE - 768)
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-99", SIZE, (0, 99)),
+    ("bytes=0-0", SIZE, (0, 0)),
+    ("bytes=990-2000", SIZE, (990, 999)),
+    # Open-ended
+    ("bytes=500-", SIZE, (500, 999)),
+    ("bytes=999-", SIZE, (999, 999)),
+    # Suffix: the last N bytes, all of them when N exceeds the size
+    ("bytes=-100", SIZE, (900, 999)),
+    ("bytes=-5000", SIZE, (0, 999)),
+    (" Bytes = 10-20", SIZE, (10, 20)),
+    # Ignored: the whole file is sent
+    ("bytes=0-1,5-6", SIZE, None),
+    ("items=0-1", SIZE, None),
+    ("bytes=10", SIZE, None),
+    ("bytes=a-b", SIZE, None),
+    ("bytes=20-10", SIZE, None),
+])
+def test_parse_range(header, size, expected):
+    assert parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", SIZE),
+    ("bytes=5000-6000", SIZE),
+    ("bytes=-0", SIZE),
+    ("bytes=0-", 0),
+    ("bytes=-1", 0),
+])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+@pytest.mark.parametrize("header, matches", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ("*", True),
+    ('"abcd"', False),
+    ('"x", W/"y"', False),
+])
+def test_etag_matches(header, matches):
+    assert etag_matches(header, '"abc"') is matches
+
+
+@pytest.fixture(params=["plain", "encrypted"])
+def client(request, tmp_path):
+    cipher = FileCipher(KeyRing({"k1": os.urandom(32)}, "k1"), chunk_size=64)
+    if request.param == "plain":
+        names = {"full": f"{BLOB_ID}.bin", "empty": f"{BLOB_ID[::-1]}.bin"}
+        (tmp_path / names["full"]).write_bytes(DATA)
+        (tmp_path / names["empty"]).write_bytes(b"")
+    else:
+        names = {"full": f"{BLOB_ID}.wge.bin", "empty": f"{BLOB_ID[::-1]}.wge.bin"}
+        cipher.write_bytes(DATA, tmp_path / names["full"], bytes(16))
+        cipher.write_bytes(b"", tmp_path / names["empty"], bytes(range(16)))
+    server = FileServer(tmp_path, cipher)
+
+    async def serve(request: Request):
+        return await server.response(request, names[request.path_params["name"]])
+
+    app = Starlette(routes=[Route("/{name}", serve, methods=["GET", "HEAD"])])
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.mark.parametrize("range_header, status, content_range, body", [
+    (None, 200, None, DATA),
+    ("bytes=0-9", 206, "bytes 0-9/1000", DATA[:10]),
+    # Crosses the 64 byte encryption chunks
+    ("bytes=60-200", 206, "bytes 60-200/1000", DATA[60:201]),
+    ("bytes=-10", 206, "bytes 990-999/1000", DATA[-10:]),
+    ("bytes=995-", 206, "bytes 995-999/1000", DATA[995:]),
+    ("bytes=990-5000", 206, "bytes 990-999/1000", DATA[990:]),
+    ("bytes=0-1,5-6", 200, None, DATA),
+    ("bytes=1000-", 416, "bytes */1000", b""),
+])
+def test_ranges(client, range_header, status, content_range, body):
+    response = client.get("/full", headers={"range": range_header} if range_header else {})
+    assert response.status_code == status
+    assert response.headers.get("content-range") == content_range
+    assert response.content == body
+    if status != 416:
+        assert response.headers["content-length"] == str(len(body))
+        assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_head_range_has_no_body(client):
+    response = client.head("/full", headers={"range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 10-19/1000"
+    assert response.content == b""
+
+
+def test_etag_revalidation(client):
+    etag = client.get("/full").headers["etag"]
+    assert etag.startswith(f'"{BLOB_ID}')
+    assert client.get("/full", headers={"if-none-match": etag}).status_code == 304
+    assert client.get("/full", headers={"if-none-match": f"W/{etag}"}).status_code == 304
+    assert client.get("/full", headers={"if-none-match": '"other"'}).status_code == 200
+    not_modified = client.get("/full", headers={"if-none-match": etag, "range": "bytes=0-9"})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+
+
+def test_if_range(client):
+    etag = client.get("/full").headers["etag"]
+    current = client.get("/full", headers={"if-range": etag, "range": "bytes=0-9"})
+    assert current.status_code == 206
+    assert current.content == DATA[:10]
+    # A stale validator gets the whole (changed) file instead of a mismatched piece
+    stale = client.get("/full", headers={"if-range": '"stale"', "range": "bytes=0-9"})
+    assert stale.status_code == 200
+    assert stale.content == DATA
+
+
+def test_zero_length_file(client):
+    response = client.get("/empty")
+    assert response.status_code == 200
+    assert response.content == b""
+    assert response.headers["content-length"] == "0"
+    for range_header in ("bytes=0-", "bytes=-1"):
+        unsatisfiable = client.get("/empty", headers={"range": range_header})
+        assert unsatisfiable.status_code == 416
+        assert unsatisfiable.headers["content-range"] == "bytes */0"
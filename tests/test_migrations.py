@@ -0,0 +1,93 @@
+"""
+Private conversation de-duplication and the unique participant_key index
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from migrations import (  # noqa: E402
+    PARTICIPANT_KEY_INDEX, ensure_conversation_indexes, merge_duplicate_private_conversations, participant_key,
+)
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+def make_db():
+    return mongomock_motor.AsyncMongoMockClient()["whatgram_test"]
+
+
+def conversation(conv_id, participant_ids, last_activity, platform="whatgram", **extra):
+    return {
+        "id": conv_id, "participant_ids": participant_ids, "platform": platform,
+        "conversation_type": "private", "group_id": None, "channel_id": None,
+        "last_activity": last_activity, **extra,
+    }
+
+
+def test_participant_key_is_order_and_duplicate_insensitive():
+    assert participant_key(["b", "a"]) == participant_key(["a", "b", "a"]) == "a|b"
+
+
+def test_duplicates_are_merged_into_the_most_recent():
+    async def run():
+        db = make_db()
+        await db.conversations.insert_many([
+            conversation("old", ["u1", "u2"], datetime(2024, 1, 1)),
+            conversation("new", ["u2", "u1"], datetime(2024, 3, 1)),
+            conversation("older", ["u1", "u2"], None),
+            # Same people on another platform is a different conversation
+            conversation("other-platform", ["u1", "u2"], datetime(2024, 2, 1), platform="telegram"),
+            conversation("single", ["u1", "u3"], datetime(2024, 2, 1)),
+            conversation("group", ["u1", "u2"], datetime(2024, 4, 1), conversation_type="group", group_id="g1"),
+        ])
+        await db.messages.insert_many([
+            {"id": "m1", "conversation_id": "old"},
+            {"id": "m2", "conversation_id": "older"},
+            {"id": "m3", "conversation_id": "new"},
+            {"id": "m4", "conversation_id": "group"},
+        ])
+
+        result = await merge_duplicate_private_conversations(db)
+
+        assert result == {"backfilled": 3, "merged": 2}
+        remaining = {c["id"]: c async for c in db.conversations.find({}, {"_id": 0})}
+        assert sorted(remaining) == ["group", "new", "other-platform", "single"]
+        assert remaining["new"]["participant_key"] == "u1|u2"
+        assert remaining["other-platform"]["participant_key"] == "u1|u2"
+        assert remaining["single"]["participant_key"] == "u1|u3"
+        assert "participant_key" not in remaining["group"]
+        moved = {m["id"]: m["conversation_id"] async for m in db.messages.find({}, {"_id": 0})}
+        assert moved == {"m1": "new", "m2": "new", "m3": "new", "m4": "group"}
+
+        # Once every private conversation has a key the migration is a no-op
+        assert await merge_duplicate_private_conversations(db) == {"backfilled": 0, "merged": 0}
+
+    asyncio.run(run())
+
+
+def test_index_is_unique_for_private_conversations_only():
+    async def run():
+        db = make_db()
+        await ensure_conversation_indexes(db)
+        assert PARTICIPANT_KEY_INDEX in await db.conversations.index_information()
+
+        await db.conversations.insert_one(conversation("a", ["u1", "u2"], None, participant_key="u1|u2"))
+        with pytest.raises(DuplicateKeyError):
+            await db.conversations.insert_one(conversation("b", ["u2", "u1"], None, participant_key="u1|u2"))
+        await db.conversations.insert_one(
+            conversation("c", ["u1", "u2"], None, platform="telegram", participant_key="u1|u2")
+        )
+        # Groups and channels carry no key, so any number of them may share members
+        for conv_id in ("g1", "g2"):
+            await db.conversations.insert_one(
+                conversation(conv_id, ["u1", "u2"], None, conversation_type="group", group_id=conv_id)
+            )
+        assert await db.conversations.count_documents({}) == 4
+
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+"""
+Spliced fan-out frames must be exactly what encoding each recipient's event directly gives
+"""
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from ws_protocol import JSON_CODEC, MSGPACK_CODEC, EventTemplate, message_event  # noqa: E402
+
+CODECS = [
+    JSON_CODEC,
+    pytest.param(MSGPACK_CODEC, marks=pytest.mark.skipif(MSGPACK_CODEC is None, reason="msgpack is not installed")),
+]
+
+
+def make_message(file_message=None):
+    return SimpleNamespace(
+        id="m1", conversation_id="c1", sender_id="u1", receiver_id="u2", content="merhaba",
+        platform="whatgram", timestamp=datetime(2024, 5, 1, 12, 30, 15, 250000), message_type="text",
+        original_language="tr", file_message=file_message,
+    )
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("content, language", [
+    ("Günaydın, nasılsın? İyiyim 👍", "tr"),
+    ("引号 \"quoted\" and \\ backslash\n新行", "zh"),
+    ("", "en"),
+    (None, "en"),
+    ("untranslated", None),
+    ("", None),
+])
+def test_spliced_frame_matches_direct_encode(codec, content, language):
+    message = make_message()
+    template = EventTemplate("new_message", message)
+    frame = template.for_recipient(content, language).render(codec)
+    direct = codec.encode(message_event("new_message", message, content, language))
+    assert frame == direct
+    assert codec.decode(frame) == codec.decode(direct)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_one_template_serves_every_language(codec):
+    file_message = SimpleNamespace(
+        id="f1", filename="0123456789abcdef0123456789abcdef.wge.jpg", original_name="fotoğraf.jpg",
+        file_path="/uploads/0123456789abcdef0123456789abcdef.wge.jpg", file_size=1234, mime_type="image/jpeg",
+        thumbnail_path=None, duration_ms=None, waveform=None,
+    )
+    message = make_message(file_message)
+    template = EventTemplate("new_file", message)
+    for content, language in [("Merhaba", "tr"), ("Hello", "en"), ("", "de"), ("Merhaba", None)]:
+        frame = template.render(codec, content, language)
+        assert codec.decode(frame) == codec.decode(codec.encode(message_event("new_file", message, content, language)))
+    # Rendered frames are cached, and the shared part was encoded once per shape
+    assert template.render(codec, "Hello", "en") is template.render(codec, "Hello", "en")
+    assert template.encodes == 2
+
+
+def test_spliced_frame_to_event():
+    message = make_message()
+    spliced = EventTemplate("new_message", message).for_recipient("Hallo", "de")
+    assert spliced.to_event() == message_event("new_message", message, "Hallo", "de")
+    assert JSON_CODEC.decode(spliced.render(JSON_CODEC)) == spliced.to_event()